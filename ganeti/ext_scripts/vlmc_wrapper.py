@@ -39,9 +39,6 @@ Returns O after successfull completion, 1 on failure
 import os
 import sys
 
-from archipelago.common import Error, DEVICE_PREFIX, loadrc, config
-from archipelago import vlmc as vlmc
-
 
 def ReadEnv():
     """Read the enviromental variables"""
@@ -58,134 +55,28 @@ def ReadEnv():
             }
 
 
-def create(env):
-    """Create a new vlmc Image"""
-    name = env.get("name")
-    size = env.get("size")
-    origin = env.get("origin")
-    origin_size = env.get("origin_size")
-    sys.stderr.write("Creating volume '%s' of size '%s' from '%s'\n"
-                     % (name, size, origin))
-    vlmc.create(name=name, size=int(size), snap=origin, assume_v0=True,
-                v0_size=int(origin_size))
-    return 0
-
-
-def snapshot(env):
-    """Create a snapshot of an existing vlmc Image."""
-    name = env.get("name")
-    snapshot_name = env.get("snapshot_name")
-    sys.stderr.write("Creating snapshot '%s' from '%s'\n" %
-                     (snapshot_name, name))
-    vlmc.snapshot(name=name, snap_name=snapshot_name)
-    return 0
-
-
-def attach(env):
-    """Map an existing vlmc Image to a block device
-
-    This function maps an existing vlmc Image to a block device
-    e.g. /dev/xsegbd{X} and returns the device path. If the mapping
-    already exists, it returns the corresponding device path.
-
-    """
-
-    name = env.get("name")
-
-    # Check if the mapping already exists
-    d_id = vlmc.is_mapped(name)
-    if d_id is not None:
-        # The mapping exists. Return it.
-        sys.stdout.write("%s" % str(DEVICE_PREFIX + str(d_id)))
-        return 0
-    # The mapping doesn't exist. Create it.
-    d_id = vlmc.map_volume(name=name)
-    # The device was successfully mapped. Return it.
-    # maybe assert (d_id == vlmc.is_mapped(name)
-    sys.stdout.write("%s" % str(DEVICE_PREFIX + str(d_id)))
-    return 0
-
-
-def detach(env):
-    """Unmap a vlmc device from the Image it is mapped to
-
-    This function unmaps an vlmc device from the Image it is mapped to.
-    It is idempotent if the mapping doesn't exist at all.
-
-    """
-    name = env.get("name")
-
-    # try:
-    # Check if the mapping already exists
-    d_id = vlmc.is_mapped(name)
-    if d_id is not None:
-        # The mapping exists. Unmap the vlmc device.
-        vlmc.unmap_volume(name=str(DEVICE_PREFIX + str(d_id)))
-    # assert(vlmc.is_mapped(name) == None)
-    return 0
-    # except Error as e:
-    #  sys.stderr.write(str(e)+'\n')
-    #  return -1
-
-
-def grow(env):
-    """Grow an existing vlmc Image"""
-    name = env.get("name")
-    size = env.get("size")
-
-    sys.stderr.write("Resizing '%s'. New size '%s'\n" % (name, size))
-    vlmc.resize(name=name, size=int(size))
-    return 0
-
-
-def remove(env):
-    """Delete a vlmc Image"""
-    name = env.get("name")
-
-    sys.stderr.write("Deleting '%s'\n" % name)
-    vlmc.remove(name=name)
-    return 0
-
-
-def verify(env):
-    return 0
-
-
-def setinfo(env):
-    return 0
-
-
 def main():
     env = ReadEnv()
     if env is None:
         sys.stderr.write("Wrong environment. Aborting...\n")
         return 1
 
-    loadrc(None)
-
-    os.umask(config['UMASK'])
-
-    actions = {
-        'create': create,
-        'snapshot': snapshot,
-        'attach': attach,
-        'detach': detach,
-        'grow': grow,
-        'remove': remove,
-        'verify': verify,
-        'setinfo': setinfo,
-    }
+    action_name = os.path.basename(sys.argv[0])
 
+    # Hand the action to the vlmc command server, if one is running, to avoid
+    # loading the package and joining the segment on every invocation
+    from archipelago import cmdclient
     try:
-        action_name = os.path.basename(sys.argv[0])
-        action = actions[action_name]
-        return action(env)
-    except KeyError:
-        sys.stderr.write("Action '%s' not supported\n" % action_name)
-        return 1
-    except Error as e:
-        sys.stderr.write("Archipelago error: %s\n" % e)
+        reply = cmdclient.call({'prog': 'extstorage', 'action': action_name,
+                                'env': env})
+    except Exception as e:
+        sys.stderr.write("vlmc server error: %s\n" % e)
         return 1
+    if reply is not None:
+        return cmdclient.relay(reply)
+
+    from archipelago import extstorage
+    return extstorage.main(action_name, env)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Event loop integration for xseg contexts.
+
+The signal file descriptor of an Xseg_ctx is registered with an asyncio
+compatible event loop (trollius on python 2), so that many requests can be
+driven from a single thread, without blocking in select():
+
+    actx = AsyncXsegCtx(Xseg_ctx(get_segment()))
+    req = Request.get_info_request(actx.xseg_ctx, mport, name)
+    req = yield From(req.submit_async())
+
+Requests submitted with a plain submit() are delivered through receive().
+"""
+
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from common import Error
+
+
+class AsyncXsegCtx(object):
+    def __init__(self, xseg_ctx, loop=None):
+        if xseg_ctx.async_ctx is not None:
+            raise Error("Context already attached to an event loop")
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.xseg_ctx = xseg_ctx
+        self.loop = loop
+        self.fd = xseg_ctx.fileno()
+        self.receivers = deque()
+
+        xseg_ctx.async_ctx = self
+        xseg_ctx.arm()
+        self.loop.add_reader(self.fd, self.__on_signal)
+        # Replies may have arrived before the context was armed
+        self.__on_signal()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def __on_signal(self):
+        self.xseg_ctx.handle_signal()
+        self.__wake_receivers()
+
+    def __wake_receivers(self):
+        completed = self.xseg_ctx.completed
+        while self.receivers and completed:
+            fut = self.receivers.popleft()
+            if not fut.cancelled():
+                fut.set_result(completed.pop())
+
+    def submit(self, req):
+        """Submit a request and return a future, resolved with the request
+        upon completion"""
+        fut = asyncio.Future(loop=self.loop)
+
+        def complete(req):
+            if not fut.cancelled():
+                fut.set_result(req)
+
+        req.submit(callback=complete)
+        return fut
+
+    def receive(self):
+        """Return a future, resolved with the next completed request that
+        was submitted without a callback"""
+        fut = asyncio.Future(loop=self.loop)
+        self.receivers.append(fut)
+        self.__wake_receivers()
+        return fut
+
+    def close(self):
+        """Detach the context from the event loop. The context itself is left
+        intact."""
+        if self.xseg_ctx.async_ctx is not self:
+            return
+        self.loop.remove_reader(self.fd)
+        self.xseg_ctx.disarm()
+        self.xseg_ctx.async_ctx = None
+        while self.receivers:
+            self.receivers.popleft().cancel()
@@ -234,3 +234,30 @@ def status(cli=False, **kwargs):  # NOQA
 def restart(**kwargs):
     stop(force=True, **kwargs)
     start(**kwargs)
+
+
+def gc(jobs=16, grace=None, rate=0, dry_run=False, verbose=False, cli=False,
+       **kwargs):
+    """Remove the data objects that no map references"""
+    from garbage import Collector, DEFAULT_GRACE
+
+    if grace is None:
+        grace = DEFAULT_GRACE
+
+    def report(name, size):
+        sys.stdout.write("%s %s (%d bytes)\n" %
+                         ("Would remove" if dry_run else "Removed", name,
+                          size))
+
+    collector = Collector(jobs=jobs, grace=grace, rate=rate, dry_run=dry_run,
+                          report=report if cli and verbose else None)
+    stats = collector.run()
+    if cli:
+        pretty_print("Maps read", str(stats['maps']))
+        pretty_print("Referenced objects", str(stats['referenced']))
+        pretty_print("Data objects", str(stats['objects']))
+        pretty_print("Within grace period", str(stats['young']))
+        pretty_print("Of unread maps", str(stats['unknown']))
+        pretty_print("Would remove" if dry_run else "Removed",
+                     "%d (%d bytes)" % (stats['removed'], stats['bytes']))
+    return stats
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Archives of the extents of a snapshot that changed since a base snapshot.
+
+An archive starts with the magic, the format version and the length of a
+JSON description: the names of the snapshot and of its base, if any, and the
+size and the block size of the snapshot. Every extent follows as a record of
+its offset, length and flags, then, unless it is a zero extent, its data and
+their CRC32. An end record, holding the number of extents and the bytes of
+data, closes the archive, so that truncated archives are detected. The data
+of an extent is checked against its CRC32 before any of it is written.
+
+Archives are written from, and applied to, file-like volumes such as
+VolumeIO, which keep the X_READ and X_WRITE requests pipelined.
+"""
+
+import json
+import time
+import zlib
+from struct import Struct
+
+from common import *
+from mapdiff import Extent, DIFF_EXTENT, DIFF_EXTENT_ZERO
+
+ARCHIVE_MAGIC = 'ABK.'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = Struct('>4sLL')
+ARCHIVE_CRC = Struct('>L')
+ARCHIVE_END = 1 << 31
+
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if len(data) != size:
+        raise Error("Truncated archive")
+    return data
+
+
+def _readinto_exact(src, view):
+    done = 0
+    while done < len(view):
+        n = src.readinto(view[done:])
+        if not n:
+            raise Error("Truncated archive")
+        done += n
+
+
+def write_archive(dst, vio, extents, snapshot, base, size, blocksize,
+                  bufsize=1 << 20):
+    """Write an archive of the extents of the volume vio to dst and return
+    the number of extents and the bytes of data written"""
+    info = json.dumps({'snapshot': snapshot, 'base': base, 'size': size,
+                       'blocksize': blocksize, 'created': int(time.time())})
+    dst.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(info)))
+    dst.write(info)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    count = written = 0
+    for e in extents:
+        flags = DIFF_EXTENT_ZERO if e.zero else 0
+        dst.write(DIFF_EXTENT.pack(e.offset, e.length, flags))
+        count += 1
+        if e.zero:
+            continue
+        crc = 0
+        vio.seek(e.offset)
+        end = e.offset + e.length
+        while vio.tell() < end:
+            n = vio.readinto(view[:min(bufsize, end - vio.tell())])
+            if not n:
+                raise Error("Short read on volume %s" % snapshot)
+            dst.write(view[:n])
+            crc = zlib.crc32(buffer(buf, 0, n), crc)
+        dst.write(ARCHIVE_CRC.pack(crc & 0xffffffff))
+        written += e.length
+    dst.write(DIFF_EXTENT.pack(count, written, ARCHIVE_END))
+    return count, written
+
+
+def read_archive_header(src):
+    """Read the header of an archive and return its description"""
+    magic, version, length = ARCHIVE_HEADER.unpack(
+        _read_exact(src, ARCHIVE_HEADER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise Error("Not a backup archive")
+    if version != ARCHIVE_VERSION:
+        raise Error("Unsupported archive version %d" % version)
+    try:
+        return json.loads(_read_exact(src, length))
+    except ValueError:
+        raise Error("Invalid archive description")
+
+
+def _read_extent(src, e, buf, spool):
+    """Read the data of an extent into buf, a window at a time, and check it
+    against its checksum. Extents longer than buf are copied to spool, if
+    any."""
+    bufsize = len(buf)
+    view = memoryview(buf)
+    crc = 0
+    done = 0
+    while done < e.length:
+        n = min(bufsize, e.length - done)
+        start = done if e.length <= bufsize else 0
+        _readinto_exact(src, view[start:start + n])
+        crc = zlib.crc32(buffer(buf, start, n), crc)
+        if spool is not None:
+            spool.write(buffer(buf, 0, n))
+        done += n
+    expected, = ARCHIVE_CRC.unpack(_read_exact(src, ARCHIVE_CRC.size))
+    if (crc & 0xffffffff) != expected:
+        raise Error("Checksum mismatch in the extent at offset %d" % e.offset)
+
+
+def apply_archive(src, vio, bufsize=1 << 20):
+    """Write the extents of an archive, past its header, to the volume vio
+    and return the number of extents and the bytes of data written. With
+    vio None, the archive is only checked.
+
+    The data of every extent is checked against its checksum before any of
+    it is written: it is held in memory, or spooled to a temporary file if
+    it is longer than bufsize.
+    """
+    import tempfile
+
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    zeros = memoryview(bytearray(bufsize))
+    count = written = 0
+    while True:
+        offset, length, flags = DIFF_EXTENT.unpack(
+            _read_exact(src, DIFF_EXTENT.size))
+        if flags & ARCHIVE_END:
+            if (offset, length) != (count, written):
+                raise Error("Archive end does not match its contents")
+            return count, written
+        e = Extent(offset, length, bool(flags & DIFF_EXTENT_ZERO))
+        count += 1
+        if e.zero:
+            if vio is None:
+                continue
+            vio.seek(e.offset)
+            remaining = e.length
+            while remaining > 0:
+                n = min(bufsize, remaining)
+                vio.write(zeros[:n])
+                remaining -= n
+            continue
+        spool = None
+        if e.length > bufsize and vio is not None:
+            spool = tempfile.TemporaryFile()
+        try:
+            _read_extent(src, e, buf, spool)
+            written += e.length
+            if vio is None:
+                continue
+            vio.seek(e.offset)
+            if spool is None:
+                vio.write(view[:e.length])
+                continue
+            spool.seek(0)
+            remaining = e.length
+            while remaining > 0:
+                n = spool.readinto(view[:min(bufsize, remaining)])
+                if not n:
+                    raise Error("Short read of the spooled extent at offset "
+                                "%d" % e.offset)
+                vio.write(view[:n])
+                remaining -= n
+        finally:
+            if spool is not None:
+                spool.close()
+
+
+def verify_archive(src, bufsize=1 << 20):
+    """Check the extents of an archive, past its header, against their
+    checksums and return the number of extents and the bytes of data"""
+    return apply_archive(src, None, bufsize)
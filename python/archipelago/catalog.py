@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Persistent catalog of volume headers.
+
+The catalog keeps the name, version, flags, size and epoch of every volume in
+a local SQLite database, so that volumes can be listed without reading every
+map header from the storage. It is refreshed incrementally:
+
+ * On file storage, the modification time of every directory created by
+   filed is recorded. Only the directories that changed since the last
+   refresh are listed again, and only the headers whose file changed are read
+   again.
+ * On RADOS, which keeps no log of changed objects, the object names are
+   listed and only the headers that are new, or whose modification time
+   changed, are read again.
+"""
+
+import os
+import re
+import time
+import sqlite3
+
+from common import *
+from vlmc import Volume, parse_volume_header, is_header_candidate, \
+    filed_object_dir, filed_dir_re, open_rados, FILED_DIR_DEPTH, \
+    MAP_HEADER_SIZE
+
+# Modification times this recent are not trusted, since the file or
+# directory may change again within the same timestamp
+MTIME_SLACK = 2
+
+pithos_object_re = re.compile('^[0-9a-f]{64}$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    header_object TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    readonly INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    size INTEGER,
+    epoch INTEGER,
+    location TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS volumes_name ON volumes (name);
+CREATE INDEX IF NOT EXISTS volumes_location ON volumes (location);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+VOLUME_COLUMNS = "name, version, header_object, readonly, deleted, size, epoch"
+
+
+def _to_volume(row):
+    name, version, header_object, readonly, deleted, size, epoch = row
+    return Volume(name=name, version=version, header_object=header_object,
+                  readonly=bool(readonly), deleted=bool(deleted), size=size,
+                  epoch=epoch)
+
+
+class Catalog(object):
+    """Catalog of the volumes of the storage of the blocker peer"""
+    def __init__(self, path=None):
+        if path is None:
+            path = config['CATALOG_PATH']
+        self.path = path
+        catalog_dir = os.path.dirname(path)
+        try:
+            if catalog_dir and not os.path.isdir(catalog_dir):
+                os.makedirs(catalog_dir)
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.text_factory = str
+            self.db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            raise Error("Cannot open catalog %s: %s" % (path, e))
+
+        self.storage = self.__storage_id()
+        with self.db:
+            if self.__get_meta('storage') != self.storage:
+                self.db.execute("DELETE FROM volumes")
+                self.db.execute("DELETE FROM dirs")
+                self.__set_meta('storage', self.storage)
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def __storage_id():
+        blocker = peers['blockerm']
+        if isinstance(blocker, Filed):
+            return 'filed:%s' % os.path.realpath(blocker.archip_dir)
+        elif isinstance(blocker, Radosd):
+            return 'rados:%s' % blocker.pool
+        raise Error("Invalid storage")
+
+    def __get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key, )).fetchone()
+        return row[0] if row is not None else None
+
+    def __set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                        "VALUES (?, ?)", (key, value))
+
+    def volumes(self):
+        """Return the Volumes in the catalog, as of its last refresh"""
+        rows = self.db.execute("SELECT %s FROM volumes ORDER BY name" %
+                               VOLUME_COLUMNS)
+        return [_to_volume(row) for row in rows]
+
+    def get(self, name):
+        """Return the Volume of a name, as of the last refresh, or None. A
+        version 2 header is preferred over older ones left behind by an
+        upgrade."""
+        row = self.db.execute("SELECT %s FROM volumes WHERE name = ? "
+                              "ORDER BY version DESC LIMIT 1" %
+                              VOLUME_COLUMNS, (name, )).fetchone()
+        return _to_volume(row) if row is not None else None
+
+    def __store(self, volume, location, mtime):
+        if volume is None:
+            return
+        self.db.execute("INSERT OR REPLACE INTO volumes (name, version, "
+                        "header_object, readonly, deleted, size, epoch, "
+                        "location, mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        tuple(volume) + (location, mtime))
+
+    def __forget(self, header_object):
+        self.db.execute("DELETE FROM volumes WHERE header_object = ?",
+                        (header_object, ))
+
+    def refresh(self, jobs=16):
+        """Bring the catalog up to date with the storage"""
+        with self.db:
+            if isinstance(peers['blockerm'], Filed):
+                self.__refresh_filed(peers['blockerm'].archip_dir, jobs)
+            else:
+                self.__refresh_rados(jobs)
+
+    def refresh_volume(self, name):
+        """Read again the headers of a single volume and return its Volume,
+        or None if it does not exist"""
+        header_objects = [ARCHIP_PREFIX + name, name]
+        with self.db:
+            if isinstance(peers['blockerm'], Filed):
+                root = peers['blockerm'].archip_dir
+                for header_object in header_objects:
+                    locations = [filed_object_dir(header_object)]
+                    if pithos_object_re.match(header_object):
+                        # Left in place of the old pithos layout
+                        locations.append(os.path.join(header_object[0:2],
+                                                      header_object[2:4],
+                                                      header_object[4:6]))
+                    self.__forget(header_object)
+                    for location in locations:
+                        result = _probe_file(root, location, header_object,
+                                             None)
+                        if result is not None:
+                            self.__store(result[0], location, result[1])
+                            break
+            else:
+                cluster, ioctx = open_rados()
+                try:
+                    for header_object in header_objects:
+                        result = _probe_object(ioctx, header_object, None)
+                        if result is None:
+                            self.__forget(header_object)
+                        else:
+                            self.__store(result[0], None, result[1])
+                finally:
+                    ioctx.close()
+                    cluster.shutdown()
+        return self.get(name)
+
+    def __refresh_filed(self, root, jobs):
+        from multiprocessing.pool import ThreadPool
+
+        now = time.time()
+        dirs = {}
+        children = {}
+        for path, parent, mtime in self.db.execute("SELECT path, parent, "
+                                                   "mtime FROM dirs"):
+            dirs[path] = mtime
+            children.setdefault(parent, []).append(path)
+        known = {}
+        for header_object, location, mtime in self.db.execute(
+                "SELECT header_object, location, mtime FROM volumes"):
+            known.setdefault(location, {})[header_object] = mtime
+
+        seen_dirs = []
+        changed_leaves = []
+
+        def walk(rel, parent, depth):
+            path = os.path.join(root, rel)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return
+            unchanged = dirs.get(rel) == mtime
+            if depth == FILED_DIR_DEPTH:
+                if not unchanged:
+                    changed_leaves.append(rel)
+            else:
+                if unchanged:
+                    subdirs = children.get(rel, [])
+                else:
+                    try:
+                        subdirs = [os.path.join(rel, n)
+                                   for n in os.listdir(path)
+                                   if filed_dir_re.match(n)]
+                    except OSError:
+                        return
+                for subdir in subdirs:
+                    walk(subdir, rel, depth + 1)
+            if now - mtime < MTIME_SLACK:
+                mtime = None
+            seen_dirs.append((rel, parent, mtime))
+
+        walk('', None, 0)
+
+        # Headers of changed directories are all probed, those of unchanged
+        # ones only if they are already known
+        probes = []
+        changed = set(changed_leaves)
+        for location in changed_leaves:
+            try:
+                names = os.listdir(os.path.join(root, location))
+            except OSError:
+                continue
+            mtimes = known.get(location, {})
+            probes.extend((location, name, mtimes.get(name))
+                          for name in names if is_header_candidate(name))
+        for location, mtimes in known.iteritems():
+            if location not in changed:
+                probes.extend((location, name, mtime)
+                              for name, mtime in mtimes.iteritems())
+
+        def probe(args):
+            location, name, mtime = args
+            return location, name, _probe_file(root, location, name, mtime,
+                                               now)
+
+        found = set()
+        pool = ThreadPool(jobs)
+        try:
+            for location, name, result in pool.imap_unordered(probe, probes,
+                                                              chunksize=64):
+                if result is None:
+                    continue
+                found.add(name)
+                if result is not True:
+                    self.__store(result[0], location, result[1])
+        finally:
+            pool.terminate()
+
+        for mtimes in known.itervalues():
+            for name in mtimes:
+                if name not in found:
+                    self.__forget(name)
+        self.db.execute("DELETE FROM dirs")
+        self.db.executemany("INSERT INTO dirs (path, parent, mtime) "
+                            "VALUES (?, ?, ?)", seen_dirs)
+
+    def __refresh_rados(self, jobs):
+        from radoslist import list_objects
+        from multiprocessing.pool import ThreadPool
+
+        now = time.time()
+        known = dict(self.db.execute("SELECT header_object, mtime "
+                                     "FROM volumes"))
+        cluster, ioctx = open_rados()
+        pool = ThreadPool(jobs)
+        try:
+            names = (name for _, name in list_objects(ioctx)
+                     if is_header_candidate(name))
+
+            def probe(name):
+                return name, _probe_object(ioctx, name, known.get(name), now)
+
+            found = set()
+            for name, result in pool.imap_unordered(probe, names,
+                                                    chunksize=64):
+                if result is None:
+                    continue
+                found.add(name)
+                if result is not True:
+                    self.__store(result[0], None, result[1])
+        finally:
+            pool.terminate()
+            ioctx.close()
+            cluster.shutdown()
+
+        for name in known:
+            if name not in found:
+                self.__forget(name)
+
+
+def _trusted_mtime(mtime, now):
+    if now is None or now - mtime < MTIME_SLACK:
+        return None
+    return mtime
+
+
+def _probe_file(root, location, name, known_mtime, now=None):
+    """Return True if a header file is unchanged since known_mtime, None if
+    it is gone or holds no map header, or its Volume and mtime otherwise"""
+    path = os.path.join(root, location, name)
+    try:
+        mtime = os.stat(path).st_mtime
+        if known_mtime is not None and mtime == known_mtime:
+            return True
+        with open(path, 'rb') as f:
+            header = f.read(MAP_HEADER_SIZE)
+    except (IOError, OSError):
+        return None
+    volume = parse_volume_header(name, header)
+    if volume is None:
+        return None
+    return volume, _trusted_mtime(mtime, now)
+
+
+def _probe_object(ioctx, name, known_mtime, now=None):
+    """Like _probe_file, for RADOS objects"""
+    from radoslist import rados_module
+    rados = rados_module()
+    try:
+        _, mtime = ioctx.stat(name)
+        mtime = time.mktime(mtime)
+        if known_mtime is not None and mtime == known_mtime:
+            return True
+        header = ioctx.read(name, length=MAP_HEADER_SIZE)
+    except rados.Error:
+        return None
+    volume = parse_volume_header(name, header)
+    if volume is None:
+        return None
+    return volume, _trusted_mtime(mtime, now)
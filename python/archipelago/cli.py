@@ -23,11 +23,41 @@ import argparse
 from common import *
 
 
-def vlmc_parser():
+class BatchArgumentParser(argparse.ArgumentParser):
+    """Argument parser for batch lines, which reports errors with an
+    exception instead of exiting"""
+    def error(self, message):
+        raise Error(message)
+
+
+def snapshot_member(arg):
+    """Parse a volume:snapshot member of a snapshot group"""
+    name, sep, snap_name = arg.rpartition(':')
+    if not sep or not name or not snap_name:
+        raise argparse.ArgumentTypeError("expected volume:snapshot, got %s" %
+                                         arg)
+    return name, snap_name
+
+
+def wait_policy(arg):
+    """Parse a wait policy, sleep or spin[:usecs]"""
+    try:
+        return parse_wait_policy(arg)
+    except Error as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def vlmc_parser(parser_class=argparse.ArgumentParser):
     import vlmc
-    parser = argparse.ArgumentParser(description='vlmc tool')
+    import cmdclient
+    import cmdserver
+    parser = parser_class(description='vlmc tool')
     parser.add_argument('-c', '--config', type=str, nargs='?',
                         help='config file')
+    parser.add_argument('--wait-policy', type=wait_policy, default=None,
+                        help='how to wait for replies: sleep on the signal '
+                        'of the port, or spin[:usecs] to busy-poll for usecs '
+                        'microseconds first (default: sleep)')
     subparsers = parser.add_subparsers()
 
     create_parser = subparsers.add_parser('create', help='Create volume')
@@ -83,6 +113,17 @@ def vlmc_parser():
     showmapped_parser.set_defaults(func=vlmc.showmapped_wrapper)
 
     list_parser = subparsers.add_parser('list', help='List volumes')
+    list_parser.add_argument('-j', '--jobs', type=int, default=16,
+                             help='number of headers read in parallel')
+    list_parser.add_argument('--no-catalog', action='store_false',
+                             dest='use_catalog', default=True,
+                             help='scan the storage instead of the volume '
+                             'catalog')
+    list_parser.add_argument('--prefix', type=str, default=None,
+                             help='only list header objects starting with '
+                             'prefix')
+    list_parser.add_argument('--namespace', type=str, default=None,
+                             help='RADOS namespace to list, or * for all')
     list_parser.set_defaults(func=vlmc.list_volumes)
 
     snapshot_parser = subparsers.add_parser('snapshot', help='snapshot volume')
@@ -98,6 +139,26 @@ def vlmc_parser():
                                  ' found as version 0.')
     snapshot_parser.set_defaults(func=vlmc.snapshot)
 
+    snapshot_group_parser = subparsers.add_parser('snapshot-group',
+                                                  help='snapshot several '
+                                                  'volumes at once')
+    snapshot_group_parser.add_argument('members', type=snapshot_member,
+                                       nargs='+', metavar='volume:snapshot',
+                                       help='volume and snapshot name')
+    snapshot_group_parser.add_argument('-p', '--pause', action='store_true',
+                                       default=False,
+                                       help='pause the tapdisks of mapped '
+                                       'volumes while snapshotting')
+    snapshot_group_parser.add_argument('-v0', '--assume_v0',
+                                       action='store_true', default=False,
+                                       help='Assume target volumes as '
+                                       'version 0 if necessary')
+    snapshot_group_parser.add_argument('--v0_size', type=int, nargs='?',
+                                       default=-1,
+                                       help='Size of target volumes to be '
+                                       'assumed, if found as version 0.')
+    snapshot_group_parser.set_defaults(func=vlmc.snapshot_group)
+
     rename_parser = subparsers.add_parser('rename', help='rename volume')
     # group = rename_parser.add_mutually_exclusive_group(required=True)
     rename_parser.add_argument('name', type=str,  help='volume name')
@@ -112,6 +173,17 @@ def vlmc_parser():
     rename_parser.set_defaults(func=vlmc.rename)
 
     ls_parser = subparsers.add_parser('ls', help='List volumes')
+    ls_parser.add_argument('-j', '--jobs', type=int, default=16,
+                           help='number of headers read in parallel')
+    ls_parser.add_argument('--no-catalog', action='store_false',
+                           dest='use_catalog', default=True,
+                           help='scan the storage instead of the volume '
+                           'catalog')
+    ls_parser.add_argument('--prefix', type=str, default=None,
+                           help='only list header objects starting with '
+                           'prefix')
+    ls_parser.add_argument('--namespace', type=str, default=None,
+                           help='RADOS namespace to list, or * for all')
     ls_parser.set_defaults(func=vlmc.list_volumes)
 
     resize_parser = subparsers.add_parser('resize', help='Resize volume')
@@ -170,12 +242,70 @@ def vlmc_parser():
                              'found as version 0.')
     info_parser.set_defaults(func=vlmc.info)
 
-#    map_info_parser = subparsers.add_parser('mapinfo',
-#                                            help='Show volume map_info')
-#    map_info_parser.add_argument('name', type=str,  help='volume name')
-#    map_info_parser.set_defaults(func=vlmc.mapinfo)
-#    map_info_parser.add_argument('-v', '--verbose',  action='store_true',
-#                                 default=False, help='')
+    map_info_parser = subparsers.add_parser('mapinfo',
+                                            help='Show volume map_info')
+    map_info_parser.add_argument('name', type=str,  help='volume name')
+    map_info_parser.set_defaults(func=vlmc.mapinfo)
+    map_info_parser.add_argument('-v', '--verbose',  action='store_true',
+                                 default=False,
+                                 help='list every object instead of extents')
+    map_info_parser.add_argument('--json', action='store_true',
+                                 default=False, dest='json_output',
+                                 help='output JSON')
+    map_info_parser.add_argument('-w', '--window', type=int, default=None,
+                                 help='size in MB of the map range queried '
+                                 'per request')
+    map_info_parser.add_argument('-d', '--depth', type=int, default=8,
+                                 help='number of map requests in flight')
+    map_info_parser.add_argument('-v0', '--assume_v0',  action='store_true',
+                                 default=False,
+                                 help='Assume target volume as version 0 if '
+                                 'necessary')
+    map_info_parser.add_argument('--v0_size', type=int, nargs='?',
+                                 default=-1,
+                                 help='Size of target volume to be assumed, '
+                                 'if found as version 0.')
+
+    flatten_parser = subparsers.add_parser('flatten',
+                                           help='Copy up the objects a clone '
+                                           'shares with its snapshot')
+    flatten_parser.add_argument('name', type=str,  help='volume name')
+    flatten_parser.add_argument('-j', '--jobs', type=int, default=4,
+                                help='number of map requests in flight')
+    flatten_parser.add_argument('-b', '--batch', type=int, default=16,
+                                help='objects copied per map request')
+    flatten_parser.add_argument('-r', '--rate', type=int, default=0,
+                                help='objects copied per second, 0 for no '
+                                'limit')
+    flatten_parser.add_argument('-v0', '--assume_v0',  action='store_true',
+                                default=False,
+                                help='Assume target volume as version 0 if '
+                                'necessary')
+    flatten_parser.add_argument('--v0_size', type=int, nargs='?', default=-1,
+                                help='Size of target volume to be assumed, if '
+                                'found as version 0.')
+    flatten_parser.set_defaults(func=vlmc.flatten)
+
+    du_parser = subparsers.add_parser('du', help='Show the exclusive and '
+                                      'shared space of volumes')
+    du_parser.add_argument('names', type=str, nargs='*',
+                           help='volumes to show, all if none given')
+    du_parser.add_argument('--json', action='store_true',
+                           dest='json_output', default=False,
+                           help='output JSON')
+    du_parser.set_defaults(func=vlmc.du, blktap=False)
+
+    diff_parser = subparsers.add_parser('diff', help='Show the extents that '
+                                        'changed between two snapshots')
+    diff_parser.add_argument('snap_a', type=str, help='older snapshot')
+    diff_parser.add_argument('snap_b', type=str, help='newer snapshot')
+    diff_parser.add_argument('-o', '--output', type=str, dest='path',
+                             default='-', help='output file, or - for stdout')
+    diff_parser.add_argument('-b', '--binary', action='store_true',
+                             default=False,
+                             help='output the compact binary form instead '
+                             'of JSON lines')
+    diff_parser.set_defaults(func=vlmc.diff, blktap=False)
 
     hash_parser = subparsers.add_parser('hash', help='Hash snapshot')
     # group = hash_parser.add_mutually_exclusive_group(required=True)
@@ -189,6 +319,98 @@ def vlmc_parser():
                              'found as version 0.')
     hash_parser.set_defaults(func=vlmc.hash)
 
+    import_parser = subparsers.add_parser('import',
+                                          help='Import raw image to volume')
+    import_parser.add_argument('name', type=str,  help='volume name')
+    import_parser.add_argument('path', type=str, nargs='?', default='-',
+                               help='image file, or - for stdin')
+    import_parser.add_argument('-d', '--iodepth', type=int, default=16,
+                               help='number of requests in flight')
+    import_parser.add_argument('-b', '--blocksize', type=int, default=1024,
+                               help='request size in KB')
+    import_parser.add_argument('--no-sparse', dest='sparse',
+                               action='store_false', default=True,
+                               help='write blocks of zeros too, instead of '
+                               'skipping those over ranges of the volume '
+                               'that read as zeros')
+    import_parser.add_argument('-v0', '--assume_v0',  action='store_true',
+                               default=False,
+                               help='Assume target volume as version 0 if '
+                               'necessary')
+    import_parser.add_argument('--v0_size', type=int, nargs='?', default=-1,
+                               help='Size of target volume to be assumed, if '
+                               'found as version 0.')
+    import_parser.set_defaults(func=vlmc.import_volume, blktap=False)
+
+    export_parser = subparsers.add_parser('export',
+                                          help='Export volume to raw image')
+    export_parser.add_argument('name', type=str,  help='volume name')
+    export_parser.add_argument('path', type=str, nargs='?', default='-',
+                               help='image file, or - for stdout')
+    export_parser.add_argument('-d', '--iodepth', type=int, default=16,
+                               help='number of requests in flight')
+    export_parser.add_argument('-b', '--blocksize', type=int, default=1024,
+                               help='request size in KB')
+    export_parser.add_argument('--no-sparse', dest='sparse',
+                               action='store_false', default=True,
+                               help='write unallocated objects as zeros')
+    export_parser.add_argument('-v0', '--assume_v0',  action='store_true',
+                               default=False,
+                               help='Assume target volume as version 0 if '
+                               'necessary')
+    export_parser.add_argument('--v0_size', type=int, nargs='?', default=-1,
+                               help='Size of target volume to be assumed, if '
+                               'found as version 0.')
+    export_parser.set_defaults(func=vlmc.export_volume, blktap=False)
+
+    backup_parser = subparsers.add_parser('backup',
+                                          help='Archive the extents of a '
+                                          'snapshot changed since another')
+    backup_parser.add_argument('snap', type=str, help='snapshot to archive')
+    backup_parser.add_argument('path', type=str, nargs='?', default='-',
+                               help='archive file, or - for stdout')
+    backup_parser.add_argument('--base', type=str, default=None,
+                               help='base snapshot, a full archive is '
+                               'written if none given')
+    backup_parser.add_argument('-d', '--iodepth', type=int, default=16,
+                               help='number of requests in flight')
+    backup_parser.add_argument('-b', '--blocksize', type=int, default=1024,
+                               help='request size in KB')
+    backup_parser.set_defaults(func=vlmc.backup, blktap=False)
+
+    restore_parser = subparsers.add_parser('restore',
+                                           help='Apply a chain of archives '
+                                           'to a volume')
+    restore_parser.add_argument('name', type=str,  help='volume name')
+    restore_parser.add_argument('paths', type=str, nargs='+',
+                                help='archive files, oldest first, or - for '
+                                'stdin')
+    restore_parser.add_argument('-d', '--iodepth', type=int, default=16,
+                                help='number of requests in flight')
+    restore_parser.add_argument('-b', '--blocksize', type=int, default=1024,
+                                help='request size in KB')
+    restore_parser.set_defaults(func=vlmc.restore, blktap=False)
+
+    batch_parser = subparsers.add_parser('batch',
+                                         help='Run volume operations from a '
+                                         'file')
+    batch_parser.add_argument('path', type=str, nargs='?', default='-',
+                              help='file with one operation per line, or - '
+                              'for stdin')
+    batch_parser.add_argument('-j', '--jobs', type=int, default=8,
+                              dest='max_workers',
+                              help='number of operations run in parallel')
+    batch_parser.set_defaults(func=vlmc.batch)
+
+    serve_parser = subparsers.add_parser('serve',
+                                         help='Serve vlmc commands on a Unix '
+                                         'socket')
+    serve_parser.add_argument('-s', '--socket', type=str, default=None,
+                              dest='socket_path',
+                              help='socket path, defaults to %s' %
+                              cmdclient.VLMC_SOCKET)
+    serve_parser.set_defaults(func=cmdserver.serve, blktap=False)
+
     return parser
 
 
@@ -221,6 +443,23 @@ def archipelago_parser():
     restart_parser.add_argument('role', type=str, nargs='?',
                                 help='peer to restart')
 
+    gc_parser = subparsers.add_parser('gc', help='Remove the data objects '
+                                      'that no map references')
+    gc_parser.set_defaults(func=archipelago.gc)
+    gc_parser.add_argument('-n', '--dry-run', action='store_true',
+                           dest='dry_run', default=False,
+                           help='only report the objects to remove')
+    gc_parser.add_argument('-g', '--grace', type=int, default=None,
+                           help='keep objects modified less than this many '
+                           'seconds ago (default: one day)')
+    gc_parser.add_argument('-j', '--jobs', type=int, default=16,
+                           help='maps read and objects examined in parallel')
+    gc_parser.add_argument('-r', '--rate', type=float, default=0,
+                           help='objects removed per second, 0 for no limit')
+    gc_parser.add_argument('-v', '--verbose', action='store_true',
+                           default=False,
+                           help='print every object removed')
+
     return parser
 
 
@@ -239,17 +478,28 @@ def main():
     try:
         args = parser.parse_args()
         loadrc(args.config)
-        kwargs = vars(args)
-        # if parser_func == archipelago_parser:
-            # peers = construct_peers()
-        if parser_func == vlmc_parser:
-            if config['BLKTAP_ENABLED'] is False:
-                print red("Blktap module is disabled.")
-                return -1
-            os.umask(config['UMASK'])
-
-        args.func(cli=True, **kwargs)
-        return 0
+        set_wait_policy(getattr(args, 'wait_policy', None))
+        return dispatch(parser_func, args)
     except Error as e:
         print red(e)
         return -1
+
+
+def dispatch(parser_func, args):
+    """Run the command of parsed arguments, once the configuration has been
+    loaded"""
+    kwargs = vars(args)
+    # The wait policy is set once per process, see main()
+    kwargs.pop('wait_policy', None)
+    # if parser_func == archipelago_parser:
+        # peers = construct_peers()
+    if parser_func == vlmc_parser:
+        # import/export talk to vlmcd directly and need no blktap
+        if kwargs.get('blktap', True) and \
+           config['BLKTAP_ENABLED'] is False:
+            print red("Blktap module is disabled.")
+            return -1
+        os.umask(config['UMASK'])
+
+    args.func(cli=True, **kwargs)
+    return 0
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Thin client of the vlmc command server.
+
+This module must stay cheap to import. It does not import the rest of the
+package, so that a command served by a running `vlmc serve` costs no more
+than a connect and a round trip. When no server is reachable, or the server
+cannot run the command, the command is run in-process as before.
+
+Messages are JSON objects, each preceded by its length as a 32 bit unsigned
+integer in network byte order.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+
+VLMC_SOCKET = "/var/run/archipelago/vlmc.socket"
+
+header_struct = struct.Struct("!I")
+
+
+def get_socket_path():
+    return os.environ.get("ARCHIPELAGO_VLMC_SOCKET", VLMC_SOCKET)
+
+
+def send_msg(sock, msg):
+    data = json.dumps(msg)
+    sock.sendall(header_struct.pack(len(data)) + data)
+
+
+def _recv_all(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def recv_msg(sock):
+    header = _recv_all(sock, header_struct.size)
+    if header is None:
+        return None
+    data = _recv_all(sock, header_struct.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def call(request, endpoint=None):
+    """Send a request to the command server and return its reply, or None if
+    the command must be run locally"""
+    if endpoint is None:
+        endpoint = get_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(5)
+            sock.connect(endpoint)
+            sock.settimeout(None)
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES,
+                           errno.EPERM):
+                return None
+            raise
+        send_msg(sock, request)
+        reply = recv_msg(sock)
+    finally:
+        sock.close()
+    if reply is None or reply.get('fallback'):
+        return None
+    return reply
+
+
+def relay(reply):
+    """Write out the output of a served command and return its exit code"""
+    sys.stdout.write(reply['stdout'].encode('utf-8'))
+    sys.stdout.flush()
+    sys.stderr.write(reply['stderr'].encode('utf-8'))
+    return reply['status']
+
+
+def main():
+    reply = None
+    prog = os.path.basename(sys.argv[0])
+    if prog == 'vlmc':
+        try:
+            reply = call({'prog': prog, 'argv': sys.argv[1:]})
+        except (socket.error, ValueError) as e:
+            # The command may have run, so it is not retried locally
+            sys.stderr.write("vlmc server error: %s\n" % e)
+            return -1
+    if reply is None:
+        from archipelago.cli import main as cli_main
+        return cli_main()
+    return relay(reply)
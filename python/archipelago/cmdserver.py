@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Long-lived server of vlmc commands.
+
+`vlmc serve` loads the configuration once, keeps the xseg bindings loaded and
+the segment joined, and runs the commands forwarded by cmdclient, each on its
+own thread. The output of a command is captured and sent back to the client
+along with its exit code.
+
+Commands that stream data through the client's standard input or output, or
+that name a configuration file of their own, are handed back to the client,
+which runs them locally.
+"""
+
+import os
+import stat
+import socket
+import signal
+import threading
+import SocketServer
+from cStringIO import StringIO
+
+from common import *
+from cmdclient import get_socket_path, send_msg, recv_msg
+
+
+class CapturedStream(object):
+    """Stream that redirects the writes of a thread to a buffer, while it
+    captures them, and passes all other writes to the wrapped stream"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __target(self):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            return self.stream
+        return buf
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        buf = self.local.buf
+        self.local.buf = None
+        return buf.getvalue()
+
+    def write(self, data):
+        self.__target().write(data)
+
+    def writelines(self, lines):
+        self.__target().writelines(lines)
+
+    def flush(self):
+        self.__target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CommandHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        request = recv_msg(self.request)
+        if request is None:
+            return
+        send_msg(self.request, self.server.run(request))
+
+
+class CommandServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    daemon_threads = True
+    # Not run by the server, since they use the client's stdin, stdout or
+    # working directory
+    local_commands = ('import', 'export', 'diff', 'backup', 'restore',
+                      'batch', 'serve')
+
+    def __init__(self, socket_path):
+        from cli import vlmc_parser, BatchArgumentParser
+
+        self.socket_path = socket_path
+        self.vlmc_parser = vlmc_parser
+        self.parser = vlmc_parser(parser_class=BatchArgumentParser)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               CommandHandler)
+        os.chmod(socket_path, stat.S_IRUSR | stat.S_IWUSR)
+
+        self.stdout = sys.stdout = CapturedStream(sys.stdout)
+        self.stderr = sys.stderr = CapturedStream(sys.stderr)
+
+    def run(self, request):
+        prog = request.get('prog')
+        if prog == 'vlmc':
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+            if not argv or argv[0] in self.local_commands or \
+               '-c' in argv or any(a.startswith('--config') for a in argv):
+                return {'fallback': True}
+            run = lambda: self.run_vlmc(argv)
+        elif prog == 'extstorage':
+            import extstorage
+            action = request['action'].encode('utf-8')
+            env = dict((k, v.encode('utf-8') if v is not None else None)
+                       for k, v in request['env'].iteritems())
+            run = lambda: extstorage.run_action(action, env)
+        else:
+            return {'fallback': True}
+
+        self.stdout.capture()
+        self.stderr.capture()
+        try:
+            try:
+                status = run()
+            except Exception as e:
+                sys.stderr.write("%s\n" % e)
+                status = -1
+        finally:
+            out = self.stdout.release()
+            err = self.stderr.release()
+        return {'status': status,
+                'stdout': out.decode('utf-8', 'replace'),
+                'stderr': err.decode('utf-8', 'replace')}
+
+    def run_vlmc(self, argv):
+        from cli import dispatch
+
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit as e:
+            # --help
+            return e.code
+        except Error as e:
+            self.parser.print_usage(sys.stderr)
+            sys.stderr.write("vlmc: error: %s\n" % e)
+            return 2
+
+        try:
+            return dispatch(self.vlmc_parser, args)
+        except Error as e:
+            print red(e)
+            return -1
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        sys.stdout = self.stdout.stream
+        sys.stderr = self.stderr.stream
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+def serve(socket_path=None, cli=False, **kwargs):
+    """Serve vlmc commands on a Unix socket, until interrupted.
+
+    The configuration is loaded once, so the server must be restarted for
+    configuration changes to take effect.
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    if os.path.exists(socket_path):
+        # Refuse to steal the socket of a running server
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            raise Error("%s is already in use" % socket_path)
+        finally:
+            sock.close()
+
+    server = CommandServer(socket_path)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    if cli:
+        sys.stdout.write("Serving vlmc commands on %s\n" % socket_path)
+        sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutdown_xseg_ctxs()
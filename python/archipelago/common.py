@@ -17,8 +17,6 @@
 #
 
 
-from xseg.xseg_api import *
-from xseg.xprotocol import *
 from ctypes import (
     CFUNCTYPE,
     cast,
@@ -33,26 +31,28 @@ from ctypes import (
     byref,
     c_int,
     c_char,
+    c_ubyte,
     Structure,
     CDLL
 )
-cb_null_ptrtype = CFUNCTYPE(None, uint32_t)
 
 import os
 import sys
 import time
-import psutil
+import atexit
+import threading
+import Queue
 import errno
 import signal
 from subprocess import check_call
 import socket
-import random
 from select import select
-import ConfigParser
+from functools import partial
 from grp import getgrnam
 from pwd import getpwnam
 import stat
 import struct
+from zlib import crc32
 
 libc = CDLL("libc.so.6")
 
@@ -60,14 +60,12 @@ get_errno_loc = libc.__errno_location
 get_errno_loc.restype = POINTER(c_int)
 
 
-random.seed()
 hostname = socket.gethostname()
 
 valid_role_types = ['file_blocker', 'rados_blocker', 'mapperd', 'vlmcd',
                     'poold']
 valid_segment_types = ['posix']
 
-peers = dict()
 segment = None
 
 BIN_DIR = '/usr/bin/'
@@ -96,6 +94,68 @@ def is_power2(x):
     return bool(x != 0 and (x & (x-1)) == 0)
 
 
+# Layout of struct xseg_request_create and its scatterlist in the segment
+create_header_struct = struct.Struct("=LLL")
+create_scatterlist_struct = struct.Struct("=256sLL")
+
+
+def pack_create_request(blocksize, create_flags, objects):
+    """Pack the data of a create request in a single preallocated buffer.
+
+    Objects is a sequence of (name, flags) tuples. The header and every
+    scatterlist entry are encoded by a single Struct, with the entry format
+    repeated for each object.
+    """
+    cnt = len(objects)
+    values = [cnt, blocksize, create_flags]
+    for name, flags in objects:
+        values.extend((name, len(name), flags))
+    packer = struct.Struct(create_header_struct.format +
+                           create_scatterlist_struct.format[1:] * cnt)
+    buf = bytearray(packer.size)
+    packer.pack_into(buf, 0, *values)
+    return buf
+
+
+def buffer_size(data):
+    """Return the size in bytes of an object supporting the buffer
+    protocol"""
+    if isinstance(data, basestring):
+        return len(data)
+    try:
+        view = memoryview(data)
+    except TypeError:
+        # Objects supporting only the old buffer interface, e.g. mmap
+        return len(buffer(data))
+    size = view.itemsize
+    for dim in view.shape:
+        size *= dim
+    return size
+
+
+class XsegBindings(object):
+    """The names of the xseg bindings, from xseg.xprotocol and
+    xseg.xseg_api.
+
+    The bindings are imported on first use, so that commands which do not
+    talk to the peers do not pay for them. Names are looked up in xprotocol
+    first, and are cached once looked up.
+    """
+    def __getattr__(self, name):
+        import xseg.xseg_api
+        import xseg.xprotocol
+        for module in (xseg.xprotocol, xseg.xseg_api):
+            try:
+                value = getattr(module, name)
+            except AttributeError:
+                continue
+            setattr(self, name, value)
+            return value
+        raise AttributeError("The xseg bindings have no '%s'" % name)
+
+api = XsegBindings()
+
+
 # hack to test green waiting with python gevent.
 class posixfd_signal_desc(Structure):
     pass
@@ -106,20 +166,28 @@ posixfd_signal_desc._fields_ = [
 ]
 
 
-def xseg_wait_signal_green(ctx, sd, timeout):
+def get_signal_fd(sd):
     posixfd_sd = cast(sd, POINTER(posixfd_signal_desc))
-    fd = posixfd_sd.contents.fd
-    select([fd], [], [], timeout/1000000.0)
+    return posixfd_sd.contents.fd
+
+
+def clear_signal_fd(fd):
     while True:
         try:
             os.read(fd, 512)
         except OSError as (e, msg):
-            if e == 11:
+            if e == errno.EAGAIN:
                 break
             else:
                 raise OSError(e, msg)
 
 
+def xseg_wait_signal_green(ctx, sd, timeout):
+    fd = get_signal_fd(sd)
+    select([fd], [], [], timeout/1000000.0)
+    clear_signal_fd(fd)
+
+
 def create_posixfd_dirs():
     path = "/dev/shm/posixfd"
     uid = getpwnam(config['USER']).pw_uid
@@ -137,7 +205,6 @@ def create_posixfd_dirs():
             raise Error("Cannot create directory %s" % path)
 
     os.chown(path, uid, gid)
-    st = os.stat(path)
     os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_ISGID)
 
 
@@ -251,6 +318,7 @@ class Peer(object):
             os.kill(pid, signal.SIGTERM)
 
     def __is_running(self, pid):
+        import psutil
         name = self.executable
         for p in psutil.process_iter():
             if p.name[0:len(name)] == name and pid == p.pid:
@@ -417,11 +485,13 @@ class Mapperd(Peer):
     def __init__(self, blockerm_port=None, blockerb_port=None, **kwargs):
         self.executable = MAPPER
         if blockerm_port is None:
-            raise Error("blockerm_port must be provied for %s" % role)
+            raise Error("blockerm_port must be provied for %s" %
+                        kwargs.get('role'))
         self.blockerm_port = blockerm_port
 
         if blockerb_port is None:
-            raise Error("blockerb_port must be provied for %s" % role)
+            raise Error("blockerb_port must be provied for %s" %
+                        kwargs.get('role'))
         self.blockerb_port = blockerb_port
         super(Mapperd, self).__init__(**kwargs)
 
@@ -442,11 +512,13 @@ class Vlmcd(Peer):
     def __init__(self, blocker_port=None, mapper_port=None, **kwargs):
         self.executable = VLMC
         if blocker_port is None:
-            raise Error("blocker_port must be provied for %s" % role)
+            raise Error("blocker_port must be provied for %s" %
+                        kwargs.get('role'))
         self.blocker_port = blocker_port
 
         if mapper_port is None:
-            raise Error("mapper_port must be provied for %s" % role)
+            raise Error("mapper_port must be provied for %s" %
+                        kwargs.get('role'))
         self.mapper_port = mapper_port
         super(Vlmcd, self).__init__(**kwargs)
 
@@ -536,6 +608,7 @@ class Poold(object):
             os.kill(pid, signal.SIGQUIT)
 
     def __is_running(self, pid):
+        import psutil
         name = self.executable
         for p in psutil.process_iter():
             if p.name[0:len(name)] == name and pid == p.pid:
@@ -611,7 +684,9 @@ config = {
     'SEGMENT_ALIGNMENT': 12,
     'VTOOL_START': 1003,
     'VTOOL_END': 1003,
+    'PORT_SELECTION': 'roundrobin',
     'UMASK': 0o007,
+    'CATALOG_PATH': '/var/lib/archipelago/catalog.db',
     # RESERVED 1023
 }
 
@@ -657,7 +732,6 @@ class Segment(object):
     spec = None
 
     def __init__(self, type, name, dynports, ports, size, align=12):
-        initialize_xseg()
         self.type = type
         self.name = name
         self.dynports = dynports
@@ -683,10 +757,11 @@ class Segment(object):
 
     def create(self):
         # FIXME blocking....
-        xconf = xseg_config()
+        initialize_xseg()
+        xconf = api.xseg_config()
         c_spec = create_string_buffer(self.spec)
-        xseg_parse_spec(c_spec, xconf)
-        r = xseg_create(xconf)
+        api.xseg_parse_spec(c_spec, xconf)
+        r = api.xseg_create(xconf)
         if r < 0:
             raise Error("Cannot create segment")
 
@@ -697,8 +772,8 @@ class Segment(object):
         except:
             return
         try:
-            xseg_leave(xseg)
-            xseg_destroy(xseg)
+            api.xseg_leave(xseg)
+            api.xseg_destroy(xseg)
         except Exception:
             raise Error("Cannot destroy segment")
 
@@ -711,16 +786,45 @@ class Segment(object):
                             % (config['SEGMENT_NAME'], os.strerror(e)))
             return ret
 
-        xconf = xseg_config()
+        initialize_xseg()
+        xconf = api.xseg_config()
         spec_buf = create_string_buffer(self.spec)
-        xseg_parse_spec(spec_buf, xconf)
-        xseg_join.errcheck = errcheck
-        ctx = xseg_join(xconf.type, xconf.name, "posixfd",
-                        cast(0, cb_null_ptrtype))
+        api.xseg_parse_spec(spec_buf, xconf)
+        api.xseg_join.errcheck = errcheck
+        ctx = api.xseg_join(xconf.type, xconf.name, "posixfd",
+                            cast(0, CFUNCTYPE(None, api.uint32_t)))
 
         return ctx
 
 
+class PeerDict(dict):
+    """Peers by role.
+
+    Peers are constructed on first access, from the constructor registered
+    for their role, so that a command only pays for the peers it uses.
+    """
+    def __init__(self):
+        super(PeerDict, self).__init__()
+        self.constructors = {}
+        self.lock = threading.Lock()
+
+    def register(self, role, constructor):
+        self.constructors[role] = constructor
+        self.pop(role, None)
+
+    def __missing__(self, role):
+        constructor = self.constructors[role]
+        with self.lock:
+            if not dict.__contains__(self, role):
+                self[role] = constructor()
+            return dict.__getitem__(self, role)
+
+    def __contains__(self, role):
+        return role in self.constructors
+
+peers = PeerDict()
+
+
 def check_conf():  # NOQA
     port_ranges = []
 
@@ -789,25 +893,34 @@ def check_conf():  # NOQA
             raise Error("No config found for %s" % role)
 
         if role_type == 'file_blocker':
-            peers[role] = Filed(role=role, spec=segment.get_spec(),
-                                prefix=ARCHIP_PREFIX, **role_config)
+            peer = partial(Filed, role=role, spec=segment.get_spec(),
+                           prefix=ARCHIP_PREFIX, **role_config)
         elif role_type == 'rados_blocker':
-            peers[role] = Radosd(role=role,
-                                 spec=segment.get_spec(), **role_config)
+            peer = partial(Radosd, role=role,
+                           spec=segment.get_spec(), **role_config)
         elif role_type == 'mapperd':
-            peers[role] = Mapperd(role=role, spec=segment.get_spec(),
-                                  **role_config)
+            peer = partial(Mapperd, role=role, spec=segment.get_spec(),
+                           **role_config)
         elif role_type == 'vlmcd':
-            peers[role] = Vlmcd(role=role, spec=segment.get_spec(),
-                                **role_config)
+            peer = partial(Vlmcd, role=role, spec=segment.get_spec(),
+                           **role_config)
         elif role_type == 'poold':
-            peers[role] = Poold(role=role, **role_config)
+            peer = partial(Poold, role=role, **role_config)
         else:
             raise Error("No valid peer type: %s" % role_type)
-        validatePortRange(peers[role].portno_start, peers[role].portno_end,
-                          xseg_ports)
+        # The peer itself is constructed when first used
+        peers.register(role, peer)
+        for option in ('portno_start', 'portno_end'):
+            if option not in role_config:
+                raise Error("%s must be provided for %s" % (option, role))
+        validatePortRange(role_config['portno_start'],
+                          role_config['portno_end'], xseg_ports)
 
     validatePortRange(config['VTOOL_START'], config['VTOOL_END'], xseg_ports)
+
+    if config['PORT_SELECTION'] not in port_selectors:
+        raise Error("Invalid port selection policy '%s'" %
+                    config['PORT_SELECTION'])
     return True
 
 
@@ -824,10 +937,101 @@ vtool_port = None
 def get_vtool_port():
     global vtool_port
     if vtool_port is None:
+        import random
         vtool_port = random.randint(config['VTOOL_START'], config['VTOOL_END'])
     return vtool_port
 
-acquired_locks = {}
+
+def get_port_queue_count(xseg_ctx, portno):
+    """Return the number of requests waiting on the request queue of a
+    port"""
+    port = api.xseg_get_port_nonstatic(xseg_ctx.ctx, portno)
+    if not port:
+        raise Error("Invalid port %d" % portno)
+    base = cast(xseg_ctx.ctx.contents.segment, c_void_p).value
+    queue = cast(base + port.contents.request_queue, POINTER(api.xq))
+    return api.xq_count(queue)
+
+
+class PortSelector(object):
+    """Select the port of a peer that a request is sent to, among the ports
+    of its range, in a round-robin fashion"""
+    def __init__(self, portno_start, portno_end):
+        self.portno_start = portno_start
+        self.portno_end = portno_end
+        self.nr_ports = portno_end - portno_start + 1
+        self.next = 0
+
+    def select(self, xseg_ctx=None, name=None):
+        portno = self.portno_start + self.next
+        self.next = (self.next + 1) % self.nr_ports
+        return portno
+
+
+class HashPortSelector(PortSelector):
+    """Select a port by hashing the name of the target volume, so that all
+    requests for a volume end up on the same queue"""
+    def select(self, xseg_ctx=None, name=None):
+        if name is None:
+            return super(HashPortSelector, self).select(xseg_ctx, name)
+        return self.portno_start + (crc32(name) & 0xffffffff) % self.nr_ports
+
+
+class LeastQueuedPortSelector(PortSelector):
+    """Select the port with the fewest requests waiting on its queue.
+
+    Falls back to round-robin selection, if the queues of the ports cannot
+    be inspected.
+    """
+    inspectable = True
+
+    def select(self, xseg_ctx=None, name=None):
+        if xseg_ctx is None or not self.inspectable:
+            return super(LeastQueuedPortSelector, self).select(xseg_ctx, name)
+        try:
+            counts = [(get_port_queue_count(xseg_ctx, portno), portno)
+                      for portno in xrange(self.portno_start,
+                                           self.portno_end + 1)]
+        except (NameError, AttributeError) as e:
+            # The bindings do not expose the ports and queues of the segment
+            self.inspectable = False
+            print >> sys.stderr, yellow("Cannot inspect the port queues (%s), "
+                                        "falling back to round-robin" % e)
+            return super(LeastQueuedPortSelector, self).select(xseg_ctx, name)
+        return min(counts)[1]
+
+
+port_selectors = {
+    'start': None,
+    'roundrobin': PortSelector,
+    'hash': HashPortSelector,
+    'leastqueued': LeastQueuedPortSelector,
+}
+
+
+def get_peer_port(role, xseg_ctx=None, name=None):
+    """Return the port of a peer to send a request for the given volume to,
+    according to the configured port selection policy"""
+    peer = peers[role]
+    selector = getattr(peer, 'port_selector', None)
+    if selector is None:
+        cls = port_selectors[config['PORT_SELECTION']]
+        if cls is None:
+            return peer.portno_start
+        selector = cls(peer.portno_start, peer.portno_end)
+        peer.port_selector = selector
+    return selector.select(xseg_ctx, name)
+
+# Lock files held by each thread, with their nesting depth
+lock_state = threading.local()
+
+
+def get_acquired_locks():
+    try:
+        return lock_state.acquired_locks
+    except AttributeError:
+        lock_state.acquired_locks = {}
+        return lock_state.acquired_locks
 
 
 def get_lock(lock_file, max_time=15):
@@ -869,6 +1073,7 @@ def exclusive(get_port=False):  # NOQA
                                          str(vtool_port))
             else:
                 lock_file = os.path.join(LOCK_PATH, VLMC_LOCK_FILE)
+            acquired_locks = get_acquired_locks()
             try:
                 depth = acquired_locks[lock_file]
                 if depth == 0:
@@ -964,6 +1169,7 @@ def loadrc(rc):
     except:
         raise Error("Cannot read config file")
 
+    import ConfigParser
     cfg = ConfigParser.ConfigParser()
     cfg.readfp(cfg_fd)
     config['SEGMENT_PORTS'] = cfg.getint('XSEG', 'SEGMENT_PORTS')
@@ -971,11 +1177,15 @@ def loadrc(rc):
     config['SEGMENT_SIZE'] = cfg.getint('XSEG', 'SEGMENT_SIZE')
     config['VTOOL_START'] = cfg.getint('XSEG', 'VTOOL_START')
     config['VTOOL_END'] = cfg.getint('XSEG', 'VTOOL_END')
+    if cfg.has_option('XSEG', 'PORT_SELECTION'):
+        config['PORT_SELECTION'] = cfg.get('XSEG', 'PORT_SELECTION')
     config['USER'] = cfg.get('ARCHIPELAGO', 'USER')
     config['GROUP'] = cfg.get('ARCHIPELAGO', 'GROUP')
     config['BLKTAP_ENABLED'] = cfg.getboolean('ARCHIPELAGO', 'BLKTAP_ENABLED')
     if cfg.has_option('ARCHIPELAGO', 'UMASK'):
         config['UMASK'] = int(cfg.get('ARCHIPELAGO', 'UMASK'), 0)
+    if cfg.has_option('ARCHIPELAGO', 'CATALOG_PATH'):
+        config['CATALOG_PATH'] = cfg.get('ARCHIPELAGO', 'CATALOG_PATH')
     roles = cfg.get('PEERS', 'ROLES')
     roles = str(roles)
     roles = roles.split(' ')
@@ -1043,11 +1253,12 @@ xseg_initialized = False
 def initialize_xseg():
     global xseg_initialized
     if not xseg_initialized:
-        xseg_initialize()
+        api.xseg_initialize()
         xseg_initialized = True
 
 
 def check_running(name, pid=None):
+    import psutil
     for p in psutil.process_iter():
         if p.name[0:len(name)] == name:
             if pid:
@@ -1073,38 +1284,158 @@ def check_pidfile(name):
     return pid
 
 
+class WaitPolicy(object):
+    """Wait for replies by sleeping on the signal of the port.
+
+    Statistics are kept on the number of sleeps, the time spent asleep and
+    the wake-up latency, that is the time from the end of a sleep until the
+    reply that ended it is received. Sleeps that time out, or that are not
+    followed by a reply, do not count towards the latency.
+    """
+    # Timeout of a single sleep, in microseconds
+    sleep_usecs = 10000000
+
+    def __init__(self):
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.spins = 0
+        self.spin_hits = 0
+        self.sleeps = 0
+        self.sleep_time = 0.0
+        self.wakeups = 0
+        self.wakeup_time = 0.0
+        self.max_wakeup_time = 0.0
+
+    def get_stats(self):
+        return {'spins': self.spins,
+                'spin_hits': self.spin_hits,
+                'sleeps': self.sleeps,
+                'avg_sleep_usecs': (self.sleep_time * 1000000 / self.sleeps
+                                    if self.sleeps else 0),
+                'wakeups': self.wakeups,
+                'avg_wakeup_usecs': (self.wakeup_time * 1000000 /
+                                     self.wakeups if self.wakeups else 0),
+                'max_wakeup_usecs': self.max_wakeup_time * 1000000}
+
+    def wait(self, xseg_ctx):
+        return self.sleep(xseg_ctx)
+
+    def sleep(self, xseg_ctx):
+        ctx = xseg_ctx.ctx
+        portno = xseg_ctx.portno
+        woken = None
+        api.xseg_prepare_wait(ctx, portno)
+        while True:
+            received = api.xseg_receive(ctx, portno, 0)
+            if received:
+                api.xseg_cancel_wait(ctx, portno)
+                if woken is not None:
+                    latency = time.time() - woken
+                    self.wakeups += 1
+                    self.wakeup_time += latency
+                    if latency > self.max_wakeup_time:
+                        self.max_wakeup_time = latency
+                return received
+            start = time.time()
+            xseg_wait_signal_green(ctx, xseg_ctx.signal_desc,
+                                   self.sleep_usecs)
+            woken = time.time()
+            self.sleeps += 1
+            self.sleep_time += woken - start
+
+
+class SpinWaitPolicy(WaitPolicy):
+    """Busy-poll the port for spin_usecs microseconds, before falling back to
+    sleeping on its signal.
+
+    Trades CPU time for lower latency, when replies are expected to arrive
+    faster than the cost of a wake-up.
+    """
+    def __init__(self, spin_usecs=50):
+        super(SpinWaitPolicy, self).__init__()
+        self.spin_usecs = spin_usecs
+
+    def wait(self, xseg_ctx):
+        ctx = xseg_ctx.ctx
+        portno = xseg_ctx.portno
+        deadline = time.time() + self.spin_usecs / 1000000.0
+        while True:
+            received = api.xseg_receive(ctx, portno, 0)
+            self.spins += 1
+            if received:
+                self.spin_hits += 1
+                return received
+            if time.time() >= deadline:
+                return self.sleep(xseg_ctx)
+
+
+def parse_wait_policy(spec):
+    """Return the wait policy described by spec: sleep, or spin[:usecs]"""
+    name, sep, arg = spec.partition(':')
+    if name == 'sleep' and not sep:
+        return WaitPolicy()
+    if name == 'spin':
+        if not sep:
+            return SpinWaitPolicy()
+        try:
+            spin_usecs = int(arg)
+        except ValueError:
+            spin_usecs = -1
+        if spin_usecs >= 0:
+            return SpinWaitPolicy(spin_usecs)
+    raise Error("Invalid wait policy: %s" % spec)
+
+
 class Xseg_ctx(object):
     ctx = None
     port = None
     portno = None
     signal_desc = None
     dynalloc = False
-
-    def __init__(self, segment, portno=None):
-        ctx = segment.join()
-        if not ctx:
-            raise Error("Cannot join segment")
+    shared_xseg = False
+    async_ctx = None
+    # Maximum number of prepared requests kept for reuse
+    max_free_reqs = 64
+
+    def __init__(self, segment, portno=None, xseg=None, wait_policy=None):
+        if xseg is None:
+            ctx = segment.join()
+            if not ctx:
+                raise Error("Cannot join segment")
+            self.shared_xseg = False
+        else:
+            ctx = xseg
+            self.shared_xseg = True
         if portno is None:
-            port = xseg_bind_dynport(ctx)
-            portno = xseg_portno_nonstatic(ctx, port)
+            port = api.xseg_bind_dynport(ctx)
+            portno = api.xseg_portno_nonstatic(ctx, port)
             dynalloc = True
         else:
-            port = xseg_bind_port(ctx, portno, c_void_p(0))
+            port = api.xseg_bind_port(ctx, portno, c_void_p(0))
             dynalloc = False
 
         if not port:
             raise Error("Cannot bind to port")
 
-        sd = xseg_get_signal_desc_nonstatic(ctx, port)
+        sd = api.xseg_get_signal_desc_nonstatic(ctx, port)
         if not sd:
             raise Error("Cannot get signal descriptor")
 
-        xseg_init_local_signal(ctx, portno)
+        api.xseg_init_local_signal(ctx, portno)
         self.ctx = ctx
         self.port = port
         self.portno = portno
         self.dynalloc = dynalloc
         self.signal_desc = sd
+        # Outstanding requests, indexed by the segment address of their
+        # xseg_request, and completed requests not yet claimed by a waiter.
+        self.pending = dict()
+        self.completed = set()
+        self.free_reqs = []
+        if wait_policy is None:
+            wait_policy = WaitPolicy()
+        self.wait_policy = wait_policy
 
     def __del__(self):
         return
@@ -1119,41 +1450,269 @@ class Xseg_ctx(object):
         return False
 
     def shutdown(self):
+        if self.ctx:
+            for req in self.free_reqs:
+                api.xseg_put_request(self.ctx, req, self.portno)
+        self.free_reqs = []
         if self.port is not None and self.dynalloc:
-                xseg_leave_dynport(self.ctx, self.port)
+                api.xseg_leave_dynport(self.ctx, self.port)
         if self.ctx:
-            xseg_quit_local_signal(self.ctx, self.portno)
-            xseg_leave(self.ctx)
+            api.xseg_quit_local_signal(self.ctx, self.portno)
+            if not self.shared_xseg:
+                api.xseg_leave(self.ctx)
         self.ctx = None
 
+    def fileno(self):
+        """Return the file descriptor the port of the context is signaled on,
+        so that it can be watched by an event loop"""
+        return get_signal_fd(self.signal_desc)
+
+    def arm(self):
+        """Ask to be signaled on the context's file descriptor, when a reply
+        arrives"""
+        api.xseg_prepare_wait(self.ctx, self.portno)
+
+    def disarm(self):
+        api.xseg_cancel_wait(self.ctx, self.portno)
+
+    def handle_signal(self):
+        """Clear the signal and dispatch any received replies, without
+        blocking. Meant to be called when the file descriptor of an armed
+        context becomes readable."""
+        clear_signal_fd(self.fileno())
+        return self.poll()
+
     def wait_request(self):
-        xseg_prepare_wait(self.ctx, self.portno)
-        while True:
-            received = xseg_receive(self.ctx, self.portno, 0)
-            if received:
-                xseg_cancel_wait(self.ctx, self.portno)
-                return received
+        return self.wait_policy.wait(self)
+
+    def get_request(self, dst_portno, targetlen, datalen):
+        """Return a prepared xseg request for the given target and data
+        lengths.
+
+        A previously put request with enough buffer space is reused if
+        possible, instead of allocating and preparing a new one.
+        """
+        buflen = targetlen + datalen
+        free_reqs = self.free_reqs
+        for i in xrange(len(free_reqs) - 1, -1, -1):
+            req = free_reqs[i]
+            r = req.contents
+            if r.bufferlen < buflen:
+                continue
+            del free_reqs[i]
+            if api.xseg_resize_request(self.ctx, req, targetlen,
+                                       datalen) < 0:
+                api.xseg_put_request(self.ctx, req, self.portno)
+                break
+            r.state = 0
+            r.serviced = 0
+            r.transit_portno = self.portno
+            r.dst_portno = dst_portno
+            r.effective_dst_portno = dst_portno
+            return req
+
+        req = api.xseg_get_request(self.ctx, self.portno, dst_portno,
+                                   api.X_ALLOC)
+        if not req:
+            raise Error("Cannot get request")
+        r = api.xseg_prep_request(self.ctx, req, targetlen, datalen)
+        if r < 0:
+            api.xseg_put_request(self.ctx, req, self.portno)
+            raise Error("Cannot prepare request")
+        return req
+
+    def put_request(self, req, reuse=True):
+        """Return an xseg request, keeping it for reuse if possible"""
+        if reuse and len(self.free_reqs) < self.max_free_reqs:
+            self.free_reqs.append(req)
+        else:
+            api.xseg_put_request(self.ctx, req, self.portno)
+
+    def track(self, req, callback=None):
+        """Track a request until its reply is dispatched.
+
+        If a callback is given, it is called with the request upon
+        completion. Otherwise the request is kept as completed, until it is
+        claimed by wait_requests.
+        """
+        req.callback = callback
+        req.completed = False
+        self.pending[addressof(req.req.contents)] = req
+
+    def untrack(self, req):
+        self.pending.pop(addressof(req.req.contents), None)
+        self.completed.discard(req)
+
+    def claim(self, req):
+        """Remove a completed request from those kept for waiters"""
+        self.completed.discard(req)
+
+    def dispatch(self, received):
+        """Deliver a received xseg request to its owner.
+
+        Returns the completed Request object, or None if the received request
+        was not submitted through this context, in which case it is bounced
+        back.
+        """
+        req = self.pending.pop(addressof(received.contents), None)
+        if req is None:
+            p = api.xseg_respond(self.ctx, received, self.portno, api.X_ALLOC)
+            if p == api.NoPort:
+                api.xseg_put_request(self.ctx, received, self.portno)
             else:
-                xseg_wait_signal_green(self.ctx, self.signal_desc, 10000000)
+                api.xseg_signal(self.ctx, p)
+            return None
+
+        req.completed = True
+        if req.callback is not None:
+            req.callback(req)
+        else:
+            self.completed.add(req)
+        return req
+
+    def poll(self):
+        """Dispatch all replies currently available without blocking.
+
+        Returns the number of dispatched requests.
+        """
+        nr = 0
+        while True:
+            received = api.xseg_receive(self.ctx, self.portno, 0)
+            if not received:
+                return nr
+            if self.dispatch(received) is not None:
+                nr += 1
 
     def wait_requests(self, requests):
+        """Wait until one of the given requests is completed and return it"""
         while True:
-            received = self.wait_request()
-            for req in requests:
-                xseg_req = req.req
-                if addressof(received.contents) == \
-                        addressof(xseg_req.contents):
+            for req in self.completed:
+                if req in requests:
+                    self.completed.remove(req)
                     return req
-            p = xseg_respond(self.ctx, received, self.portno, X_ALLOC)
-            if p == NoPort:
-                xseg_put_request(self.ctx, received, self.portno)
+            req = self.dispatch(self.wait_request())
+            if req is not None and req in requests:
+                self.completed.discard(req)
+                return req
+
+    def wait_all(self):
+        """Wait until every outstanding request is completed"""
+        while self.pending:
+            self.dispatch(self.wait_request())
+
+
+class ThreadedXseg_ctx(Xseg_ctx):
+    """A context that can be shared between threads.
+
+    A receiver thread waits for replies on the port of the context and routes
+    each one to its owner, waking up the threads waiting on it.
+    """
+    def __init__(self, segment, portno=None, xseg=None, wait_policy=None):
+        super(ThreadedXseg_ctx, self).__init__(segment, portno=portno,
+                                               xseg=xseg,
+                                               wait_policy=wait_policy)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.running = True
+        self.receiver = threading.Thread(target=self.__receive_loop,
+                                         name="xseg-receiver-%d" % self.portno)
+        self.receiver.daemon = True
+        self.receiver.start()
+
+    def shutdown(self):
+        if self.running:
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+            api.xseg_signal(self.ctx, self.portno)
+            if self.receiver is not threading.current_thread():
+                self.receiver.join()
+        super(ThreadedXseg_ctx, self).shutdown()
+
+    def __receive_loop(self):
+        ctx = self.ctx
+        portno = self.portno
+        while self.running:
+            api.xseg_prepare_wait(ctx, portno)
+            received = api.xseg_receive(ctx, portno, 0)
+            if received:
+                api.xseg_cancel_wait(ctx, portno)
+                self.dispatch(received)
             else:
-                xseg_signal(self.ctx, p)
+                # Wake up periodically to check for shutdown
+                xseg_wait_signal_green(ctx, self.signal_desc, 1000000)
+        api.xseg_cancel_wait(ctx, portno)
+
+    def get_request(self, dst_portno, targetlen, datalen):
+        with self.lock:
+            return super(ThreadedXseg_ctx, self).get_request(dst_portno,
+                                                             targetlen,
+                                                             datalen)
+
+    def put_request(self, req, reuse=True):
+        with self.lock:
+            super(ThreadedXseg_ctx, self).put_request(req, reuse=reuse)
+
+    def track(self, req, callback=None):
+        with self.lock:
+            super(ThreadedXseg_ctx, self).track(req, callback=callback)
+
+    def untrack(self, req):
+        with self.lock:
+            super(ThreadedXseg_ctx, self).untrack(req)
+
+    def claim(self, req):
+        with self.lock:
+            super(ThreadedXseg_ctx, self).claim(req)
+
+    def dispatch(self, received):
+        with self.lock:
+            req = self.pending.pop(addressof(received.contents), None)
+            if req is not None:
+                req.completed = True
+                if req.callback is None:
+                    self.completed.add(req)
+                self.cond.notify_all()
+        if req is None:
+            p = api.xseg_respond(self.ctx, received, self.portno, api.X_ALLOC)
+            if p == api.NoPort:
+                api.xseg_put_request(self.ctx, received, self.portno)
+            else:
+                api.xseg_signal(self.ctx, p)
+        elif req.callback is not None:
+            req.callback(req)
+        return req
+
+    def poll(self):
+        raise Error("Replies are received by the receiver thread")
+
+    def handle_signal(self):
+        raise Error("Replies are received by the receiver thread")
+
+    def wait_requests(self, requests):
+        with self.cond:
+            while True:
+                for req in self.completed:
+                    if req in requests:
+                        self.completed.remove(req)
+                        return req
+                if not self.running:
+                    raise Error("Context shut down")
+                self.cond.wait()
+
+    def wait_all(self):
+        with self.cond:
+            while self.pending:
+                if not self.running:
+                    raise Error("Context shut down")
+                self.cond.wait()
 
 
 class Request(object):
     xseg_ctx = None
     req = None
+    callback = None
+    completed = False
 
     def __init__(self, xseg_ctx, dst_portno, target, datalen=0,  # NOQA
                  size=0, op=None, data=None, flags=0, offset=0, v0_size=-1):
@@ -1161,21 +1720,14 @@ class Request(object):
             raise Error("No target")
         targetlen = len(target)
         if not datalen and data:
-            if isinstance(data, basestring):
-                datalen = len(data)
-            else:
+            if isinstance(data, Structure):
                 datalen = sizeof(data)
+            else:
+                datalen = buffer_size(data)
 
-        ctx = xseg_ctx.ctx
-        if not ctx:
+        if not xseg_ctx.ctx:
             raise Error("No context")
-        req = xseg_get_request(ctx, xseg_ctx.portno, dst_portno, X_ALLOC)
-        if not req:
-            raise Error("Cannot get request")
-        r = xseg_prep_request(ctx, req, targetlen, datalen)
-        if r < 0:
-            xseg_put_request(ctx, req, xseg_ctx.portno)
-            raise Error("Cannot prepare request")
+        req = xseg_ctx.get_request(dst_portno, targetlen, datalen)
         self.req = req
         self.xseg_ctx = xseg_ctx
 
@@ -1188,11 +1740,14 @@ class Request(object):
                 self.put()
                 raise Error("Cannot set data")
 
-        self.set_size(size)
-        self.set_op(op)
-        self.set_flags(flags)
-        self.set_offset(offset)
-        self.set_v0_size(v0_size)
+        # Dereference the request only once, since every access to
+        # req.contents creates a new ctypes object.
+        r = req.contents
+        r.size = size
+        r.op = op
+        r.flags = flags
+        r.offset = offset
+        r.v0_size = v0_size
 
         return
 
@@ -1209,10 +1764,11 @@ class Request(object):
     def put(self, force=False):
         if not self.req:
             return False
-        if not force:
-            if xq_count(byref(self.req.contents.path)) > 0:
-                return False
-        xseg_put_request(self.xseg_ctx.ctx, self.req, self.xseg_ctx.portno)
+        in_transit = api.xq_count(byref(self.req.contents.path)) > 0
+        if in_transit and not force:
+            return False
+        self.xseg_ctx.untrack(self)
+        self.xseg_ctx.put_request(self.req, reuse=not in_transit)
         self.req = None
         return True
 
@@ -1259,53 +1815,71 @@ class Request(object):
         """Sets the target of the request, respecting request's targetlen"""
         if len(target) != self.req.contents.targetlen:
             return False
-        c_target = xseg_get_target_nonstatic(self.xseg_ctx.ctx, self.req)
-        p_target = create_string_buffer(target)
-#        print hex(addressof(c_target.contents))
-        memmove(c_target, p_target, len(target))
+        c_target = api.xseg_get_target_nonstatic(self.xseg_ctx.ctx, self.req)
+        memmove(c_target, target, len(target))
         return True
 
     def get_target(self):
         """Return a string to the target of the request"""
-        c_target = xseg_get_target_nonstatic(self.xseg_ctx.ctx, self.req)
+        c_target = api.xseg_get_target_nonstatic(self.xseg_ctx.ctx, self.req)
 #        print "target_addr " + str(addressof(c_target.contents))
         return string_at(c_target, self.req.contents.targetlen)
 
+    def target_view(self):
+        """Return a memoryview over the target of the request, in the
+        segment. The view is only valid until the request is put."""
+        c_target = api.xseg_get_target_nonstatic(self.xseg_ctx.ctx, self.req)
+        TargetArray = c_ubyte * self.req.contents.targetlen
+        return memoryview(TargetArray.from_address(addressof(
+            c_target.contents)))
+
+    def data_view(self):
+        """Return a writable memoryview over the data buffer of the request,
+        in the segment. The view is only valid until the request is put."""
+        c_data = api.xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
+        DataArray = c_ubyte * self.req.contents.datalen
+        return memoryview(DataArray.from_address(addressof(c_data.contents)))
+
     def set_data(self, data):
-        """Sets requests data. Data should be a xseg protocol structure"""
-        if isinstance(data, basestring):
-            if len(data) != self.req.contents.datalen:
-                return False
-            p_data = create_string_buffer(data)
-            c_data = xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
-            memmove(c_data, p_data, self.req.contents.datalen)
-        elif isinstance(data, xseg_request_create):
-            size = sizeof(uint32_t) * 3 + \
-                data.cnt * sizeof(xseg_create_map_scatterlist)
+        """Sets requests data. Data should be a xseg protocol structure, or
+        any object supporting the buffer protocol, which is copied once to
+        the segment"""
+        if isinstance(data, api.xseg_request_create):
+            size = sizeof(api.uint32_t) * 3 + \
+                data.cnt * sizeof(api.xseg_create_map_scatterlist)
             if size != self.req.contents.datalen:
                 return False
-            p = struct.pack("=LLL", data.cnt, data.blocksize,
-                            data.create_flags)
-            p_data = create_string_buffer(p)
-            c_data = xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
-            memmove(c_data, p_data, sizeof(uint32_t)*3)
-            c_data = addressof(c_data.contents)
-            c_data += sizeof(uint32_t) * 3
-            c_data = cast(c_data, POINTER(c_char))
-            for i in range(0, data.cnt):
-                p = struct.pack("=256sLL", data.segs[i].target,
-                                data.segs[i].targetlen, data.segs[i].flags)
-                p_data = create_string_buffer(p)
-                memmove(c_data, p_data, sizeof(xseg_create_map_scatterlist))
-                c_data = addressof(c_data.contents)
-                c_data += sizeof(xseg_create_map_scatterlist)
-                c_data = cast(c_data, POINTER(c_char))
-        else:
+            segs = data.segs
+            p_data = pack_create_request(
+                data.blocksize, data.create_flags,
+                [(segs[i].target, segs[i].flags) for i in xrange(data.cnt)])
+            c_data = api.xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
+            memmove(c_data, (c_char * size).from_buffer(p_data), size)
+        elif isinstance(data, Structure):
             if sizeof(data) != self.req.contents.datalen:
                 return False
             p_data = pointer(data)
-            c_data = xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
+            c_data = api.xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
             memmove(c_data, p_data, self.req.contents.datalen)
+        else:
+            datalen = buffer_size(data)
+            if datalen != self.req.contents.datalen:
+                return False
+            if not datalen:
+                return True
+            c_data = api.xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req)
+            if isinstance(data, str):
+                memmove(c_data, data, datalen)
+                return True
+            try:
+                p_data = (c_char * datalen).from_buffer(data)
+            except TypeError:
+                # Read-only buffers cannot be shared with ctypes
+                try:
+                    p_data = memoryview(data).tobytes()
+                except TypeError:
+                    p_data = str(buffer(data))
+            memmove(c_data, p_data, datalen)
 
         return True
 
@@ -1319,128 +1893,150 @@ class Request(object):
 #        print addressof(ret.contents)
 #        return ret
         if _type:
-            return cast(xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req),
+            return cast(api.xseg_get_data_nonstatic(self.xseg_ctx.ctx,
+                                                    self.req),
                         POINTER(_type))
         else:
-            return cast(xseg_get_data_nonstatic(self.xseg_ctx.ctx, self.req),
+            return cast(api.xseg_get_data_nonstatic(self.xseg_ctx.ctx,
+                                                    self.req),
                         c_void_p)
 
-    def submit(self):
-        """Submit the associated xseg_request"""
-        p = xseg_submit(self.xseg_ctx.ctx, self.req, self.xseg_ctx.portno,
-                        X_ALLOC)
-        if p == NoPort:
-            raise Exception
-        xseg_signal(self.xseg_ctx.ctx, p)
+    def submit_async(self):
+        """Submit the associated xseg_request and return a future for it. The
+        context must be attached to an event loop, see archipelago.aio"""
+        if self.xseg_ctx.async_ctx is None:
+            raise Error("Context not attached to an event loop")
+        return self.xseg_ctx.async_ctx.submit(self)
+
+    def submit(self, callback=None):
+        """Submit the associated xseg_request.
+
+        If a callback is given, it will be called with this request, once its
+        reply is dispatched by the context.
+        """
+        self.xseg_ctx.track(self, callback=callback)
+        p = api.xseg_submit(self.xseg_ctx.ctx, self.req,
+                            self.xseg_ctx.portno, api.X_ALLOC)
+        if p == api.NoPort:
+            self.xseg_ctx.untrack(self)
+            raise Error("Cannot submit request")
+        api.xseg_signal(self.xseg_ctx.ctx, p)
 
     def wait(self):
-        """Wait until the associated xseg_request is responded, discarding any
+        """Wait until the associated xseg_request is responded, dispatching any
         other requests that may be received in the meantime"""
-        self.xseg_ctx.wait_requests([self])
+        if self.completed:
+            self.xseg_ctx.claim(self)
+            return
+        self.xseg_ctx.wait_requests((self,))
+
+    def done(self):
+        return self.completed
 
     def success(self):
-        if not bool(self.req.contents.state & XS_SERVED) and not \
-                bool(self.req.contents.state & XS_FAILED):
+        if not bool(self.req.contents.state & api.XS_SERVED) and not \
+                bool(self.req.contents.state & api.XS_FAILED):
             raise Error("Request not completed, nor Failed")
-        return bool((self.req.contents.state & XS_SERVED) and not
-                    (self.req.contents.state & XS_FAILED))
+        return bool((self.req.contents.state & api.XS_SERVED) and not
+                    (self.req.contents.state & api.XS_FAILED))
 
     @classmethod
     def get_write_request(cls, xseg, dst, target, data=None, offset=0,
                           datalen=0, flags=0):
         if data is None:
             data = ""
-        size = len(data)
+        size = buffer_size(data)
         if not datalen:
             datalen = size
 
-        return cls(xseg, dst, target, op=X_WRITE, data=data, offset=offset,
+        return cls(xseg, dst, target, op=api.X_WRITE, data=data, offset=offset,
                    size=size, datalen=datalen, flags=flags)
 
     @classmethod
     def get_read_request(cls, xseg, dst, target, size=0, offset=0, datalen=0):
         if not datalen:
             datalen = size
-        return cls(xseg, dst, target, op=X_READ, offset=offset, size=size,
+        return cls(xseg, dst, target, op=api.X_READ, offset=offset, size=size,
                    datalen=datalen)
 
     @classmethod
     def get_info_request(cls, xseg, dst, target):
-        return cls(xseg, dst, target, op=X_INFO)
+        return cls(xseg, dst, target, op=api.X_INFO)
 
     @classmethod
     def get_copy_request(cls, xseg, dst, target, copy_target=None, size=0,
                          offset=0):
-        datalen = sizeof(xseg_request_copy)
-        xcopy = xseg_request_copy()
+        datalen = sizeof(api.xseg_request_copy)
+        xcopy = api.xseg_request_copy()
         xcopy.target = target
         xcopy.targetlen = len(target)
-        return cls(xseg, dst, copy_target, op=X_COPY, data=xcopy,
+        return cls(xseg, dst, copy_target, op=api.X_COPY, data=xcopy,
                    datalen=datalen, size=size, offset=offset)
 
     @classmethod
     def get_acquire_request(cls, xseg, dst, target, wait=False):
         flags = 0
         if not wait:
-            flags = XF_NOSYNC
-        return cls(xseg, dst, target, op=X_ACQUIRE, flags=flags)
+            flags = api.XF_NOSYNC
+        return cls(xseg, dst, target, op=api.X_ACQUIRE, flags=flags)
 
     @classmethod
     def get_release_request(cls, xseg, dst, target, force=False):
         flags = 0
         if force:
-            flags = XF_FORCE
-        return cls(xseg, dst, target, op=X_RELEASE, flags=flags)
+            flags = api.XF_FORCE
+        return cls(xseg, dst, target, op=api.X_RELEASE, flags=flags)
 
     @classmethod
     def get_delete_request(cls, xseg, dst, target):
-        return cls(xseg, dst, target, op=X_DELETE)
+        return cls(xseg, dst, target, op=api.X_DELETE)
 
     @classmethod
     def get_update_request(cls, xseg, dst, target):
-        return cls(xseg, dst, target, op=X_UPDATE)
+        return cls(xseg, dst, target, op=api.X_UPDATE)
 
     @classmethod
     def get_clone_request(cls, xseg, dst, target, clone=None, clone_size=0):
-        datalen = sizeof(xseg_request_clone)
-        xclone = xseg_request_clone()
+        datalen = sizeof(api.xseg_request_clone)
+        xclone = api.xseg_request_clone()
         xclone.target = target
         xclone.targetlen = len(target)
         xclone.size = clone_size
 
-        return cls(xseg, dst, clone, op=X_CLONE, data=xclone, datalen=datalen)
+        return cls(xseg, dst, clone, op=api.X_CLONE, data=xclone,
+                   datalen=datalen)
 
     @classmethod
     def get_open_request(cls, xseg, dst, target):
-        return cls(xseg, dst, target, op=X_OPEN)
+        return cls(xseg, dst, target, op=api.X_OPEN)
 
     @classmethod
     def get_close_request(cls, xseg, dst, target):
-        return cls(xseg, dst, target, op=X_CLOSE)
+        return cls(xseg, dst, target, op=api.X_CLOSE)
 
     @classmethod
     def get_snapshot_request(cls, xseg, dst, target, snap=None):
-        datalen = sizeof(xseg_request_snapshot)
-        xsnapshot = xseg_request_snapshot()
+        datalen = sizeof(api.xseg_request_snapshot)
+        xsnapshot = api.xseg_request_snapshot()
         xsnapshot.target = snap
         xsnapshot.targetlen = len(snap)
 
-        return cls(xseg, dst, target, op=X_SNAPSHOT, data=xsnapshot,
+        return cls(xseg, dst, target, op=api.X_SNAPSHOT, data=xsnapshot,
                    datalen=datalen)
 
     @classmethod
     def get_mapr_request(cls, xseg, dst, target, offset=0, size=0):
-        return cls(xseg, dst, target, op=X_MAPR, offset=offset, size=size,
+        return cls(xseg, dst, target, op=api.X_MAPR, offset=offset, size=size,
                    datalen=0)
 
     @classmethod
     def get_mapw_request(cls, xseg, dst, target, offset=0, size=0):
-        return cls(xseg, dst, target, op=X_MAPW, offset=offset, size=size,
+        return cls(xseg, dst, target, op=api.X_MAPW, offset=offset, size=size,
                    datalen=0)
 
     @classmethod
     def get_hash_request(cls, xseg, dst, target, size=0, offset=0):
-        return cls(xseg, dst, target, op=X_HASH, size=size, offset=offset)
+        return cls(xseg, dst, target, op=api.X_HASH, size=size, offset=offset)
 
     @classmethod
     def get_rename_request(cls, xseg, dst, target, newname=None):
@@ -1448,12 +2044,12 @@ class Request(object):
         Return a new request, formatted as a rename request with the given
         arguments
         """
-        datalen = sizeof(xseg_request_rename)
-        xrename = xseg_request_rename()
+        datalen = sizeof(api.xseg_request_rename)
+        xrename = api.xseg_request_rename()
         xrename.target = newname
         xrename.targetlen = len(newname)
 
-        return cls(xseg, dst, target, op=X_RENAME, data=xrename,
+        return cls(xseg, dst, target, op=api.X_RENAME, data=xrename,
                    datalen=datalen)
 
     @classmethod
@@ -1470,21 +2066,287 @@ class Request(object):
         if mapflags is None:
             mapflags = 0
 
-        xcreate = xseg_request_create()
-        xcreate.blocksize = blocksize
-        xcreate.create_flags = mapflags
-        xcreate.cnt = len(objects)
-        SegsArray = xseg_create_map_scatterlist * xcreate.cnt
-        xcreate.segs = SegsArray()
-        for i in range(0, xcreate.cnt):
-            xcreate.segs[i].target = objects[i]['name']
-            xcreate.segs[i].targetlen = len(xcreate.segs[i].target)
-            xcreate.segs[i].flags = objects[i]['flags']
+        data = pack_create_request(blocksize, mapflags,
+                                   [(o['name'], o['flags']) for o in objects])
 
-        datalen = sizeof(uint32_t) * 3 + sizeof(SegsArray)
+        return cls(xseg, dst, target, op=api.X_CREATE, size=size, data=data,
+                   datalen=len(data))
 
-        return cls(xseg, dst, target, op=X_CREATE, size=size, data=xcreate,
-                   datalen=datalen)
+
+class XsegCtxCache(object):
+    """Cache of contexts bound to dynamic ports.
+
+    All contexts share a single join of the segment. Contexts returned to the
+    cache are kept bound, up to max_ctxs, and are handed out again, so that
+    an operation does not have to join the segment and bind a port.
+
+    A thread-safe context may be set as shared, in which case it is handed
+    out to every caller instead.
+
+    Contexts wait for replies with the wait policy given to get(), or else
+    with wait_policy if set, or else with a policy of their own.
+    """
+    def __init__(self, segment, max_ctxs=4, wait_policy=None):
+        self.segment = segment
+        self.max_ctxs = max_ctxs
+        self.wait_policy = wait_policy
+        self.xseg = None
+        self.free_ctxs = []
+        self.shared_ctx = None
+        self.lock = threading.Lock()
+
+    def __join(self):
+        if self.xseg is None:
+            xseg = self.segment.join()
+            if not xseg:
+                raise Error("Cannot join segment")
+            self.xseg = xseg
+        return self.xseg
+
+    def get(self, wait_policy=None):
+        if wait_policy is None:
+            wait_policy = self.wait_policy
+        with self.lock:
+            if self.shared_ctx is not None:
+                return self.shared_ctx
+            if self.free_ctxs:
+                xseg_ctx = self.free_ctxs.pop()
+                if wait_policy is None:
+                    wait_policy = WaitPolicy()
+                xseg_ctx.wait_policy = wait_policy
+                return xseg_ctx
+            return Xseg_ctx(self.segment, xseg=self.__join(),
+                            wait_policy=wait_policy)
+
+    def put(self, xseg_ctx):
+        with self.lock:
+            if xseg_ctx is self.shared_ctx:
+                return
+            if xseg_ctx.ctx and not xseg_ctx.pending and \
+                    xseg_ctx.async_ctx is None and \
+                    len(self.free_ctxs) < self.max_ctxs:
+                xseg_ctx.completed.clear()
+                self.free_ctxs.append(xseg_ctx)
+                return
+        xseg_ctx.shutdown()
+
+    def get_shared(self):
+        """Return a thread-safe context, bound on the cached segment join"""
+        with self.lock:
+            return ThreadedXseg_ctx(self.segment, xseg=self.__join())
+
+    def share(self, xseg_ctx):
+        """Hand out the given thread-safe context to every caller, or stop
+        doing so if None"""
+        with self.lock:
+            self.shared_ctx = xseg_ctx
+
+    def shutdown(self):
+        with self.lock:
+            for xseg_ctx in self.free_ctxs:
+                xseg_ctx.shutdown()
+            self.free_ctxs = []
+            if self.shared_ctx is not None:
+                self.shared_ctx.shutdown()
+                self.shared_ctx = None
+            if self.xseg is not None:
+                api.xseg_leave(self.xseg)
+                self.xseg = None
+
+
+xseg_ctx_cache = None
+default_wait_policy = None
+
+
+def get_xseg_ctx_cache():
+    global xseg_ctx_cache
+    if xseg_ctx_cache is None or xseg_ctx_cache.segment is not segment:
+        if xseg_ctx_cache is not None:
+            xseg_ctx_cache.shutdown()
+        xseg_ctx_cache = XsegCtxCache(get_segment(),
+                                      wait_policy=default_wait_policy)
+    return xseg_ctx_cache
+
+
+def set_wait_policy(policy):
+    """Set the wait policy of the contexts handed out by get_xseg_ctx, or
+    restore the default if None"""
+    global default_wait_policy
+    default_wait_policy = policy
+    if xseg_ctx_cache is not None:
+        xseg_ctx_cache.wait_policy = policy
+
+
+def get_xseg_ctx(wait_policy=None):
+    """Return a context bound to a dynamic port, from the process-wide cache.
+    The context waits with the given wait policy, or the one set by
+    set_wait_policy. The context must be returned with put_xseg_ctx."""
+    return get_xseg_ctx_cache().get(wait_policy=wait_policy)
+
+
+def put_xseg_ctx(xseg_ctx):
+    if xseg_ctx_cache is None or xseg_ctx.ctx is not xseg_ctx_cache.xseg:
+        xseg_ctx.shutdown()
+    else:
+        xseg_ctx_cache.put(xseg_ctx)
+
+
+def shutdown_xseg_ctxs():
+    global xseg_ctx_cache
+    if xseg_ctx_cache is not None:
+        xseg_ctx_cache.shutdown()
+        xseg_ctx_cache = None
+
+atexit.register(shutdown_xseg_ctxs)
+
+
+class XsegFuture(object):
+    """The result of an operation run by an XsegExecutor"""
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+
+    def done(self):
+        return self.__done
+
+    def __complete(self, result, exception):
+        with self.__cond:
+            self.__result = result
+            self.__exception = exception
+            self.__done = True
+            self.__cond.notify_all()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self.__complete(result, None)
+
+    def set_exception(self, exception):
+        self.__complete(None, exception)
+
+    def add_done_callback(self, fn):
+        with self.__cond:
+            if not self.__done:
+                self.__callbacks.append(fn)
+                return
+        fn(self)
+
+    def __wait(self, timeout):
+        with self.__cond:
+            if not self.__done:
+                self.__cond.wait(timeout)
+            if not self.__done:
+                raise Error("Operation timed out")
+
+    def exception(self, timeout=None):
+        self.__wait(timeout)
+        return self.__exception
+
+    def result(self, timeout=None):
+        self.__wait(timeout)
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+
+class XsegExecutor(object):
+    """Run requests and volume operations concurrently over a single port.
+
+    The executor binds a thread-safe context, shared by all of its worker
+    threads, and returns futures in the style of concurrent.futures:
+
+        with XsegExecutor(max_workers=16) as executor:
+            futures = [executor.submit(vlmc.info, name) for name in names]
+            sizes = [f.result() for f in futures]
+
+    While the executor is running, its context is also handed out by
+    get_xseg_ctx(), so that the vlmc operations run by the workers share it.
+    Raw requests may be submitted with submit_request(), without occupying a
+    worker thread.
+    """
+    def __init__(self, max_workers=8, cache=None):
+        if max_workers <= 0:
+            raise Error("Invalid number of workers")
+        if cache is None:
+            cache = get_xseg_ctx_cache()
+        self.cache = cache
+        self.xseg_ctx = self.cache.get_shared()
+        self.cache.share(self.xseg_ctx)
+        self.work = Queue.Queue()
+        self.running = True
+        self.workers = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self.__work_loop,
+                                 name="xseg-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.shutdown()
+        return False
+
+    def __work_loop(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) on a worker thread"""
+        if not self.running:
+            raise Error("Executor is shut down")
+        future = XsegFuture()
+        self.work.put((future, fn, args, kwargs))
+        return future
+
+    def submit_request(self, req):
+        """Submit a request created on the executor's context. The future is
+        resolved with the request, once it is completed."""
+        if req.xseg_ctx is not self.xseg_ctx:
+            raise Error("Request not created on the executor's context")
+        future = XsegFuture()
+        req.submit(callback=future.set_result)
+        return future
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        for future in futures:
+            yield future.result()
+
+    def shutdown(self, wait=True):
+        if not self.running:
+            return
+        self.running = False
+        for t in self.workers:
+            self.work.put(None)
+        if wait:
+            self.__join()
+        else:
+            t = threading.Thread(target=self.__join)
+            t.daemon = True
+            t.start()
+
+    def __join(self):
+        for t in self.workers:
+            t.join()
+        self.cache.share(None)
+        self.xseg_ctx.shutdown()
 
 
 class PoolClient(object):
@@ -1656,6 +2518,7 @@ class ArchipelagoPoolClient(PoolClient):
             super(ArchipelagoPoolClient, self).__init__()
 
     def __parse_conffile(self):
+        import ConfigParser
         cfg = ConfigParser.ConfigParser()
         cfg.readfp(open(self.conffile))
         try:
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Archipelago actions of the ganeti extstorage provider.
+
+The actions are run by the vlmc_wrapper.py script, either in-process or, when
+available, by the vlmc command server. They take the environment of the
+extstorage interface, as read by the wrapper.
+"""
+
+import os
+import sys
+
+from common import *
+import vlmc
+
+
+def create(env):
+    """Create a new vlmc Image"""
+    name = env.get("name")
+    size = env.get("size")
+    origin = env.get("origin")
+    origin_size = env.get("origin_size")
+    sys.stderr.write("Creating volume '%s' of size '%s' from '%s'\n"
+                     % (name, size, origin))
+    vlmc.create(name=name, size=int(size), snap=origin, assume_v0=True,
+                v0_size=int(origin_size))
+    return 0
+
+
+def snapshot(env):
+    """Create a snapshot of an existing vlmc Image."""
+    name = env.get("name")
+    snapshot_name = env.get("snapshot_name")
+    sys.stderr.write("Creating snapshot '%s' from '%s'\n" %
+                     (snapshot_name, name))
+    vlmc.snapshot(name=name, snap_name=snapshot_name)
+    return 0
+
+
+def attach(env):
+    """Map an existing vlmc Image to a block device
+
+    This function maps an existing vlmc Image to a block device
+    e.g. /dev/xsegbd{X} and returns the device path. If the mapping
+    already exists, it returns the corresponding device path.
+
+    """
+
+    name = env.get("name")
+
+    # Check if the mapping already exists
+    d_id = vlmc.is_mapped(name)
+    if d_id is not None:
+        # The mapping exists. Return it.
+        sys.stdout.write("%s" % str(DEVICE_PREFIX + str(d_id)))
+        return 0
+    # The mapping doesn't exist. Create it.
+    d_id = vlmc.map_volume(name=name)
+    # The device was successfully mapped. Return it.
+    # maybe assert (d_id == vlmc.is_mapped(name)
+    sys.stdout.write("%s" % str(DEVICE_PREFIX + str(d_id)))
+    return 0
+
+
+def detach(env):
+    """Unmap a vlmc device from the Image it is mapped to
+
+    This function unmaps an vlmc device from the Image it is mapped to.
+    It is idempotent if the mapping doesn't exist at all.
+
+    """
+    name = env.get("name")
+
+    # try:
+    # Check if the mapping already exists
+    d_id = vlmc.is_mapped(name)
+    if d_id is not None:
+        # The mapping exists. Unmap the vlmc device.
+        vlmc.unmap_volume(name=str(DEVICE_PREFIX + str(d_id)))
+    # assert(vlmc.is_mapped(name) == None)
+    return 0
+    # except Error as e:
+    #  sys.stderr.write(str(e)+'\n')
+    #  return -1
+
+
+def grow(env):
+    """Grow an existing vlmc Image"""
+    name = env.get("name")
+    size = env.get("size")
+
+    sys.stderr.write("Resizing '%s'. New size '%s'\n" % (name, size))
+    vlmc.resize(name=name, size=int(size))
+    return 0
+
+
+def remove(env):
+    """Delete a vlmc Image"""
+    name = env.get("name")
+
+    sys.stderr.write("Deleting '%s'\n" % name)
+    vlmc.remove(name=name)
+    return 0
+
+
+def verify(env):
+    """Verify that a vlmc Image exists, according to the catalog"""
+    from catalog import Catalog
+    name = env.get("name")
+
+    try:
+        catalog = Catalog()
+    except Error as e:
+        # Answer from the storage alone
+        sys.stderr.write("Cannot use the volume catalog: %s\n" % e)
+        catalog = Catalog(":memory:")
+    try:
+        volume = catalog.refresh_volume(name)
+    finally:
+        catalog.close()
+    if volume is None or volume.deleted:
+        sys.stderr.write("Volume '%s' does not exist\n" % name)
+        return 1
+    return 0
+
+
+def setinfo(env):
+    return 0
+
+
+actions = {
+    'create': create,
+    'snapshot': snapshot,
+    'attach': attach,
+    'detach': detach,
+    'grow': grow,
+    'remove': remove,
+    'verify': verify,
+    'setinfo': setinfo,
+}
+
+
+def run_action(action_name, env):
+    """Run an action, once the configuration has been loaded, and return its
+    exit code"""
+    try:
+        action = actions[action_name]
+        return action(env)
+    except KeyError:
+        sys.stderr.write("Action '%s' not supported\n" % action_name)
+        return 1
+    except Error as e:
+        sys.stderr.write("Archipelago error: %s\n" % e)
+        return 1
+
+
+def main(action_name, env):
+    loadrc(None)
+
+    os.umask(config['UMASK'])
+
+    return run_action(action_name, env)
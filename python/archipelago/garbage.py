@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Offline garbage collection of data objects.
+
+Removed volumes and failed clones leave behind data objects that no map
+references. They are collected in two phases, as outlined in
+docs/design/gc.rst:
+
+ * Mark: every map of the storage is read, and the objects referenced by
+   the maps that are not deleted are merged to a sorted run of keys. The
+   objects that hold the maps themselves are marked too. The storage is
+   listed again until no new maps show up, so that snapshots and clones
+   created while marking are not missed.
+ * Sweep: the blocker storage is listed, and every data object, named
+   <volume>_<epoch>_<index>, that is not marked and was last modified before
+   the grace period that precedes the mark is removed.
+
+Data objects have unique names, so an object that no map references never
+gets referenced again, and the collection can run on a live system. Keys
+that collide only keep garbage in place.
+"""
+
+import os
+import time
+import errno
+import threading
+
+from common import *
+from vlmc import scan_volumes, object_name_re, filed_dir_re, open_rados, \
+    FILED_DIR_DEPTH
+from mapreader import open_store, MapReader, map_run, object_key, \
+    object_run, run_union, run_contains, _release, V2_OBJECT_SIZE
+
+DEFAULT_GRACE = 24 * 60 * 60
+# Keys gathered from maps before they are merged to the marked run
+MERGE_KEYS = 1 << 22
+
+
+class Throttle(object):
+    """Pace the callers of acquire(), from any thread, to rate per second"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.started = None
+        self.acquired = 0
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            if self.started is None:
+                self.started = now
+            delay = self.started + float(self.acquired) / self.rate - now
+            self.acquired += 1
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _exists(store, name):
+    data = store.open(name)
+    if data is None:
+        return False
+    _release(data)
+    return True
+
+
+class Collector(object):
+    """Mark and sweep the data objects of the storage of the blocker peer.
+
+    Up to jobs maps are read and jobs objects are examined in parallel, and
+    at most rate objects are removed per second, if rate is set. Objects
+    modified less than grace seconds before the mark started are kept. With
+    dry_run, nothing is removed. report is called with the name and size of
+    every object removed, or that would be removed.
+    """
+    def __init__(self, jobs=16, grace=DEFAULT_GRACE, rate=0, dry_run=False,
+                 report=None):
+        if jobs <= 0 or grace < 0 or rate < 0:
+            raise Error("Invalid jobs, grace or rate")
+        self.jobs = jobs
+        self.grace = grace
+        self.throttle = Throttle(rate)
+        self.dry_run = dry_run
+        self.report = report
+        self.lock = threading.Lock()
+        self.marked = None
+        self.cutoff = None
+        self.volumes = set()
+        self.missed = {}
+        self.store = None
+        self.stats = dict(maps=0, referenced=0, objects=0, young=0,
+                          unknown=0, removed=0, bytes=0)
+
+    def run(self):
+        """Collect the garbage and return the statistics of the run"""
+        self.store = open_store()
+        try:
+            self.mark()
+            self.sweep()
+        finally:
+            self.store.close()
+        return self.stats
+
+    def __read_map(self, volumes):
+        """Return the run of a map, given the Volumes of its headers, or None
+        if it is gone"""
+        name = volumes[0].name
+        try:
+            reader = MapReader(self.store, name)
+        except Error:
+            if any(_exists(self.store, v.header_object) for v in volumes):
+                raise
+            return None
+        map_objects = [v.header_object for v in volumes]
+        map_objects.append(reader.header_object)
+        if reader.version == 2:
+            per_block = reader.blocksize // V2_OBJECT_SIZE
+            blocks = (reader.nr_objs + per_block - 1) // per_block
+            map_objects.extend(reader.map_block_name(block)
+                               for block in xrange(blocks))
+        # The flags of the header actually read decide, and any doubt keeps
+        # the objects
+        deleted = [v.deleted for v in volumes
+                   if v.header_object == reader.header_object]
+        if deleted and deleted[0]:
+            return object_run(map_objects)
+        run, _ = map_run(reader)
+        return run_union([run, object_run(map_objects)])
+
+    def mark(self):
+        """Read all maps and build the run of referenced objects"""
+        from multiprocessing.pool import ThreadPool
+
+        self.cutoff = time.time() - self.grace
+        seen = set()
+        marked = run_union([])
+        pending = []
+        pending_keys = 0
+        pool = ThreadPool(self.jobs)
+        try:
+            while True:
+                maps = {}
+                for v in scan_volumes(self.jobs):
+                    if v.header_object not in seen:
+                        seen.add(v.header_object)
+                        maps.setdefault(v.name, []).append(v)
+                        self.volumes.update((v.name, v.header_object))
+                if not maps:
+                    break
+                for run in pool.imap_unordered(self.__read_map,
+                                               maps.values()):
+                    if run is None:
+                        continue
+                    self.stats['maps'] += 1
+                    pending.append(run)
+                    pending_keys += len(run)
+                    if pending_keys >= MERGE_KEYS:
+                        marked = run_union([marked] + pending)
+                        pending = []
+                        pending_keys = 0
+        finally:
+            pool.terminate()
+        self.marked = run_union([marked] + pending)
+        self.stats['referenced'] = len(self.marked)
+
+    def __missed_map(self, volume):
+        """Tell whether the volume of a data object has a map the mark did
+        not read, such as one not told apart from data objects by name"""
+        if volume in self.volumes:
+            return False
+        with self.lock:
+            missed = self.missed.get(volume)
+        if missed is None:
+            missed = _exists(self.store, volume)
+            if not volume.startswith(ARCHIP_PREFIX):
+                missed = missed or _exists(self.store, ARCHIP_PREFIX + volume)
+            with self.lock:
+                self.missed[volume] = missed
+        return missed
+
+    def __count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def __is_candidate(self, name):
+        m = object_name_re.match(name)
+        if m is None:
+            return False
+        self.__count('objects')
+        if run_contains(self.marked, object_key(name)):
+            return False
+        if self.__missed_map(m.group(1)):
+            self.__count('unknown')
+            return False
+        return True
+
+    def __remove(self, name, mtime, size, remove):
+        if mtime >= self.cutoff:
+            self.__count('young')
+            return
+        if not self.dry_run:
+            self.throttle.acquire()
+            remove()
+        with self.lock:
+            self.stats['removed'] += 1
+            self.stats['bytes'] += size
+            if self.report is not None:
+                self.report(name, size)
+
+    def sweep(self):
+        """Remove the data objects that are not marked"""
+        if self.marked is None:
+            raise Error("Sweep without mark")
+        blocker = peers['blockerm']
+        if isinstance(blocker, Filed):
+            self.__sweep_filed(blocker.archip_dir)
+        elif isinstance(blocker, Radosd):
+            self.__sweep_rados()
+        else:
+            raise Error("Invalid storage")
+
+    def __sweep_filed(self, root):
+        from multiprocessing.pool import ThreadPool
+
+        def leaves(path, depth):
+            if not depth:
+                yield path
+                return
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                return
+            for name in names:
+                if filed_dir_re.match(name):
+                    for leaf in leaves(os.path.join(path, name), depth - 1):
+                        yield leaf
+
+        def sweep_dir(path):
+            try:
+                names = os.listdir(path)
+            except OSError:
+                return
+            for name in names:
+                if not self.__is_candidate(name):
+                    continue
+                filename = os.path.join(path, name)
+                try:
+                    st = os.lstat(filename)
+                except OSError:
+                    continue
+                self.__remove(name, st.st_mtime, st.st_size,
+                              lambda: _unlink(filename))
+
+        pool = ThreadPool(self.jobs)
+        try:
+            for _ in pool.imap_unordered(sweep_dir,
+                                         leaves(root, FILED_DIR_DEPTH)):
+                pass
+        finally:
+            pool.terminate()
+
+    def __sweep_rados(self):
+        from radoslist import list_objects, rados_module
+        from multiprocessing.pool import ThreadPool
+
+        rados = rados_module()
+        cluster, ioctx = open_rados()
+
+        def sweep_object(name):
+            try:
+                size, mtime = ioctx.stat(name)
+            except rados.ObjectNotFound:
+                return
+
+            def remove():
+                try:
+                    ioctx.remove_object(name)
+                except rados.ObjectNotFound:
+                    pass
+                except rados.Error as e:
+                    raise Error("Cannot remove %s: %s" % (name, e))
+            self.__remove(name, time.mktime(mtime), size, remove)
+
+        pool = ThreadPool(self.jobs)
+        try:
+            names = (name for _, name in list_objects(ioctx)
+                     if self.__is_candidate(name))
+            for _ in pool.imap_unordered(sweep_object, names, chunksize=16):
+                pass
+        finally:
+            pool.terminate()
+            ioctx.close()
+            cluster.shutdown()
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise Error("Cannot remove %s: %s" % (filename, e.strerror))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Changed block diff between two maps.
+
+Two maps are compared object by object, a chunk of records at a time. An
+object is unchanged when both maps point to the same object name, since
+names carry the epoch of the map that created them and are never reused, or
+when it is zero in both maps. Runs of changed objects are turned to Extents
+of the volume of the second map, in bytes, and zero Extents tell the ranges
+that now read as zeros. Against no map at all, every object is reported, so
+that the Extents cover the whole volume.
+
+Extents are written as a stream of JSON lines, or in a compact binary form:
+a header of the magic, the format version, the size and the block size of
+the target map, followed by fixed size records of the offset, the length
+and the flags of every extent, up to the end of the stream.
+"""
+
+from struct import Struct
+from collections import namedtuple
+
+from common import *
+from mapreader import get_numpy, MF_OBJECT_ZERO
+
+Extent = namedtuple('Extent', ['offset', 'length', 'zero'])
+
+DIFF_MAGIC = 'ADF.'
+DIFF_VERSION = 1
+DIFF_HEADER = Struct('>4sLQL')
+DIFF_EXTENT = Struct('>QQL')
+DIFF_EXTENT_ZERO = 1 << 0
+
+
+def _aligned_chunks(a, b):
+    """Yield (start, flags and names in a, flags and names in b) over the
+    objects of b. Objects beyond the end of a, or of every object if a is
+    None, are reported as zero in a."""
+    chunks_a = a.chunks() if a is not None else iter(())
+    flags_a, names_a = [], []
+    for chunk in b.chunks():
+        count = len(chunk.objects)
+        while len(names_a) < count:
+            try:
+                more = next(chunks_a)
+            except StopIteration:
+                missing = count - len(names_a)
+                flags_a.extend([MF_OBJECT_ZERO] * missing)
+                names_a.extend([''] * missing)
+                break
+            flags_a.extend(more.flags)
+            names_a.extend(more.objects)
+        yield (chunk.start, flags_a[:count], names_a[:count], chunk.flags,
+               chunk.objects)
+        del flags_a[:count]
+        del names_a[:count]
+
+
+def _compare(flags_a, names_a, flags_b, names_b):
+    """Return whether every object of b changed since a, and whether it is
+    zero in b"""
+    np = get_numpy()
+    if np is not None:
+        zero_a = (np.array(flags_a, dtype=np.uint8) & MF_OBJECT_ZERO) != 0
+        zero_b = (np.array(flags_b, dtype=np.uint8) & MF_OBJECT_ZERO) != 0
+        same = np.array(names_a, dtype=object) == \
+            np.array(names_b, dtype=object)
+        changed = np.where(zero_b, ~zero_a, zero_a | ~same)
+        return changed.tolist(), zero_b.tolist()
+    zero_a = [(f & MF_OBJECT_ZERO) != 0 for f in flags_a]
+    zero_b = [(f & MF_OBJECT_ZERO) != 0 for f in flags_b]
+    changed = [(not za) if zb else (za or na != nb)
+               for za, zb, na, nb in zip(zero_a, zero_b, names_a, names_b)]
+    return changed, zero_b
+
+
+def changed_objects(a, b):
+    """Yield (start, count, zero) for the runs of consecutive objects of map
+    b that differ from map a, or for all of them if a is None. a and b are
+    MapReaders."""
+    if a is not None and a.blocksize != b.blocksize:
+        raise Error("Maps %s and %s have different block sizes" %
+                    (a.name, b.name))
+    run = None
+    for start, flags_a, names_a, flags_b, names_b in _aligned_chunks(a, b):
+        changed, zero = _compare(flags_a, names_a, flags_b, names_b)
+        for i, (c, z) in enumerate(zip(changed, zero)):
+            if not c and a is not None:
+                continue
+            index = start + i
+            if run is not None and run[0] + run[1] == index and run[2] == z:
+                run[1] += 1
+                continue
+            if run is not None:
+                yield tuple(run)
+            run = [index, 1, z]
+    if run is not None:
+        yield tuple(run)
+
+
+def diff_maps(a, b):
+    """Yield the Extents of the volume of map b that changed since map a"""
+    for start, count, zero in changed_objects(a, b):
+        offset = start * b.blocksize
+        length = min(count * b.blocksize, b.size - offset)
+        if length > 0:
+            yield Extent(offset, length, zero)
+
+
+def write_diff(stream, extents, size, blocksize):
+    """Write the binary form of a diff to a stream and return the number of
+    extents"""
+    stream.write(DIFF_HEADER.pack(DIFF_MAGIC, DIFF_VERSION, size, blocksize))
+    count = 0
+    for e in extents:
+        stream.write(DIFF_EXTENT.pack(e.offset, e.length,
+                                      DIFF_EXTENT_ZERO if e.zero else 0))
+        count += 1
+    return count
+
+
+def read_diff(stream):
+    """Read the binary form of a diff from a stream and return the size and
+    the block size of the target map, and an iterator over its Extents"""
+    header = stream.read(DIFF_HEADER.size)
+    if len(header) != DIFF_HEADER.size:
+        raise Error("Truncated diff header")
+    magic, version, size, blocksize = DIFF_HEADER.unpack(header)
+    if magic != DIFF_MAGIC or version != DIFF_VERSION:
+        raise Error("Invalid diff header")
+
+    def extents():
+        while True:
+            record = stream.read(DIFF_EXTENT.size)
+            if not record:
+                return
+            if len(record) != DIFF_EXTENT.size:
+                raise Error("Truncated diff extent")
+            offset, length, flags = DIFF_EXTENT.unpack(record)
+            yield Extent(offset, length, bool(flags & DIFF_EXTENT_ZERO))
+
+    return size, blocksize, extents()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Offline reader of volume maps.
+
+Maps are read straight from the storage of the blocker, without mapperd, in
+the on-disk formats of src/include/mapper-version*.h:
+
+ * Version 0 (pithos) maps have no header. The map object, named after the
+   64 hex digit hash of the map, holds one 32 byte SHA256 digest per object,
+   up to the first all-zero record.
+ * Version 1 maps are held in the object named after the volume: a 12 byte
+   little endian header with the version and the size, followed by 33 byte
+   records of a writable flag and a SHA256 digest.
+ * Version 2 maps have a 32 byte big endian header in the object named
+   after the volume, or in archip_<volume> for legacy maps. Their 128 byte
+   records, of flags, the length and the name of the object, are spread
+   over map blocks of blocksize bytes, named after the header object and
+   the block.
+
+Records are decoded a chunk at a time: with numpy, through structured dtypes
+over the mmap'ed map, or else with a single struct call per chunk.
+"""
+
+import os
+import re
+import mmap
+from struct import Struct
+from binascii import hexlify
+from collections import namedtuple
+
+from common import *
+
+MF_OBJECT_WRITABLE = 1 << 0
+MF_OBJECT_ARCHIP = 1 << 1
+MF_OBJECT_ZERO = 1 << 2
+MF_OBJECT_DELETED = 1 << 3
+
+MF_MAP_READONLY = 1 << 0
+MF_MAP_DELETED = 1 << 1
+
+MAPPER_DEFAULT_BLOCKSIZE = 1 << 22
+ZERO_BLOCK = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+SHA256_DIGEST_SIZE = 32
+V0_OBJECT_SIZE = SHA256_DIGEST_SIZE
+V1_HEADER = Struct("<LQ")
+V1_OBJECT_SIZE = 1 + SHA256_DIGEST_SIZE
+V2_HEADER = Struct(">LLQLLQ")
+V2_OBJECT_SIZE = 128
+V2_MAX_OBJECTLEN = 123
+V2_SIGNATURE = Struct(">L").pack(int(hexlify(b'AMF.'), base=16))
+
+# Records decoded at a time
+CHUNK_OBJECTS = 4096
+
+MapHeader = namedtuple('MapHeader', ['version', 'size', 'blocksize', 'flags',
+                                     'epoch', 'nr_objs', 'header_object'])
+MapChunk = namedtuple('MapChunk', ['start', 'flags', 'objects'])
+
+pithos_object_re = re.compile('^[0-9a-f]{64}$')
+
+_numpy = []
+
+
+def get_numpy():
+    """Return the numpy module, or None if it is not installed"""
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
+_structs = {}
+
+
+def _records_struct(fmt, count):
+    """Return a Struct decoding count consecutive records of fmt"""
+    key = (fmt, count)
+    s = _structs.get(key)
+    if s is None:
+        s = _structs[key] = Struct('<' + fmt * count)
+    return s
+
+
+class FiledStore(object):
+    """Map objects of a filed directory, mapped in memory"""
+    def __init__(self, archip_dir):
+        self.archip_dir = archip_dir
+
+    def __paths(self, name):
+        from vlmc import filed_object_dir
+        yield os.path.join(self.archip_dir, filed_object_dir(name), name)
+        if pithos_object_re.match(name):
+            # Left in place of the old pithos layout
+            yield os.path.join(self.archip_dir, name[0:2], name[2:4],
+                               name[4:6], name)
+
+    def open(self, name):
+        """Return the contents of an object, or None if it does not exist"""
+        for path in self.__paths(name):
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                continue
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return ''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        return None
+
+    def close(self):
+        pass
+
+
+class RadosStore(object):
+    """Map objects of a RADOS pool, read whole"""
+    def __init__(self, ioctx, cluster=None):
+        self.ioctx = ioctx
+        self.cluster = cluster
+
+    def open(self, name):
+        from radoslist import rados_module
+        rados = rados_module()
+        try:
+            size, _ = self.ioctx.stat(name)
+            return self.ioctx.read(name, length=size) if size else ''
+        except rados.ObjectNotFound:
+            return None
+
+    def close(self):
+        if self.cluster is not None:
+            self.ioctx.close()
+            self.cluster.shutdown()
+
+
+def open_store():
+    """Return the store of map objects of the configured blocker"""
+    blocker = peers['blockerm']
+    if isinstance(blocker, Filed):
+        return FiledStore(blocker.archip_dir)
+    elif isinstance(blocker, Radosd):
+        from vlmc import open_rados
+        cluster, ioctx = open_rados()
+        return RadosStore(ioctx, cluster)
+    raise Error("Invalid storage")
+
+
+def _release(data):
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def parse_header(header_object, data):
+    """Return the MapHeader of a map object, or None if it holds no map"""
+    if data[0:4] == V2_SIGNATURE:
+        if len(data) < V2_HEADER.size:
+            return None
+        _, version, size, blocksize, flags, epoch = \
+            V2_HEADER.unpack_from(data)
+        if version != 2 or blocksize < V2_OBJECT_SIZE:
+            return None
+        nr_objs = (size + blocksize - 1) // blocksize
+        return MapHeader(version, size, blocksize, flags, epoch, nr_objs,
+                         header_object)
+    if len(data) >= V1_HEADER.size and V1_HEADER.unpack_from(data)[0] == 1:
+        _, size = V1_HEADER.unpack_from(data)
+        blocksize = MAPPER_DEFAULT_BLOCKSIZE
+        nr_objs = (size + blocksize - 1) // blocksize
+        return MapHeader(1, size, blocksize, 0, 0, nr_objs, header_object)
+    if pithos_object_re.match(header_object):
+        nr_objs = _count_v0_objects(data)
+        return MapHeader(0, nr_objs * MAPPER_DEFAULT_BLOCKSIZE,
+                         MAPPER_DEFAULT_BLOCKSIZE, 0, 0, nr_objs,
+                         header_object)
+    return None
+
+
+def _count_v0_objects(data):
+    """Count the records of a v0 map, up to the first all-zero one"""
+    nr = len(data) // V0_OBJECT_SIZE
+    np = get_numpy()
+    if np is not None and nr:
+        records = np.frombuffer(data, dtype=np.uint8,
+                                count=nr * V0_OBJECT_SIZE).reshape(nr, -1)
+        nulls = np.flatnonzero(~records.any(axis=1))
+        return int(nulls[0]) if len(nulls) else nr
+    nulls = '\0' * V0_OBJECT_SIZE
+    for i in xrange(nr):
+        offset = i * V0_OBJECT_SIZE
+        if data[offset:offset + V0_OBJECT_SIZE] == nulls:
+            return i
+    return nr
+
+
+def _decode_digests(raw_flags, digests, prefix_writable):
+    """Turn the SHA256 digests of v0 and v1 records to object names and v2
+    style flags. digests is the concatenation of the raw digests."""
+    hexed = hexlify(digests)
+    step = 2 * SHA256_DIGEST_SIZE
+    names = [hexed[i:i + step] for i in xrange(0, len(hexed), step)]
+    flags = []
+    for i, name in enumerate(names):
+        f = 0
+        if raw_flags is not None and raw_flags[i]:
+            f = MF_OBJECT_WRITABLE | MF_OBJECT_ARCHIP
+            if prefix_writable:
+                names[i] = ARCHIP_PREFIX + name
+        elif name == ZERO_BLOCK:
+            f = MF_OBJECT_ZERO
+        flags.append(f)
+    return flags, names
+
+
+def decode_v0(data, offset, count):
+    """Decode count v0 records at offset, returning flags and names"""
+    np = get_numpy()
+    if np is not None:
+        digests = np.frombuffer(data, dtype=np.uint8, offset=offset,
+                                count=count * V0_OBJECT_SIZE).tobytes()
+    else:
+        digests = data[offset:offset + count * V0_OBJECT_SIZE]
+    return _decode_digests(None, digests, False)
+
+
+def decode_v1(data, offset, count):
+    """Decode count v1 records at offset, returning flags and names"""
+    np = get_numpy()
+    if np is not None:
+        dtype = np.dtype([('flags', 'u1'),
+                          ('name', 'u1', (SHA256_DIGEST_SIZE, ))])
+        records = np.frombuffer(data, dtype=dtype, offset=offset,
+                                count=count)
+        raw_flags = records['flags'].tolist()
+        digests = records['name'].tobytes()
+    else:
+        values = _records_struct('B32s', count).unpack_from(data, offset)
+        raw_flags = values[0::2]
+        digests = ''.join(values[1::2])
+    return _decode_digests(raw_flags, digests, True)
+
+
+def decode_v2(data, offset, count):
+    """Decode count v2 records at offset, returning flags and names"""
+    np = get_numpy()
+    if np is not None:
+        dtype = np.dtype([('flags', 'u1'), ('objectlen', '<u4'),
+                          ('object', 'S%d' % V2_MAX_OBJECTLEN)])
+        records = np.frombuffer(data, dtype=dtype, offset=offset,
+                                count=count)
+        flags = records['flags'].tolist()
+        lengths = records['objectlen'].tolist()
+        names = records['object'].tolist()
+    else:
+        values = _records_struct('BI%ds' % V2_MAX_OBJECTLEN,
+                                 count).unpack_from(data, offset)
+        flags = list(values[0::3])
+        lengths = values[1::3]
+        names = values[2::3]
+    names = [n[:l] for n, l in zip(names, lengths)]
+    return flags, names
+
+
+class MapReader(object):
+    """Read the map of a volume, given by name, or by the name of its map
+    object for version 0 maps. Like mapperd, the map is looked up by name
+    first, and then with the archip_ prefix of legacy maps."""
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.header = None
+        for header_object in (name, ARCHIP_PREFIX + name):
+            data = store.open(header_object)
+            if data is None:
+                continue
+            try:
+                self.header = parse_header(header_object, data)
+            finally:
+                _release(data)
+            if self.header is not None:
+                break
+        if self.header is None:
+            raise Error("Cannot find the map of %s" % name)
+
+    def __getattr__(self, attr):
+        return getattr(self.header, attr)
+
+    def chunks(self, nr=CHUNK_OBJECTS):
+        """Yield the objects of the map as MapChunks of up to nr objects"""
+        if self.version == 2:
+            for chunk in self.__chunks_v2(nr):
+                yield chunk
+            return
+        if self.version == 1:
+            header_size, decode = V1_HEADER.size, decode_v1
+            record_size = V1_OBJECT_SIZE
+        else:
+            header_size, decode = 0, decode_v0
+            record_size = V0_OBJECT_SIZE
+        data = self.store.open(self.header_object)
+        if data is None:
+            raise Error("Map object %s disappeared" % self.header_object)
+        try:
+            available = (len(data) - header_size) // record_size
+            if available < self.nr_objs:
+                raise Error("Map %s is truncated" % self.header_object)
+            for start in xrange(0, self.nr_objs, nr):
+                count = min(nr, self.nr_objs - start)
+                flags, objects = decode(data, header_size +
+                                        start * record_size, count)
+                yield MapChunk(start, flags, objects)
+        finally:
+            _release(data)
+
+    def map_block_name(self, block):
+        return "%s_%016x" % (self.header_object, block)
+
+    def __chunks_v2(self, nr):
+        per_block = self.blocksize // V2_OBJECT_SIZE
+        for block_start in xrange(0, self.nr_objs, per_block):
+            block = self.map_block_name(block_start // per_block)
+            data = self.store.open(block)
+            if data is None:
+                raise Error("Missing map block %s" % block)
+            try:
+                in_block = min(per_block, self.nr_objs - block_start)
+                if len(data) < in_block * V2_OBJECT_SIZE:
+                    raise Error("Map block %s is truncated" % block)
+                for i in xrange(0, in_block, nr):
+                    count = min(nr, in_block - i)
+                    flags, objects = decode_v2(data, i * V2_OBJECT_SIZE,
+                                               count)
+                    yield MapChunk(block_start + i, flags, objects)
+            finally:
+                _release(data)
+
+    def objects(self):
+        """Yield (index, flags, object name) for every object of the map"""
+        for chunk in self.chunks():
+            index = chunk.start
+            for flags, name in zip(chunk.flags, chunk.objects):
+                yield index, flags, name
+                index += 1
+
+
+# Set operations over the objects of many maps.
+#
+# Objects are keyed by the 64 bit hash of their name, and every map is turned
+# to a sorted run of unique keys: a numpy array, or an array('l') without
+# numpy. Runs cost 8 bytes per object and are combined by merging, instead of
+# building sets of name strings.
+
+def object_key(name):
+    return hash(name)
+
+
+def object_run(names):
+    """Return the sorted run of the unique keys of names"""
+    np = get_numpy()
+    keys = [object_key(name) for name in names]
+    if np is not None:
+        return np.unique(np.array(keys, dtype=np.int64))
+    from array import array
+    keys.sort()
+    run = array('l')
+    last = None
+    for key in keys:
+        if key != last:
+            run.append(key)
+            last = key
+    return run
+
+
+def map_run(reader):
+    """Return the run of the objects of a map, and its number of zero
+    objects"""
+    names = []
+    zero = 0
+    for chunk in reader.chunks():
+        for flags, name in zip(chunk.flags, chunk.objects):
+            if flags & MF_OBJECT_ZERO:
+                zero += 1
+            else:
+                names.append(name)
+    return object_run(names), zero
+
+
+def count_runs(runs):
+    """Merge runs to the sorted keys of all their objects and the number of
+    runs each key appears in"""
+    np = get_numpy()
+    if np is not None:
+        if not runs:
+            return (np.array([], dtype=np.int64),
+                    np.array([], dtype=np.int64))
+        return np.unique(np.concatenate(runs), return_counts=True)
+    import heapq
+    from array import array
+    keys = array('l')
+    counts = array('l')
+    for key in heapq.merge(*runs):
+        if keys and keys[-1] == key:
+            counts[-1] += 1
+        else:
+            keys.append(key)
+            counts.append(1)
+    return keys, counts
+
+
+def run_counts(run, keys, counts):
+    """Return the counts of the keys of a run, as given by count_runs"""
+    np = get_numpy()
+    if np is not None:
+        return counts[np.searchsorted(keys, run)]
+    from array import array
+    result = array('l')
+    i = 0
+    for key in run:
+        while keys[i] != key:
+            i += 1
+        result.append(counts[i])
+    return result
+
+
+def run_union(runs):
+    """Merge runs to the sorted run of the keys found in any of them"""
+    np = get_numpy()
+    if np is not None:
+        if not runs:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(runs))
+    import heapq
+    from array import array
+    result = array('l')
+    for key in heapq.merge(*runs):
+        if not result or result[-1] != key:
+            result.append(key)
+    return result
+
+
+def run_contains(run, key):
+    """Return whether a run holds a key"""
+    from bisect import bisect_left
+    i = bisect_left(run, key)
+    return i < len(run) and run[i] == key
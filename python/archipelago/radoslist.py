@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Listing of RADOS pools, with a bounded window of asynchronous reads.
+
+The rados module is imported through rados_module(), which the test suite
+and the benchmarks replace with an in-memory stand-in, so that the listing
+can be tested without a Ceph cluster.
+"""
+
+import os
+import errno
+import threading
+from collections import deque
+
+from common import Error
+
+DEFAULT_WINDOW = 64
+
+
+def rados_module():
+    """Return the rados module"""
+    import rados
+    return rados
+
+
+def list_objects(ioctx, prefix=None, namespace=None):
+    """Yield (namespace, name) for the objects of a pool, in the given
+    namespace, or in all of them if namespace is '*', starting with prefix.
+
+    The namespace of ioctx is left set to the listed one, so it must be set
+    again before the objects of a '*' listing are accessed through it.
+    """
+    rados = rados_module()
+    if namespace is not None:
+        if namespace == '*':
+            namespace = rados.LIBRADOS_ALL_NSPACES
+        ioctx.set_namespace(namespace)
+    for o in rados.ObjectIterator(ioctx):
+        if prefix is None or o.key.startswith(prefix):
+            yield o.nspace, o.key
+
+
+def aio_read_window(ioctx, objects, length, window=DEFAULT_WINDOW, offset=0):
+    """Read length bytes at offset from every (namespace, name) object, with
+    up to window aio_read calls in flight, and yield (namespace, name, data)
+    as they complete.
+
+    The namespace of ioctx is switched as needed before each aio_read, which
+    binds the read to the namespace at the time it is issued, so objects of
+    different namespaces can share the window.
+
+    Objects removed since they were listed are skipped. Any other failure
+    raises Error, once the reads in flight have completed.
+    """
+    if window <= 0:
+        raise Error("Invalid window")
+    cond = threading.Condition()
+    done = deque()
+    # Completions must be kept alive until their callbacks have run
+    inflight = {}
+
+    def oncomplete(token, namespace, name):
+        def complete(completion, data):
+            with cond:
+                done.append((token, namespace, name,
+                             completion.get_return_value(), data))
+                cond.notify()
+        return complete
+
+    def wait():
+        with cond:
+            while not done:
+                cond.wait()
+            completed = list(done)
+            done.clear()
+        for item in completed:
+            del inflight[item[0]]
+        return completed
+
+    objects = enumerate(objects)
+    current = None
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(inflight) < window:
+                try:
+                    token, (namespace, name) = next(objects)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if namespace != current:
+                    ioctx.set_namespace(namespace)
+                    current = namespace
+                inflight[token] = ioctx.aio_read(name, length, offset,
+                                                 oncomplete(token, namespace,
+                                                            name))
+            if not inflight:
+                break
+            for _, namespace, name, ret, data in wait():
+                if ret >= 0:
+                    yield namespace, name, data
+                elif ret != -errno.ENOENT:
+                    raise Error("Cannot read object %s: %s" %
+                                (name, os.strerror(-ret)))
+    finally:
+        while inflight:
+            wait()
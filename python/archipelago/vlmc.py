@@ -20,6 +20,7 @@
 import os
 import sys
 import re
+import time
 from struct import pack, unpack
 from binascii import hexlify
 from ctypes import c_uint32, c_uint64, string_at
@@ -100,7 +101,7 @@ def is_device_mapped(device):
 def parse_assume_v0(req, assume_v0, v0_size):
     if assume_v0:
         flags = req.get_flags()
-        flags |= XF_ASSUMEV0
+        flags |= api.XF_ASSUMEV0
         req.set_flags(flags)
         if v0_size is not None and v0_size != -1:
             req.set_v0_size(v0_size)
@@ -131,16 +132,20 @@ def create(name, size=None, snap=None, assume_v0=False, v0_size=-1, **kwargs):
         raise Error("Invalid volume name")
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    mport = peers['mapperd'].portno_start
-    req = Request.get_clone_request(xseg_ctx, mport, snap, clone=name,
-                                    clone_size=size)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        req = Request.get_clone_request(xseg_ctx, mport, snap, clone=name,
+                                        clone_size=size)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc creation failed")
 
@@ -156,15 +161,20 @@ def snapshot(name, snap_name=None, cli=False, assume_v0=False, v0_size=-1,
     if not is_valid_name(snap_name):
         raise Error("Invalid snapshot name")
 
-    xseg_ctx = Xseg_ctx(get_segment())
-    vport = peers['vlmcd'].portno_start
-    req = Request.get_snapshot_request(xseg_ctx, vport, name, snap=snap_name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        vport = get_peer_port('vlmcd', xseg_ctx, name)
+        req = Request.get_snapshot_request(xseg_ctx, vport, name,
+                                           snap=snap_name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
 
     if not ret:
         raise Error("vlmc snapshot failed")
@@ -172,6 +182,119 @@ def snapshot(name, snap_name=None, cli=False, assume_v0=False, v0_size=-1,
         sys.stdout.write("Snapshot name: %s\n" % snap_name)
 
 
+def snapshot_group(members, pause=False, assume_v0=False, v0_size=-1,
+                   cli=False, **kwargs):
+    """Snapshot several volumes at once.
+
+    Members are (volume, snapshot) pairs. The X_SNAPSHOT requests of all the
+    members are submitted together on a single context. With pause, the
+    tapdisks of the mapped members are paused right before the requests are
+    submitted and unpaused as soon as the last reply arrives.
+
+    Returns a list with the volume, snapshot, latency in seconds and success
+    of every member.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    if not members:
+        raise Error("No volumes to snapshot")
+    for name, snap_name in members:
+        if len(name) < 6:
+            raise Error("Name should have at least len 6")
+        if not is_valid_name(name):
+            raise Error("Invalid volume name %s" % name)
+        if not snap_name or not is_valid_name(snap_name):
+            raise Error("Invalid snapshot name %s" % snap_name)
+    names = [name for name, _ in members]
+    if len(set(names)) != len(names):
+        raise Error("A volume can only be snapshotted once per group")
+
+    tapdisks = []
+    if pause:
+        tapdisks = [t for t in get_mapped() if t.volume in names and t.pid]
+
+    def tap_ctl(action, targets):
+        """Run action on the targets, in parallel, and return the ones it
+        succeeded on and the first error, if any"""
+        def run(t):
+            try:
+                VlmcTapdisk.exc(action, '-p%s' % t.pid, '-m%s' % t.minor)
+            except Exception as e:
+                return e
+        errors = pool.map(run, targets)
+        done = [t for t, e in zip(targets, errors) if e is None]
+        errors = [e for e in errors if e is not None]
+        return done, errors[0] if errors else None
+
+    xseg_ctx = get_xseg_ctx()
+    pool = ThreadPool(len(tapdisks)) if tapdisks else None
+    reqs = []
+    latency = {}
+    paused = []
+    unpause_error = None
+    try:
+        for name, snap_name in members:
+            vport = get_peer_port('vlmcd', xseg_ctx, name)
+            req = Request.get_snapshot_request(xseg_ctx, vport, name,
+                                               snap=snap_name)
+            parse_assume_v0(req, assume_v0, v0_size)
+            reqs.append(req)
+
+        submitted = []
+        pause_start = time.time()
+        try:
+            if pool is not None:
+                paused, error = tap_ctl('pause', tapdisks)
+                if error is not None:
+                    raise Error("Cannot pause tapdisks: %s" % error)
+            start = time.time()
+            for req in reqs:
+                req.submit()
+                submitted.append(req)
+            pending = set(submitted)
+            while pending:
+                req = xseg_ctx.wait_requests(pending)
+                latency[req] = time.time() - start
+                pending.discard(req)
+        finally:
+            # Only the tapdisks actually paused are unpaused, and a failure
+            # to unpause does not mask an earlier error
+            if paused:
+                _, unpause_error = tap_ctl('unpause', paused)
+                paused_for = time.time() - pause_start
+            for req in submitted:
+                if req not in latency:
+                    req.wait()
+        if unpause_error is not None:
+            raise Error("Cannot unpause tapdisks: %s" % unpause_error)
+
+        results = []
+        for (name, snap_name), req in zip(members, reqs):
+            results.append({'volume': name, 'snapshot': snap_name,
+                            'latency': latency.get(req),
+                            'success': req.success()})
+    finally:
+        for req in reqs:
+            req.put()
+        if pool is not None:
+            pool.close()
+        put_xseg_ctx(xseg_ctx)
+
+    if cli:
+        for r in results:
+            sys.stdout.write("%s\t%s\t%.3f ms\t%s\n" %
+                             (r['volume'], r['snapshot'],
+                              r['latency'] * 1000,
+                              "ok" if r['success'] else "failed"))
+        if tapdisks:
+            sys.stdout.write("Paused %d tapdisks for %.3f ms\n" %
+                             (len(tapdisks), paused_for * 1000))
+    failed = [r['volume'] for r in results if not r['success']]
+    if failed:
+        raise Error("vlmc snapshot failed for %s" % ", ".join(failed))
+    return results
+
+
 def rename(name, newname=None, cli=False, assume_v0=False, v0_size=-1,
            **kwargs):
     if len(name) < 6:
@@ -189,15 +312,20 @@ def rename(name, newname=None, cli=False, assume_v0=False, v0_size=-1,
     if not is_valid_name(newname):
         raise Error("Invalid new name")
 
-    xseg_ctx = Xseg_ctx(get_segment())
-    mport = peers['mapperd'].portno_start
-    req = Request.get_rename_request(xseg_ctx, mport, name, newname=newname)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        req = Request.get_rename_request(xseg_ctx, mport, name,
+                                         newname=newname)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
 
     if not ret:
         raise Error("vlmc rename failed")
@@ -212,18 +340,22 @@ def hash(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
     if not is_valid_name(name):
         raise Error("Invalid volume name")
 
-    xseg_ctx = Xseg_ctx(get_segment())
-    mport = peers['mapperd'].portno_start
-    req = Request.get_hash_request(xseg_ctx, mport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    if ret:
-        xhash = req.get_data(xseg_reply_hash).contents
-        hash_name = string_at(xhash.target, xhash.targetlen)
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        req = Request.get_hash_request(xseg_ctx, mport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+            if ret:
+                xhash = req.get_data(api.xseg_reply_hash).contents
+                hash_name = string_at(xhash.target, xhash.targetlen)
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
 
     if not ret:
         raise Error("vlmc hash failed")
@@ -232,91 +364,210 @@ def hash(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
         return hash_name
 
 
-def list_volumes(cli=False, **kwargs):  # NOQA
-    """
-    Quick 'n dirty way to list volumes. This bypasses the archipelago
-    infrastructure and goes directly to storage.
-    """
+FILED_DIR_DEPTH = 3
+filed_dir_re = re.compile('^[0-9a-f]{2}$')
 
-    MAX_HEADER_SIZE = 32
+Volume = namedtuple('Volume', ['name', 'version', 'header_object',
+                               'readonly', 'deleted', 'size', 'epoch'])
 
-    def parse_header(name, header):
-        size_uint32t = sizeof(c_uint32)
-        size_uint64t = sizeof(c_uint64)
 
-        readonly = False
-        deleted = False
-        version1_on_disk = pack("<L", 1)
-        signature_on_disk = pack(">L", int(hexlify(b'AMF.'), base=16))
+map_block_re = re.compile('^.*_[0-9a-f]{16}$')
 
-        if (header[0:size_uint32t] != signature_on_disk):
-            if header[0:size_uint32t] == version1_on_disk:
-                version = 1
-            elif len(name) == 64 and re.match('(\d|[abcdef])+', name):
-                version = 0
-                readonly = True
-            else:
-                return None
+
+def is_header_candidate(name):
+    """Tell by its name whether an object may hold a map header. Data
+    objects and map blocks of version 2 maps and lock files never do."""
+    return len(name) >= 6 and not name.endswith('_lock') and \
+        map_block_re.match(name) is None
+
+
+def parse_volume_header(name, header):
+    """Return the Volume described by the first bytes of an object, or None
+    if the object does not hold a map header"""
+    size_uint32t = sizeof(c_uint32)
+    size_uint64t = sizeof(c_uint64)
+
+    readonly = False
+    deleted = False
+    size = None
+    epoch = None
+    version1_on_disk = pack("<L", 1)
+    signature_on_disk = pack(">L", int(hexlify(b'AMF.'), base=16))
+
+    if (header[0:size_uint32t] != signature_on_disk):
+        if header[0:size_uint32t] == version1_on_disk:
+            version = 1
+            if len(header) >= size_uint32t + size_uint64t:
+                size, = unpack("<Q", header[size_uint32t:size_uint32t +
+                                            size_uint64t])
+        elif len(name) == 64 and re.match('(\d|[abcdef])+', name):
+            version = 0
+            readonly = True
         else:
-            _, version, _, _, flags = unpack(">LLQLL",
-                                             header[:4*size_uint32t +
-                                                    size_uint64t])
-            if flags & 1:
-                readonly = True
-            if flags & 2:
-                deleted = True
+            return None
+    else:
+        if len(header) < MAP_HEADER_SIZE:
+            return None
+        _, version, size, _, flags, epoch = unpack(">LLQLLQ",
+                                                   header[:MAP_HEADER_SIZE])
+        if flags & 1:
+            readonly = True
+        if flags & 2:
+            deleted = True
+
+    volume = name
+    if volume.startswith(ARCHIP_PREFIX):
+        volume = volume[len(ARCHIP_PREFIX):]
+    return Volume(name=volume, version=version, header_object=name,
+                  readonly=readonly, deleted=deleted, size=size, epoch=epoch)
+
+
+def _file_lister():
+    """Return a function listing the names of the files of a directory.
+    scandir, when available, tells files from directories without a stat"""
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        try:
+            from scandir import scandir
+        except ImportError:
+            return os.listdir
+
+    def list_files(path):
+        return [e.name for e in scandir(path) if e.is_file()]
+    return list_files
+
+
+def filed_object_dir(name):
+    """Return the directory, relative to archip_dir, where filed stores an
+    object"""
+    import hashlib
+    digest = hashlib.sha256(name).hexdigest()
+    return os.path.join(digest[0:2], digest[2:4], digest[4:6])
+
+
+def filed_header_candidates(archip_dir):
+    """Yield (name, path) for the files of a filed directory that may hold
+    a map header.
+
+    filed stores every object in three levels of directories, named after
+    the first hex digits of the SHA256 of the object name. Objects that
+    cannot hold a map header are skipped by name, without being read.
+    """
+    list_files = _file_lister()
+
+    def walk(path, depth):
+        try:
+            names = os.listdir(path) if depth else list_files(path)
+        except OSError:
+            return
+        for name in names:
+            if depth:
+                if filed_dir_re.match(name):
+                    for entry in walk(os.path.join(path, name), depth - 1):
+                        yield entry
+            elif is_header_candidate(name):
+                yield name, os.path.join(path, name)
+
+    return walk(archip_dir, FILED_DIR_DEPTH)
+
+
+def open_rados():
+    """Connect to the pool of the RADOS blocker and return the cluster and
+    the io context"""
+    from radoslist import rados_module
+    rados = rados_module()
+    cluster = rados.Rados(rados_id=peers['blockerm'].cephx_id,
+                          conffile=config['CEPH_CONF_FILE'])
+    cluster.connect()
+    try:
+        return cluster, cluster.open_ioctx(peers['blockerm'].pool)
+    except:
+        cluster.shutdown()
+        raise
+
 
-        return (version, readonly, deleted)
+def scan_volumes(jobs=16, prefix=None, namespace=None):
+    """Yield a Volume for every map header found on the storage.
+
+    Up to jobs headers are read in parallel. Only objects starting with
+    prefix are considered and, on RADOS, only those in namespace.
+    """
+    if isinstance(peers['blockerm'], Radosd):
+        from radoslist import list_objects, aio_read_window
+
+        cluster, ioctx = open_rados()
+        try:
+            objects = ((nspace, name) for nspace, name
+                       in list_objects(ioctx, prefix, namespace)
+                       if is_header_candidate(name))
+            for _, name, header in aio_read_window(ioctx, objects,
+                                                   MAP_HEADER_SIZE, jobs):
+                volume = parse_volume_header(name, header)
+                if volume is not None:
+                    yield volume
+        finally:
+            ioctx.close()
+            cluster.shutdown()
+    elif isinstance(peers['blockerm'], Filed):
+        from multiprocessing.pool import ThreadPool
+
+        def read_header(entry):
+            name, path = entry
+            try:
+                with open(path, 'rb') as f:
+                    return name, f.read(MAP_HEADER_SIZE)
+            except (IOError, OSError):
+                return name, None
+
+        candidates = filed_header_candidates(peers['blockerm'].archip_dir)
+        if prefix is not None:
+            candidates = (c for c in candidates if c[0].startswith(prefix))
+        pool = ThreadPool(jobs)
+        try:
+            for name, header in pool.imap_unordered(read_header, candidates,
+                                                    chunksize=64):
+                if header is None:
+                    continue
+                volume = parse_volume_header(name, header)
+                if volume is not None:
+                    yield volume
+        finally:
+            pool.terminate()
+    else:
+        raise Error("Invalid storage")
+
+
+def list_volumes(cli=False, jobs=16, use_catalog=True, prefix=None,
+                 namespace=None, **kwargs):
+    """
+    Quick 'n dirty way to list volumes. This bypasses the archipelago
+    infrastructure and goes directly to storage.
+
+    The volumes are answered from the catalog, refreshed with the changes
+    since its last use. The storage is scanned instead if use_catalog is
+    False, the catalog cannot be opened, or the scan is limited to a prefix
+    or namespace.
+    """
 
     def get_volumes():
-        Volume = namedtuple('Volume', ['name', 'version', 'header_object',
-                                       'readonly', 'deleted'])
-        if isinstance(peers['blockerm'], Radosd):
-            import rados
-            cluster = rados.Rados(rados_id=peers['blockerm'].cephx_id,
-                                  conffile=config['CEPH_CONF_FILE'])
-            cluster.connect()
-            ioctx = cluster.open_ioctx(peers['blockerm'].pool)
-            oi = rados.ObjectIterator(ioctx)
-            for o in oi:
-                name = o.key
-                try:
-                    header = ioctx.read(name, length=MAX_HEADER_SIZE)
-                    ph = parse_header(name, header)
-                    if ph is None:
-                        continue
-                    (version, readonly, deleted) = ph
-                    volume = name
-                    if volume.startswith(ARCHIP_PREFIX):
-                        volume = volume[len(ARCHIP_PREFIX):]
-                    yield Volume(name=volume, version=version,
-                                 header_object=name, deleted=deleted,
-                                 readonly=readonly)
-                except:
-                    pass
-        elif isinstance(peers['blockerm'], Filed):
-            path = peers['blockerm'].archip_dir
-            for root, dirs, files in os.walk(path):
-                for f in files:
-                    name = f
-                    try:
-                        f = open(os.path.join(root, f), 'r')
-                        header = f.read(MAX_HEADER_SIZE)
-                        f.close()
-                        ph = parse_header(name, header)
-                        if ph is None:
-                            continue
-                        (version, readonly, deleted) = ph
-                        volume = name
-                        if volume.startswith(ARCHIP_PREFIX):
-                            volume = volume[len(ARCHIP_PREFIX):]
-                        yield Volume(name=volume, version=version,
-                                     header_object=name, deleted=deleted,
-                                     readonly=readonly)
-                    except:
-                        pass
-        else:
-            raise Error("Invalid storage")
+        catalog = None
+        if use_catalog and prefix is None and namespace is None:
+            from catalog import Catalog
+            try:
+                catalog = Catalog()
+            except Error:
+                pass
+        if catalog is None:
+            for volume in scan_volumes(jobs, prefix, namespace):
+                yield volume
+            return
+        try:
+            catalog.refresh(jobs=jobs)
+            volumes = catalog.volumes()
+        finally:
+            catalog.close()
+        for volume in volumes:
+            yield volume
 
     if not cli:
         return get_volumes()
@@ -338,15 +589,19 @@ def remove(name, assume_v0=False, v0_size=-1, **kwargs):
                     device))
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    vport = peers['vlmcd'].portno_start
-    req = Request.get_delete_request(xseg_ctx, vport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        vport = get_peer_port('vlmcd', xseg_ctx, name)
+        req = Request.get_delete_request(xseg_ctx, vport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc removal failed")
 
@@ -357,15 +612,19 @@ def update_volume(name, assume_v0=False, v0_size=-1, **kwargs):
         raise Error("Invalid volume name")
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    mport = peers['mapperd'].portno_start
-    req = Request.get_update_request(xseg_ctx, mport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        req = Request.get_update_request(xseg_ctx, mport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc update failed")
 
@@ -384,8 +643,9 @@ def map_volume(name, assume_v0=False, v0_size=-1, readonly=False, **kwargs):
                     '/dev/xen/blktap-2/tapdev', device))
 
     try:
-        device = VlmcTapdisk.create(name, vport=peers['vlmcd'].portno_start,
-                                    mport=peers['mapperd'].portno_start,
+        device = VlmcTapdisk.create(name, vport=get_peer_port('vlmcd',
+                                                              name=name),
+                                    mport=get_peer_port('mapperd', name=name),
                                     assume_v0=assume_v0, v0_size=v0_size,
                                     readonly=readonly)
         if device:
@@ -430,14 +690,18 @@ def lock(name, cli=False, **kwargs):
     if not is_valid_name(name):
         raise Error("Invalid volume name")
 
-    xseg_ctx = Xseg_ctx(get_segment())
-    mbport = peers['blockerm'].portno_start
-    req = Request.get_acquire_request(xseg_ctx, mbport, name)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mbport = peers['blockerm'].portno_start
+        req = Request.get_acquire_request(xseg_ctx, mbport, name)
+        try:
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc lock failed")
     if cli:
@@ -451,14 +715,18 @@ def unlock(name, force=False, cli=False, **kwargs):
     if not is_valid_name(name):
         raise Error("Invalid volume name")
 
-    xseg_ctx = Xseg_ctx(get_segment())
-    mbport = peers['blockerm'].portno_start
-    req = Request.get_release_request(xseg_ctx, mbport, name, force=force)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mbport = peers['blockerm'].portno_start
+        req = Request.get_release_request(xseg_ctx, mbport, name, force=force)
+        try:
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc unlock failed")
     if cli:
@@ -473,15 +741,19 @@ def open_volume(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
         raise Error("Invalid volume name")
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    vport = peers['vlmcd'].portno_start
-    req = Request.get_open_request(xseg_ctx, vport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        vport = get_peer_port('vlmcd', xseg_ctx, name)
+        req = Request.get_open_request(xseg_ctx, vport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc open failed")
     if cli:
@@ -496,15 +768,19 @@ def close_volume(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
         raise Error("Invalid volume name")
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    vport = peers['vlmcd'].portno_start
-    req = Request.get_close_request(xseg_ctx, vport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        vport = get_peer_port('vlmcd', xseg_ctx, name)
+        req = Request.get_close_request(xseg_ctx, vport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc close failed")
     if cli:
@@ -519,17 +795,21 @@ def info(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
         raise Error("Invalid volume name")
 
     ret = False
-    xseg_ctx = Xseg_ctx(get_segment())
-    mport = peers['mapperd'].portno_start
-    req = Request.get_info_request(xseg_ctx, mport, name)
-    parse_assume_v0(req, assume_v0, v0_size)
-    req.submit()
-    req.wait()
-    ret = req.success()
-    if ret:
-        size = req.get_data(xseg_reply_info).contents.size
-    req.put()
-    xseg_ctx.shutdown()
+    xseg_ctx = get_xseg_ctx()
+    try:
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        req = Request.get_info_request(xseg_ctx, mport, name)
+        try:
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            req.wait()
+            ret = req.success()
+            if ret:
+                size = req.get_data(api.xseg_reply_info).contents.size
+        finally:
+            req.put()
+    finally:
+        put_xseg_ctx(xseg_ctx)
     if not ret:
         raise Error("vlmc info failed")
     if cli:
@@ -538,5 +818,857 @@ def info(name, cli=False, assume_v0=False, v0_size=-1, **kwargs):
     return size
 
 
-def mapinfo(name, verbose=False, **kwargs):
-    raise Error("Unimplemented")
+MAP_WINDOW = 1 << 30
+MAP_DEPTH = 8
+MAP_HEADER_SIZE = 32
+
+MapObject = namedtuple('MapObject', ['index', 'offset', 'size', 'target',
+                                     'zero'])
+MapHeader = namedtuple('MapHeader', ['version', 'size', 'blocksize', 'flags',
+                                     'epoch', 'header_object'])
+Extent = namedtuple('Extent', ['index', 'offset', 'size', 'count', 'state',
+                               'source'])
+
+object_name_re = re.compile('^(.*)_([0-9a-f]{16})_([0-9a-f]{16})$')
+
+
+def read_map_header(xseg_ctx, name):
+    """Read the header of a version 2 map from the storage, or return None
+    for older maps.
+
+    Like mapperd, the map is looked up by the name of the volume first, and
+    then, for legacy maps, with the archip_ prefix.
+    """
+    mbport = peers['blockerm'].portno_start
+    for header_object in (name, ARCHIP_PREFIX + name):
+        req = Request.get_read_request(xseg_ctx, mbport, header_object,
+                                       size=MAP_HEADER_SIZE,
+                                       datalen=MAP_HEADER_SIZE)
+        try:
+            req.submit()
+            req.wait()
+            if not req.success():
+                continue
+            header = req.data_view()[:MAP_HEADER_SIZE].tobytes()
+        finally:
+            req.put()
+        break
+    else:
+        raise Error("Cannot read map header of %s" % name)
+    signature_on_disk = pack(">L", int(hexlify(b'AMF.'), base=16))
+    if header[0:4] != signature_on_disk:
+        return None
+    _, version, size, blocksize, flags, epoch = unpack(">LLQLLQ", header)
+    return MapHeader(version, size, blocksize, flags, epoch, header_object)
+
+
+def map_objects(xseg_ctx, name, size, window=MAP_WINDOW, depth=MAP_DEPTH,
+                assume_v0=False, v0_size=-1):
+    """Yield a MapObject for every object of a volume.
+
+    The map is read with X_MAPR requests over windows of window bytes, up to
+    depth of which are kept in flight.
+    """
+    from collections import deque
+
+    mport = get_peer_port('mapperd', xseg_ctx, name)
+
+    def submit(offset):
+        req = Request.get_mapr_request(xseg_ctx, mport, name, offset=offset,
+                                       size=min(window, size - offset))
+        parse_assume_v0(req, assume_v0, v0_size)
+        req.submit()
+        return req
+
+    def complete(req, index, offset):
+        try:
+            req.wait()
+            if not req.success():
+                raise Error("Cannot read map of volume %s" % name)
+            reply = req.get_data(api.xseg_reply_map).contents
+            SegsArray = api.xseg_reply_map_scatterlist * reply.cnt
+            segs = SegsArray.from_address(addressof(reply.segs))
+            objects = []
+            for seg in segs:
+                objects.append(MapObject(index, offset, seg.size,
+                                         string_at(seg.target, seg.targetlen),
+                                         bool(seg.flags &
+                                              api.XF_MAPFLAG_ZERO)))
+                index += 1
+                offset += seg.size
+        finally:
+            req.put()
+        if not objects:
+            raise Error("Empty map reply for volume %s" % name)
+        return objects
+
+    inflight = deque()
+    windows = iter(xrange(0, size, window))
+    index = 0
+    offset = 0
+    try:
+        for wstart in windows:
+            inflight.append(submit(wstart))
+            if len(inflight) < depth:
+                continue
+            objects = complete(inflight.popleft(), index, offset)
+            index, offset = index + len(objects), objects[-1].offset + \
+                objects[-1].size
+            for obj in objects:
+                yield obj
+        while inflight:
+            objects = complete(inflight.popleft(), index, offset)
+            index, offset = index + len(objects), objects[-1].offset + \
+                objects[-1].size
+            for obj in objects:
+                yield obj
+    finally:
+        while inflight:
+            req = inflight.popleft()
+            req.wait()
+            req.put()
+
+
+def object_state(name, obj, epoch=None):
+    """Return the state of an object of a volume and the volume it
+    originates from.
+
+    Objects are 'zero', 'writable', if named after the map of the volume and
+    its current epoch, or 'shared' otherwise, in which case they are copied
+    up on write. name is the header object of the map, which differs from
+    the volume for legacy archip_ maps. The epoch is only known for version
+    2 maps. Without it, all the objects named after the map are considered
+    writable.
+    """
+    if obj.zero:
+        return 'zero', None
+    m = object_name_re.match(obj.target)
+    if m is None:
+        # Content addressed object
+        return 'shared', None
+    source = m.group(1)
+    if source != name:
+        return 'shared', source
+    if epoch is not None and int(m.group(2), 16) != epoch:
+        return 'shared', source
+    return 'writable', source
+
+
+def map_extents(xseg_ctx, name, size, epoch=None, header_object=None,
+                **kwargs):
+    """Merge contiguous objects of the same state and origin in Extents.
+    header_object defaults to name. Keyword arguments are passed to
+    map_objects."""
+    owner = header_object or name
+    extent = None
+    for obj in map_objects(xseg_ctx, name, size, **kwargs):
+        state, source = object_state(owner, obj, epoch)
+        if extent is not None and extent.state == state and \
+           extent.source == source:
+            extent = extent._replace(size=extent.size + obj.size,
+                                     count=extent.count + 1)
+            continue
+        if extent is not None:
+            yield extent
+        extent = Extent(obj.index, obj.offset, obj.size, 1, state, source)
+    if extent is not None:
+        yield extent
+
+
+def mapinfo(name, verbose=False, json_output=False, window=None,
+            depth=MAP_DEPTH, assume_v0=False, v0_size=-1, cli=False,
+            **kwargs):
+    """Show the objects of a volume, merged in extents of the same state and
+    origin. With verbose, every object is listed instead.
+
+    The output is streamed, as text or as a single JSON document.
+    """
+    import json
+
+    if not is_valid_name(name):
+        raise Error("Invalid volume name")
+    window = (window << 20) if window else MAP_WINDOW
+    if window <= 0 or depth <= 0:
+        raise Error("Invalid window or depth")
+
+    size = info(name, assume_v0=assume_v0, v0_size=v0_size)
+    xseg_ctx = get_xseg_ctx()
+    try:
+        try:
+            header = read_map_header(xseg_ctx, name)
+        except Error:
+            header = None
+        epoch = header.epoch if header is not None else None
+        owner = header.header_object if header is not None else name
+        args = dict(window=window, depth=depth, assume_v0=assume_v0,
+                    v0_size=v0_size)
+        if verbose:
+            items = ((obj, ) + object_state(owner, obj, epoch)
+                     for obj in map_objects(xseg_ctx, name, size, **args))
+        else:
+            items = map_extents(xseg_ctx, name, size, epoch, owner, **args)
+
+        summary = {'zero': 0, 'shared': 0, 'writable': 0}
+        out = sys.stdout
+        if json_output:
+            out.write('{"volume": %s, "size": %d, "epoch": %s, "%s": [' %
+                      (json.dumps(name), size, json.dumps(epoch),
+                       "objects" if verbose else "extents"))
+        else:
+            out.write("Volume: %s, size: %d%s\n" %
+                      (name, size,
+                       ", epoch: %d" % epoch if epoch is not None else ""))
+        sep = "\n  "
+        for item in items:
+            if verbose:
+                obj, state, source = item
+                summary[state] += 1
+                d = {'index': obj.index, 'offset': obj.offset,
+                     'size': obj.size, 'state': state, 'object': obj.target}
+                line = "%8d %14d %10d %-8s %s" % (obj.index, obj.offset,
+                                                   obj.size, state,
+                                                   obj.target)
+            else:
+                summary[item.state] += item.count
+                d = item._asdict()
+                line = "%8d-%-8d %14d %14d %-8s %s" % (
+                    item.index, item.index + item.count - 1, item.offset,
+                    item.size, item.state, item.source or "-")
+            if json_output:
+                out.write(sep + json.dumps(d))
+                sep = ",\n  "
+            else:
+                out.write(line + "\n")
+        if json_output:
+            out.write('\n], "summary": %s}\n' % json.dumps(summary))
+        else:
+            out.write("Objects: %d zero, %d shared, %d writable\n" %
+                      (summary['zero'], summary['shared'],
+                       summary['writable']))
+        out.flush()
+    finally:
+        put_xseg_ctx(xseg_ctx)
+    return summary
+
+
+def shared_ranges(xseg_ctx, name, size, epoch=None, batch=16,
+                  header_object=None, **kwargs):
+    """Yield (offset, size, count) ranges of up to batch contiguous shared
+    objects of a volume. header_object defaults to name. Keyword arguments
+    are passed to map_objects."""
+    owner = header_object or name
+    start = None
+    for obj in map_objects(xseg_ctx, name, size, **kwargs):
+        state, _ = object_state(owner, obj, epoch)
+        if state == 'shared' and start is not None and count < batch:
+            count += 1
+            end += obj.size
+            continue
+        if start is not None:
+            yield start, end - start, count
+            start = None
+        if state == 'shared':
+            start, end, count = obj.offset, obj.offset + obj.size, 1
+    if start is not None:
+        yield start, end - start, count
+
+
+def flatten(name, jobs=4, batch=16, rate=0, assume_v0=False, v0_size=-1,
+            cli=False, **kwargs):
+    """Copy up all the shared objects of a volume, so that it no longer
+    depends on the snapshot it was cloned from.
+
+    Every batch of contiguous shared objects is written with an X_MAPW
+    request to mapperd, which copies the objects and updates the map, and up
+    to jobs of them are kept in flight. Rate limits the number of objects
+    copied per second. An interrupted flatten can simply be run again, since
+    copied objects are no longer shared.
+    """
+    from collections import deque
+
+    if not is_valid_name(name):
+        raise Error("Invalid volume name")
+    if jobs <= 0 or batch <= 0 or rate < 0:
+        raise Error("Invalid jobs, batch or rate")
+
+    size = info(name, assume_v0=assume_v0, v0_size=v0_size)
+    xseg_ctx = get_xseg_ctx()
+    inflight = deque()
+    copied = 0
+    try:
+        try:
+            header = read_map_header(xseg_ctx, name)
+        except Error:
+            header = None
+        epoch = header.epoch if header is not None else None
+        owner = header.header_object if header is not None else name
+        mport = get_peer_port('mapperd', xseg_ctx, name)
+        ranges = shared_ranges(xseg_ctx, name, size, epoch, batch, owner,
+                               assume_v0=assume_v0, v0_size=v0_size)
+
+        def complete():
+            req, count = inflight.popleft()
+            try:
+                req.wait()
+                if not req.success():
+                    raise Error("Flatten of %s failed at offset %d, %d "
+                                "objects copied" %
+                                (name, req.get_offset(), copied))
+            finally:
+                req.put()
+            return count
+
+        started = time.time()
+        submitted = 0
+        for offset, length, count in ranges:
+            if rate:
+                delay = started + float(submitted) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            req = Request.get_mapw_request(xseg_ctx, mport, name,
+                                           offset=offset, size=length)
+            parse_assume_v0(req, assume_v0, v0_size)
+            req.submit()
+            inflight.append((req, count))
+            submitted += count
+            if len(inflight) >= jobs:
+                copied += complete()
+                if cli:
+                    sys.stdout.write("\rCopied %d objects" % copied)
+                    sys.stdout.flush()
+        while inflight:
+            copied += complete()
+    finally:
+        while inflight:
+            req, _ = inflight.popleft()
+            req.wait()
+            req.put()
+        put_xseg_ctx(xseg_ctx)
+
+    if cli:
+        sys.stdout.write("\rCopied %d objects. Volume %s flattened\n" %
+                         (copied, name))
+    return copied
+
+
+def du(names=None, json_output=False, cli=False, **kwargs):
+    """Account for the space of volumes and snapshots.
+
+    All the maps of the storage are read offline, and every object that is
+    not zero is counted as exclusive, if no other map references it, or
+    shared otherwise. The charged objects split every shared object evenly
+    among the maps that reference it. Sizes are in whole objects.
+
+    Returns a list of dicts, one per volume, for the given names or for all
+    volumes.
+    """
+    import json
+    from mapreader import open_store, MapReader, map_run, count_runs, \
+        run_counts
+
+    volumes = {}
+    for v in list_volumes(use_catalog=True):
+        if not v.deleted:
+            volumes.setdefault(v.name, v)
+
+    store = open_store()
+    runs = []
+    maps = []
+    try:
+        for name in sorted(volumes):
+            reader = MapReader(store, name)
+            run, zero = map_run(reader)
+            runs.append(run)
+            maps.append((volumes[name], reader.header, zero))
+    finally:
+        store.close()
+
+    keys, counts = count_runs(runs)
+    results = []
+    for run, (volume, header, zero) in zip(runs, maps):
+        if names and volume.name not in names:
+            continue
+        refs = run_counts(run, keys, counts)
+        exclusive = sum(1 for c in refs if c == 1)
+        charged = sum(1.0 / c for c in refs)
+        results.append({'volume': volume.name,
+                        'snapshot': bool(volume.readonly),
+                        'version': header.version,
+                        'blocksize': header.blocksize,
+                        'objects': header.nr_objs,
+                        'zero': zero,
+                        'exclusive': exclusive,
+                        'shared': len(run) - exclusive,
+                        'charged': charged})
+    if names:
+        missing = set(names) - set(r['volume'] for r in results)
+        if missing:
+            raise Error("No such volumes: %s" % ", ".join(sorted(missing)))
+
+    if cli:
+        if json_output:
+            sys.stdout.write(json.dumps({'volumes': results,
+                                         'objects': len(keys)}) + "\n")
+        else:
+            mb = lambda r, k: r[k] * r['blocksize'] / float(1 << 20)
+            sys.stdout.write("%-32s %-4s %10s %10s %12s %12s %12s\n" %
+                             ("volume", "snap", "objects", "zero",
+                              "excl (MB)", "shared (MB)", "charged (MB)"))
+            for r in results:
+                sys.stdout.write("%-32s %-4s %10d %10d %12.1f %12.1f "
+                                 "%12.1f\n" %
+                                 (r['volume'], "yes" if r['snapshot'] else "",
+                                  r['objects'], r['zero'],
+                                  mb(r, 'exclusive'), mb(r, 'shared'),
+                                  mb(r, 'charged')))
+            sys.stdout.write("%d distinct objects referenced\n" % len(keys))
+    return results
+
+
+def diff(snap_a, snap_b, path='-', binary=False, cli=False, **kwargs):
+    """Write the extents of snap_b that changed since snap_a to path, or
+    stdout.
+
+    The maps are read offline and compared object by object. The output is
+    a JSON line with the size and the block size of snap_b, followed by one
+    JSON line per extent, or the binary form of mapdiff.write_diff.
+
+    Returns the number of changed extents and their total length.
+    """
+    import json
+    from mapreader import open_store, MapReader, MF_MAP_READONLY
+    from mapdiff import diff_maps, write_diff
+
+    store = open_store()
+    dst = None
+    try:
+        a = MapReader(store, snap_a)
+        b = MapReader(store, snap_b)
+        if b.version == 2 and not b.flags & MF_MAP_READONLY:
+            sys.stderr.write("Warning: %s is not a snapshot, the diff may "
+                             "be stale\n" % snap_b)
+        dst = _open_stream(path, 'wb')
+        totals = [0, 0]
+
+        def extents():
+            for e in diff_maps(a, b):
+                totals[0] += 1
+                totals[1] += e.length
+                yield e
+
+        if binary:
+            write_diff(dst, extents(), b.size, b.blocksize)
+        else:
+            dst.write(json.dumps({'from': snap_a, 'to': snap_b,
+                                  'size': b.size,
+                                  'blocksize': b.blocksize}) + "\n")
+            for e in extents():
+                dst.write(json.dumps(e._asdict()) + "\n")
+    finally:
+        if dst is not None:
+            dst.close()
+        store.close()
+
+    if cli and path != '-':
+        sys.stdout.write("%d extents changed, %d bytes\n" % tuple(totals))
+    return totals[0], totals[1]
+
+
+def _open_stream(path, mode):
+    import io
+    if path == '-':
+        stream = sys.stdin if mode == 'rb' else sys.stdout
+        return io.open(stream.fileno(), mode, closefd=False)
+    return io.open(path, mode)
+
+
+def zero_ranges(xseg_ctx, name, size, **kwargs):
+    """Return the (start, end) byte ranges of a volume that read as zeros,
+    merged and in order. Keyword arguments are passed to map_objects."""
+    from collections import deque
+
+    ranges = deque()
+    for extent in map_extents(xseg_ctx, name, size, **kwargs):
+        if extent.state != 'zero':
+            continue
+        if ranges and ranges[-1][1] == extent.offset:
+            ranges[-1] = (ranges[-1][0], extent.offset + extent.size)
+        else:
+            ranges.append((extent.offset, extent.offset + extent.size))
+    return ranges
+
+
+def import_volume(name, path='-', iodepth=16, blocksize=1024, sparse=True,
+                  assume_v0=False, v0_size=-1, cli=False, **kwargs):
+    """Copy a raw image from path, or stdin, to an existing volume.
+
+    When sparse is set, blocks that contain only zeros are skipped where the
+    map of the volume tells that it reads as zeros already, and written
+    elsewhere.
+    """
+    from volumeio import VolumeIO
+
+    if not is_valid_name(name):
+        raise Error("Invalid volume name")
+    if iodepth <= 0:
+        raise Error("Invalid I/O depth")
+    blocksize *= 1024
+    if blocksize <= 0:
+        raise Error("Invalid block size")
+
+    src = _open_stream(path, 'rb')
+    vio = None
+    try:
+        vio = VolumeIO(name, 'r+', iodepth=iodepth, blocksize=blocksize,
+                       assume_v0=assume_v0, v0_size=v0_size)
+        if sparse:
+            zeros_in_volume = zero_ranges(vio.xseg_ctx, name, vio.size,
+                                          assume_v0=assume_v0,
+                                          v0_size=v0_size)
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        zeros = bytearray(blocksize)
+        written = skipped = 0
+        while True:
+            n = 0
+            while n < blocksize:
+                r = src.readinto(view[n:])
+                if not r:
+                    break
+                n += r
+            if n == 0:
+                break
+            if not sparse:
+                is_zero = False
+            elif n == blocksize:
+                is_zero = buf == zeros
+            else:
+                is_zero = buf[:n] == zeros[:n]
+            if is_zero:
+                # Ranges the import is past are no longer of interest
+                pos = vio.tell()
+                while zeros_in_volume and zeros_in_volume[0][1] <= pos:
+                    zeros_in_volume.popleft()
+                is_zero = bool(zeros_in_volume) and \
+                    zeros_in_volume[0][0] <= pos and \
+                    pos + n <= zeros_in_volume[0][1]
+            if is_zero:
+                vio.seek(n, os.SEEK_CUR)
+                skipped += n
+            else:
+                vio.write(view[:n])
+                written += n
+            if n < blocksize:
+                break
+        vio.close()
+    finally:
+        if vio is not None:
+            try:
+                vio.close()
+            except Error:
+                pass
+        if path != '-':
+            src.close()
+
+    if cli:
+        sys.stdout.write("Imported %d bytes (%d bytes skipped as zeros)\n" %
+                         (written + skipped, skipped))
+    return written, skipped
+
+
+def export_volume(name, path='-', iodepth=16, blocksize=1024, sparse=True,
+                  assume_v0=False, v0_size=-1, cli=False, **kwargs):
+    """Copy the contents of a volume to path, or stdout.
+
+    Unallocated objects are left as holes when the output is seekable, and
+    are written out as zeros otherwise.
+    """
+    from volumeio import VolumeIO
+
+    if not is_valid_name(name):
+        raise Error("Invalid volume name")
+    if iodepth <= 0:
+        raise Error("Invalid I/O depth")
+    blocksize *= 1024
+    if blocksize <= 0:
+        raise Error("Invalid block size")
+
+    dst = _open_stream(path, 'wb')
+    vio = None
+    try:
+        vio = VolumeIO(name, 'r', iodepth=iodepth, blocksize=blocksize,
+                       assume_v0=assume_v0, v0_size=v0_size)
+        seekable = dst.seekable()
+        # Read iodepth blocks at once, so that VolumeIO keeps them in flight
+        buf = bytearray(blocksize * iodepth)
+        view = memoryview(buf)
+        zeros = bytearray(blocksize)
+        holes = 0
+        for extent in map_extents(vio.xseg_ctx, name, vio.size,
+                                  assume_v0=assume_v0, v0_size=v0_size):
+            offset, length = extent.offset, extent.size
+            zero = extent.state == 'zero'
+            if zero and sparse and seekable:
+                dst.seek(length, os.SEEK_CUR)
+                holes += length
+                continue
+            if zero:
+                while length > 0:
+                    n = min(length, blocksize)
+                    dst.write(zeros[:n])
+                    length -= n
+                continue
+            vio.seek(offset)
+            end = offset + length
+            while vio.tell() < end:
+                n = vio.readinto(view[:min(len(buf), end - vio.tell())])
+                if not n:
+                    raise Error("Short read on volume %s" % name)
+                dst.write(view[:n])
+        if seekable:
+            dst.truncate(vio.size)
+        dst.flush()
+        size = vio.size
+    finally:
+        if vio is not None:
+            vio.close()
+        if path != '-':
+            dst.close()
+
+    if cli:
+        sys.stderr.write("Exported %d bytes (%d bytes left as holes)\n" %
+                         (size, holes))
+    return size, holes
+
+
+def backup(snap, base=None, path='-', iodepth=16, blocksize=1024, cli=False,
+           **kwargs):
+    """Write the extents of snapshot snap that changed since snapshot base,
+    or all of its extents if base is None, to an archive at path, or stdout.
+    Zero ranges are archived as zero extents, so that a full archive
+    overwrites whatever the volume it is restored to held.
+
+    The maps are compared offline and only the changed extents are read
+    from the snapshot, with X_READ requests sent to vlmcd.
+    """
+    from volumeio import VolumeIO
+    from mapreader import open_store, MapReader, MF_MAP_READONLY
+    from mapdiff import diff_maps
+    from backup import write_archive
+
+    if iodepth <= 0:
+        raise Error("Invalid I/O depth")
+    blocksize *= 1024
+    if blocksize <= 0:
+        raise Error("Invalid block size")
+
+    store = open_store()
+    dst = None
+    vio = None
+    try:
+        b = MapReader(store, snap)
+        if b.version == 2 and not b.flags & MF_MAP_READONLY:
+            raise Error("%s is not a snapshot" % snap)
+        a = MapReader(store, base) if base is not None else None
+        vio = VolumeIO(snap, 'r', iodepth=iodepth, blocksize=blocksize)
+        dst = _open_stream(path, 'wb')
+        count, written = write_archive(dst, vio, diff_maps(a, b), snap, base,
+                                       b.size, b.blocksize,
+                                       bufsize=blocksize * iodepth)
+        dst.flush()
+    finally:
+        if vio is not None:
+            vio.close()
+        if dst is not None and path != '-':
+            dst.close()
+        store.close()
+
+    if cli:
+        sys.stderr.write("Archived %d extents, %d bytes of data\n" %
+                         (count, written))
+    return count, written
+
+
+def restore(name, paths, iodepth=16, blocksize=1024, cli=False, **kwargs):
+    """Apply a chain of archives, in order, to volume name.
+
+    Every archive must have been taken with the snapshot of the previous
+    one as its base. The volume is expected to hold the base of the first
+    archive already, unless the first archive is a full one.
+
+    Archive files are checked in full before the volume is written to. An
+    archive read from stdin can only be checked an extent at a time, as it
+    is applied.
+    """
+    from volumeio import VolumeIO
+    from backup import read_archive_header, apply_archive, verify_archive
+
+    if not is_valid_name(name):
+        raise Error("Invalid volume name")
+    if not paths:
+        raise Error("No archives to restore")
+    if paths.count('-') > 1:
+        raise Error("Only one archive can be read from stdin")
+    if iodepth <= 0:
+        raise Error("Invalid I/O depth")
+    blocksize *= 1024
+    if blocksize <= 0:
+        raise Error("Invalid block size")
+
+    archives = []
+    vio = None
+    try:
+        previous = None
+        for path in paths:
+            src = _open_stream(path, 'rb')
+            archives.append((path, src))
+            info = read_archive_header(src)
+            if previous is not None and info['base'] != previous['snapshot']:
+                raise Error("Archive %s is based on %s, not on %s" %
+                            (path, info['base'], previous['snapshot']))
+            previous = info
+            if path != '-':
+                start = src.tell()
+                verify_archive(src, bufsize=blocksize * iodepth)
+                src.seek(start)
+        vio = VolumeIO(name, 'r+', iodepth=iodepth, blocksize=blocksize)
+        if vio.size < previous['size']:
+            raise Error("Volume %s is smaller than snapshot %s" %
+                        (name, previous['snapshot']))
+        count = written = 0
+        for path, src in archives:
+            c, w = apply_archive(src, vio, bufsize=blocksize * iodepth)
+            count += c
+            written += w
+            if cli:
+                sys.stderr.write("Applied %s: %d extents, %d bytes of "
+                                 "data\n" % (path, c, w))
+        vio.flush()
+    finally:
+        if vio is not None:
+            vio.close()
+        for path, src in archives:
+            if path != '-':
+                src.close()
+
+    return count, written
+
+
+BATCH_OPS = ('create', 'clone', 'snapshot', 'remove', 'rm', 'rename', 'info')
+
+
+def parse_batch_line(line, parser=None):
+    """Parse a batch line to a (func, kwargs) tuple, or None for empty lines
+    and comments.
+
+    Lines use the syntax of the respective vlmc commands, e.g.:
+
+        create myvolume -s 10240
+        snapshot myvolume mysnap
+        info myvolume
+
+    plus "clone <snapshot> <volume> [-s size]", a shortcut for
+    "create <volume> --snap <snapshot> [-s size]".
+    """
+    import shlex
+    from cli import vlmc_parser, BatchArgumentParser
+
+    try:
+        args = shlex.split(line, comments=True)
+    except ValueError as e:
+        raise Error("Invalid batch line: %s" % e)
+    if not args:
+        return None
+    if args[0] not in BATCH_OPS:
+        raise Error("Invalid batch operation '%s'" % args[0])
+    if args[0] == 'clone':
+        if len(args) < 3:
+            raise Error("clone needs a snapshot and a volume name")
+        args = ['create', args[2], '--snap', args[1]] + args[3:]
+    if parser is None:
+        parser = vlmc_parser(parser_class=BatchArgumentParser)
+    kwargs = vars(parser.parse_args(args))
+    func = kwargs.pop('func')
+    kwargs.pop('config', None)
+    kwargs.pop('wait_policy', None)
+    return func, kwargs
+
+
+def run_batch(operations, max_workers=8):
+    """Run (func, kwargs) operations over a shared context, with up to
+    max_workers of them in parallel.
+
+    Yields a (result, exception) tuple per operation, in the order of
+    operations, which may be a lazy iterable.
+    """
+    from collections import deque
+
+    def outcome(future):
+        e = future.exception()
+        if e is not None:
+            return None, e
+        return future.result(), None
+
+    window = deque()
+    with XsegExecutor(max_workers=max_workers) as executor:
+        for func, kwargs in operations:
+            window.append(executor.submit(func, **kwargs))
+            if len(window) >= 2 * max_workers:
+                yield outcome(window.popleft())
+        while window:
+            yield outcome(window.popleft())
+
+
+def batch(path='-', max_workers=8, cli=False, **kwargs):
+    """Run the operations listed in path, or stdin, one per line, and report
+    the outcome of each line"""
+    from cli import vlmc_parser, BatchArgumentParser
+
+    if max_workers <= 0:
+        raise Error("Invalid number of jobs")
+
+    parser = vlmc_parser(parser_class=BatchArgumentParser)
+    src = sys.stdin if path == '-' else open(path)
+    lines = []
+
+    def operations():
+        for lineno, line in enumerate(src, 1):
+            try:
+                op = parse_batch_line(line, parser)
+            except Error as e:
+                # Lines that do not parse still take their turn, so that
+                # results are reported in order
+                op = (_batch_error, {'error': e})
+            if op is None:
+                continue
+            lines.append(lineno)
+            yield op
+
+    results = []
+    failed = 0
+    try:
+        for result, e in run_batch(operations(), max_workers):
+            lineno = lines[len(results)]
+            results.append((lineno, result, e))
+            if e is not None:
+                failed += 1
+            if not cli:
+                continue
+            if e is not None:
+                sys.stdout.write("%d: %s\n" % (lineno, red("FAILED: %s" % e)))
+            elif result is not None:
+                sys.stdout.write("%d: %s %s\n" % (lineno, green("OK"), result))
+            else:
+                sys.stdout.write("%d: %s\n" % (lineno, green("OK")))
+            sys.stdout.flush()
+    finally:
+        if path != '-':
+            src.close()
+
+    if cli and failed:
+        raise Error("%d of %d operations failed" % (failed, len(results)))
+    return results
+
+
+def _batch_error(error=None, **kwargs):
+    raise error
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import sys
+from collections import deque
+
+from common import *
+
+
+class VolumeIO(object):
+    """File-like access to the data of a volume.
+
+    Data are read and written with X_READ/X_WRITE requests sent to vlmcd,
+    without mapping the volume through blktap. I/O is split in requests of at
+    most blocksize bytes, aligned to blocksize, and up to iodepth requests are
+    kept in flight:
+
+        with VolumeIO('myvolume', 'w') as vio:
+            vio.write(data)
+
+    Writes are asynchronous. Errors of pending writes are reported by the
+    next read, flush() or close().
+    """
+    def __init__(self, name, mode='r', iodepth=16, blocksize=1 << 20,
+                 assume_v0=False, v0_size=-1):
+        if mode not in ('r', 'w', 'r+'):
+            raise Error("Invalid mode '%s'" % mode)
+        if iodepth <= 0:
+            raise Error("Invalid I/O depth")
+        if blocksize <= 0:
+            raise Error("Invalid block size")
+
+        self.name = name
+        self.mode = mode
+        self.writable = mode != 'r'
+        self.iodepth = iodepth
+        self.blocksize = blocksize
+        self.flags = 0
+        self.v0_size = -1
+        if assume_v0:
+            self.flags |= api.XF_ASSUMEV0
+            self.v0_size = v0_size
+        self.pos = 0
+        self.writes = deque()
+        self.closed = False
+
+        self.xseg_ctx = get_xseg_ctx()
+        try:
+            self.vport = get_peer_port('vlmcd', self.xseg_ctx, name)
+            self.size = self.__get_size()
+            if self.writable:
+                self.__send(Request.get_open_request(self.xseg_ctx,
+                                                     self.vport, name),
+                            "Cannot open volume %s" % name)
+        except:
+            put_xseg_ctx(self.xseg_ctx)
+            self.xseg_ctx = None
+            self.closed = True
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def __send(self, req, errmsg):
+        req.set_flags(req.get_flags() | self.flags)
+        req.set_v0_size(self.v0_size)
+        try:
+            req.submit()
+            req.wait()
+            if not req.success():
+                raise Error(errmsg)
+        finally:
+            req.put()
+        return req
+
+    def __get_size(self):
+        mport = get_peer_port('mapperd', self.xseg_ctx, self.name)
+        req = Request.get_info_request(self.xseg_ctx, mport, self.name)
+        req.set_flags(req.get_flags() | self.flags)
+        req.set_v0_size(self.v0_size)
+        try:
+            req.submit()
+            req.wait()
+            if not req.success():
+                raise Error("Cannot get info of volume %s" % self.name)
+            return req.get_data(api.xseg_reply_info).contents.size
+        finally:
+            req.put()
+
+    def __check_open(self):
+        if self.closed:
+            raise Error("I/O operation on closed volume")
+
+    def __chunks(self, offset, size):
+        """Split an I/O range in blocksize aligned chunks"""
+        end = offset + size
+        while offset < end:
+            chunk = self.blocksize - offset % self.blocksize
+            if chunk > end - offset:
+                chunk = end - offset
+            yield offset, chunk
+            offset += chunk
+
+    def __new_request(self, op, offset, size):
+        req = Request(self.xseg_ctx, self.vport, self.name, op=op,
+                      offset=offset, size=size, datalen=size,
+                      flags=self.flags, v0_size=self.v0_size)
+        req.submit()
+        return req
+
+    def __complete_write(self, req):
+        try:
+            req.wait()
+            if not req.success():
+                raise Error("Write on volume %s at offset %d failed" %
+                            (self.name, req.get_offset()))
+        finally:
+            req.put()
+
+    def __drain_writes(self):
+        err = None
+        while self.writes:
+            try:
+                self.__complete_write(self.writes.popleft())
+            except Error as e:
+                if err is None:
+                    err = e
+        if err is not None:
+            raise err
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.__check_open()
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise Error("Invalid whence %d" % whence)
+        if offset < 0:
+            raise Error("Invalid offset %d" % offset)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        """Read up to len(b) bytes into the writable buffer b and return the
+        number of bytes read"""
+        self.__check_open()
+        self.__drain_writes()
+        buf = memoryview(b)
+        size = min(len(buf), max(self.size - self.pos, 0))
+        chunks = self.__chunks(self.pos, size)
+        inflight = deque()
+        done = 0
+        try:
+            for offset, chunk in chunks:
+                inflight.append(self.__new_request(api.X_READ, offset,
+                                                   chunk))
+                if len(inflight) < self.iodepth:
+                    continue
+                done += self.__complete_read(inflight.popleft(), buf)
+            while inflight:
+                done += self.__complete_read(inflight.popleft(), buf)
+        finally:
+            while inflight:
+                req = inflight.popleft()
+                req.wait()
+                req.put()
+        self.pos += done
+        return done
+
+    def __complete_read(self, req, buf):
+        try:
+            req.wait()
+            if not req.success():
+                raise Error("Read on volume %s at offset %d failed" %
+                            (self.name, req.get_offset()))
+            size = req.get_size()
+            start = req.get_offset() - self.pos
+            buf[start:start + size] = req.data_view()[:size]
+        finally:
+            req.put()
+        return size
+
+    def read(self, size=-1):
+        self.__check_open()
+        remaining = max(self.size - self.pos, 0)
+        if size < 0 or size > remaining:
+            size = remaining
+        buf = bytearray(size)
+        done = self.readinto(buf)
+        return str(buf[:done])
+
+    def write(self, data):
+        """Write data, which may be any object supporting the buffer
+        protocol, at the current position and return the number of bytes
+        written"""
+        self.__check_open()
+        if not self.writable:
+            raise Error("Volume not open for writing")
+        src = memoryview(data)
+        size = len(src)
+        if self.pos + size > self.size:
+            raise Error("Write beyond the end of volume %s" % self.name)
+        for offset, chunk in self.__chunks(self.pos, size):
+            if len(self.writes) >= self.iodepth:
+                self.__complete_write(self.writes.popleft())
+            req = Request(self.xseg_ctx, self.vport, self.name,
+                          op=api.X_WRITE, offset=offset, size=chunk,
+                          datalen=chunk, flags=self.flags,
+                          v0_size=self.v0_size)
+            start = offset - self.pos
+            req.data_view()[:] = src[start:start + chunk]
+            req.submit()
+            self.writes.append(req)
+        self.pos += size
+        return size
+
+    def flush(self):
+        """Wait for all pending writes and flush the volume"""
+        self.__check_open()
+        if not self.writable:
+            return
+        self.__drain_writes()
+        req = Request(self.xseg_ctx, self.vport, self.name, op=api.X_WRITE,
+                      flags=api.XF_FLUSH)
+        self.__send(req, "Cannot flush volume %s" % self.name)
+
+    def __close_volume(self):
+        self.__send(Request.get_close_request(self.xseg_ctx, self.vport,
+                                              self.name),
+                    "Cannot close volume %s" % self.name)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.writable:
+                try:
+                    self.flush()
+                except:
+                    # Close the volume anyway, but report why the flush
+                    # failed
+                    exc_info = sys.exc_info()
+                    try:
+                        self.__close_volume()
+                    except Error:
+                        pass
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self.__close_volume()
+        finally:
+            self.closed = True
+            put_xseg_ctx(self.xseg_ctx)
+            self.xseg_ctx = None
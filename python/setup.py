@@ -60,6 +60,8 @@ CLASSIFIERS = []
 INSTALL_REQUIRES = ['xseg', 'argparse', 'psutil']
 
 EXTRAS_REQUIRES = {
+    # Event loop integration, see archipelago.aio
+    'aio': ['trollius'],
 }
 
 TESTS_REQUIRES = [
@@ -192,7 +194,7 @@ setup(
     entry_points={
         'console_scripts': [
             'archipelago = archipelago.cli:main',
-            'vlmc = archipelago.cli:main',
+            'vlmc = archipelago.cmdclient:main',
         ],
     }
 )
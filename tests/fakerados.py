@@ -0,0 +1,187 @@
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory stand-in for the subset of the rados module that archipelago uses.
+
+The test cases and the benchmarks import it with this directory on sys.path
+and install it by replacing archipelago.radoslist.rados_module with a function
+that returns it. Objects are kept in the module level pools dictionary, and
+every operation is delayed by latency seconds, to mimic the round trip to the
+OSDs. As with librados, an asynchronous read is bound to the namespace of the
+ioctx at the time it is issued.
+"""
+
+import time
+import errno
+import Queue
+import threading
+
+LIBRADOS_ALL_NSPACES = '\001'
+
+# pool -> namespace -> object name -> [data, mtime]
+pools = {}
+# object name -> errno, returned by asynchronous reads of the object
+failures = {}
+latency = 0.0
+aio_threads = 128
+
+_aio_queue = None
+_aio_lock = threading.Lock()
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+def put(pool, name, data, namespace=''):
+    """Store an object, as a test fixture"""
+    objects = pools.setdefault(pool, {}).setdefault(namespace, {})
+    objects[name] = [data, time.time()]
+
+
+def _aio_worker():
+    while True:
+        deadline, fn = _aio_queue.get()
+        delay = deadline - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        fn()
+
+
+def _aio_submit(fn):
+    global _aio_queue
+    with _aio_lock:
+        if _aio_queue is None:
+            _aio_queue = Queue.Queue()
+            for i in range(aio_threads):
+                t = threading.Thread(target=_aio_worker)
+                t.daemon = True
+                t.start()
+    _aio_queue.put((time.time() + latency, fn))
+
+
+class Rados(object):
+    def __init__(self, rados_id=None, conffile=None, **kwargs):
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+
+    def shutdown(self):
+        self.connected = False
+
+    def open_ioctx(self, pool):
+        if pool not in pools:
+            raise ObjectNotFound("No pool %s" % pool)
+        return Ioctx(pool)
+
+
+class Completion(object):
+    def __init__(self):
+        self.ret = None
+
+    def get_return_value(self):
+        return self.ret
+
+
+class Object(object):
+    def __init__(self, key, nspace):
+        self.key = key
+        self.nspace = nspace
+
+
+class Ioctx(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.namespace = ''
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+
+    def close(self):
+        pass
+
+    def __lookup(self, name, namespace=None):
+        if namespace is None:
+            namespace = self.namespace
+        try:
+            return pools[self.pool][namespace][name]
+        except KeyError:
+            raise ObjectNotFound("No object %s" % name)
+
+    def read(self, key, length=8192, offset=0):
+        if latency:
+            time.sleep(latency)
+        return self.__lookup(key)[0][offset:offset + length]
+
+    def stat(self, key):
+        if latency:
+            time.sleep(latency)
+        data, mtime = self.__lookup(key)
+        return len(data), time.localtime(mtime)
+
+    def remove_object(self, key):
+        if latency:
+            time.sleep(latency)
+        self.__lookup(key)
+        del pools[self.pool][self.namespace][key]
+
+    def aio_read(self, object_name, length, offset, oncomplete):
+        completion = Completion()
+        namespace = self.namespace
+
+        def complete():
+            if object_name in failures:
+                completion.ret = -failures[object_name]
+                oncomplete(completion, '')
+                return
+            try:
+                data = self.__lookup(object_name,
+                                     namespace)[0][offset:offset + length]
+                completion.ret = len(data)
+            except ObjectNotFound:
+                data = ''
+                completion.ret = -errno.ENOENT
+            oncomplete(completion, data)
+
+        _aio_submit(complete)
+        return completion
+
+    def list_objects(self):
+        return ObjectIterator(self)
+
+
+class ObjectIterator(object):
+    def __init__(self, ioctx):
+        namespaces = pools.get(ioctx.pool, {})
+        if ioctx.namespace == LIBRADOS_ALL_NSPACES:
+            selected = namespaces.items()
+        else:
+            selected = [(ioctx.namespace,
+                         namespaces.get(ioctx.namespace, {}))]
+        self.objects = iter([Object(name, nspace)
+                             for nspace, objects in selected
+                             for name in sorted(objects)])
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.objects)
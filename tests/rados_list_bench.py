@@ -0,0 +1,84 @@
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the listing of volumes on RADOS, against the in-memory fakerados
+pool, with serial reads and with windows of asynchronous reads:
+
+    python rados_list_bench.py -n 20000 --latency 0.0005 -w 1 16 64
+"""
+
+import os
+import sys
+import time
+import argparse
+from struct import pack
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakerados
+from archipelago import vlmc, radoslist
+from archipelago.common import Radosd, peers
+
+POOL = 'bench'
+
+
+class BenchRadosd(Radosd):
+    def __init__(self):
+        self.pool = POOL
+        self.cephx_id = None
+
+
+def populate(volumes, objects_per_volume):
+    for i in range(volumes):
+        name = 'volume%06d' % i
+        fakerados.put(POOL, 'archip_' + name,
+                      'AMF.' + pack('>LQLLQ', 2, 1 << 30, 1 << 22, 0, 1))
+        for j in range(objects_per_volume):
+            fakerados.put(POOL, '%s_%016x_%016x' % (name, 1, j), '')
+    # Headers of version 1 maps are not told apart by name
+    for i in range(volumes):
+        fakerados.put(POOL, 'v1volume%06d' % i, pack('<LQ', 1, 1 << 30))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RADOS listing benchmark')
+    parser.add_argument('-n', '--volumes', type=int, default=10000,
+                        help='number of volumes of each map version')
+    parser.add_argument('-o', '--objects', type=int, default=4,
+                        help='data objects per volume')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='seconds per read')
+    parser.add_argument('-w', '--windows', type=int, nargs='+',
+                        default=[1, 16, 64, 256],
+                        help='windows of reads in flight to measure')
+    args = parser.parse_args()
+
+    populate(args.volumes, args.objects)
+    fakerados.latency = args.latency
+    radoslist.rados_module = lambda: fakerados
+    peers['blockerm'] = BenchRadosd()
+
+    print "%-10s %10s %12s %12s" % ("window", "volumes", "seconds",
+                                    "headers/s")
+    for window in args.windows:
+        start = time.time()
+        count = sum(1 for v in vlmc.scan_volumes(jobs=window))
+        elapsed = time.time() - start
+        print "%-10d %10d %12.3f %12.0f" % (window, count, elapsed,
+                                             2 * args.volumes / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the start-up time of vlmc and archipelago subcommands.
+
+Every command is run repeatedly in a fresh interpreter, and the minimum and
+median wall clock times are reported, along with the heavy modules that the
+command ended up importing. Commands go through the installed entry point,
+archipelago.cmdclient:main, so vlmc commands reach a running command server
+if there is one. Extra commands may be given on the command line:
+
+    python startup_bench.py -n 20 -c /etc/archipelago/archipelago.conf \\
+        'vlmc info myvolume'
+"""
+
+import sys
+import time
+import argparse
+from subprocess import Popen, PIPE
+
+COMMANDS = [
+    'vlmc --help',
+    'vlmc showmapped',
+    'vlmc list',
+    'archipelago status',
+]
+
+HEAVY_MODULES = ['xseg', 'psutil', 'ConfigParser', 'random', 'rados']
+
+PROBE = """
+import sys, atexit
+
+def report():
+    loaded = [m for m in %r if m in sys.modules]
+    sys.stderr.write('\\nBENCH_MODULES %%s\\n' %% ','.join(loaded))
+
+atexit.register(report)
+sys.argv = %r
+from archipelago.cmdclient import main
+sys.exit(main())
+"""
+
+
+def run_once(argv):
+    code = PROBE % (HEAVY_MODULES, argv)
+    start = time.time()
+    p = Popen([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE)
+    _, err = p.communicate()
+    elapsed = time.time() - start
+    modules = []
+    for line in err.splitlines():
+        if line.startswith('BENCH_MODULES '):
+            modules = [m for m in line.split(' ', 1)[1].split(',') if m]
+    return elapsed, modules
+
+
+def bench(command, repeat, config=None):
+    argv = command.split()
+    if config:
+        argv[1:1] = ['-c', config]
+    times = []
+    modules = []
+    for i in range(repeat):
+        elapsed, modules = run_once(argv)
+        times.append(elapsed)
+    times.sort()
+    return times[0], times[len(times) // 2], modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='vlmc start-up benchmark')
+    parser.add_argument('-n', '--repeat', type=int, default=10,
+                        help='runs per command')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='config file')
+    parser.add_argument('commands', type=str, nargs='*',
+                        help='extra commands to measure')
+    args = parser.parse_args()
+
+    print "%-32s %12s %12s  %s" % ("command", "min (ms)", "median (ms)",
+                                   "heavy modules")
+    for command in COMMANDS + args.commands:
+        best, median, modules = bench(command, args.repeat, args.config)
+        print "%-32s %12.1f %12.1f  %s" % (command, best * 1000,
+                                           median * 1000,
+                                           ' '.join(modules) or '-')
+
+if __name__ == '__main__':
+    main()
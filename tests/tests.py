@@ -15,14 +15,18 @@
 
 import archipelago
 from archipelago.common import Xseg_ctx, Request, Filed, Mapperd, Vlmcd, Radosd, \
-        Error, Segment
+        Error, Segment, XsegCtxCache, XsegExecutor
 from archipelago.archipelago import start_peer, stop_peer
+from archipelago.mapreader import get_numpy
 import random as rnd
 import unittest2 as unittest
 from xseg.xprotocol import *
 from xseg.xseg_api import *
 import ctypes
 import os
+import sys
+import errno
+import time
 from copy import copy
 from sets import Set
 from binascii import hexlify, unhexlify
@@ -439,6 +443,317 @@ class XsegTest(unittest.TestCase):
     def get_vlmcd(self, args):
         return Vlmcd(user=self.user, group=self.group, **args)
 
+class XsegCtxTest(XsegTest):
+    def test_request_reuse(self):
+        xseg = self.xseg
+        dst = xseg.portno
+        req = Request.get_write_request(xseg, dst, 'a' * 32, data='x' * 1024,
+                                        offset=4096, flags=XF_FLUSH)
+        req.set_serviced(1024)
+        recycled = ctypes.addressof(req.req.contents)
+        self.assertTrue(req.put())
+        self.assertEqual(len(xseg.free_reqs), 1)
+
+        req = Request.get_write_request(xseg, dst, 'b' * 8, data='y' * 512)
+        self.assertEqual(ctypes.addressof(req.req.contents), recycled)
+        self.assertEqual(len(xseg.free_reqs), 0)
+        self.assertEqual(req.req.contents.targetlen, 8)
+        self.assertEqual(req.get_target(), 'b' * 8)
+        self.assertEqual(req.get_datalen(), 512)
+        self.assertEqual(req.data_view().tobytes(), 'y' * 512)
+        self.assertEqual(req.get_flags(), 0)
+        self.assertEqual(req.get_offset(), 0)
+        self.assertEqual(req.get_serviced(), 0)
+        self.assertEqual(req.get_op(), X_WRITE)
+        self.assertEqual(req.req.contents.state, 0)
+        self.assertEqual(req.req.contents.dst_portno, dst)
+        self.assertTrue(req.put())
+
+        # A request too small for the target and data is not reused
+        req = Request.get_read_request(xseg, dst, 'c' * 32, size=1 << 20)
+        self.assertNotEqual(ctypes.addressof(req.req.contents), recycled)
+        self.assertEqual(len(xseg.free_reqs), 1)
+        self.assertEqual(req.get_datalen(), 1 << 20)
+        self.assertEqual(req.get_target(), 'c' * 32)
+        self.assertEqual(req.get_op(), X_READ)
+        self.assertTrue(req.put())
+
+    def test_request_freelist_limit(self):
+        xseg = self.xseg
+        xseg.max_free_reqs = 2
+        reqs = [Request.get_info_request(xseg, xseg.portno, 'target%d' % i)
+                for i in range(4)]
+        for req in reqs:
+            self.assertTrue(req.put())
+        self.assertEqual(len(xseg.free_reqs), 2)
+        xseg.shutdown()
+        self.assertEqual(xseg.free_reqs, [])
+        self.xseg = None
+
+    def test_wait_policy(self):
+        import threading
+        from archipelago.common import WaitPolicy
+        policy = WaitPolicy()
+        self.xseg.wait_policy = policy
+        other = Xseg_ctx(self.segment)
+        try:
+            req = Request.get_info_request(other, self.xseg.portno, 'target')
+            timer = threading.Timer(0.05, req.submit)
+            timer.start()
+            received = self.xseg.wait_request()
+            timer.join()
+            self.assertEqual(ctypes.addressof(received.contents),
+                             ctypes.addressof(req.req.contents))
+            stats = policy.get_stats()
+            self.assertGreaterEqual(stats['sleeps'], 1)
+            self.assertEqual(stats['wakeups'], 1)
+            # Only the resumption after the signal counts as wake-up latency
+            self.assertGreaterEqual(stats['avg_sleep_usecs'] * stats['sleeps'],
+                                    40000)
+            self.assertLess(stats['max_wakeup_usecs'], 40000)
+            self.assertEqual(stats['avg_wakeup_usecs'],
+                             stats['max_wakeup_usecs'])
+            # Bounce it back to its owner
+            self.xseg.dispatch(received)
+            req.wait()
+            self.assertTrue(req.put())
+        finally:
+            other.shutdown()
+
+    def test_wait_completed(self):
+        from archipelago.common import ThreadedXseg_ctx, WaitPolicy
+        policy = WaitPolicy()
+        xseg = ThreadedXseg_ctx(self.segment, wait_policy=policy)
+        try:
+            self.assertIs(xseg.wait_policy, policy)
+            req = Request.get_info_request(xseg, xseg.portno, 'target')
+            xseg.track(req)
+            # As the receiver thread would do upon the reply
+            with xseg.lock:
+                xseg.pending.clear()
+                req.completed = True
+                xseg.completed.add(req)
+            req.wait()
+            self.assertNotIn(req, xseg.completed)
+            self.assertTrue(req.put())
+        finally:
+            xseg.shutdown()
+
+
+class XsegCtxCacheTest(XsegTest):
+    def test_reuse(self):
+        cache = XsegCtxCache(self.segment, max_ctxs=1)
+        a = cache.get()
+        b = cache.get()
+        self.assertIsNot(a, b)
+        self.assertIs(a.ctx, cache.xseg)
+        self.assertIs(b.ctx, cache.xseg)
+        self.assertNotEqual(a.portno, b.portno)
+        cache.put(a)
+        # Beyond max_ctxs, contexts are shut down
+        cache.put(b)
+        self.assertIsNone(b.ctx)
+        self.assertIs(cache.get(), a)
+        self.assertIsNotNone(a.ctx)
+        cache.put(a)
+        cache.shutdown()
+        self.assertIsNone(a.ctx)
+        self.assertIsNone(cache.xseg)
+        self.assertEqual(cache.free_ctxs, [])
+
+    def test_wait_policy(self):
+        from archipelago.common import WaitPolicy, SpinWaitPolicy
+        default = SpinWaitPolicy()
+        cache = XsegCtxCache(self.segment, wait_policy=default)
+        a = cache.get()
+        self.assertIs(a.wait_policy, default)
+        cache.put(a)
+        policy = WaitPolicy()
+        self.assertIs(cache.get(wait_policy=policy), a)
+        self.assertIs(a.wait_policy, policy)
+        cache.put(a)
+        cache.wait_policy = None
+        self.assertIs(cache.get(), a)
+        self.assertIsNot(a.wait_policy, policy)
+        self.assertIsNot(a.wait_policy, default)
+        self.assertIs(type(a.wait_policy), WaitPolicy)
+        cache.put(a)
+        cache.shutdown()
+
+    def test_join_failure(self):
+        class Unjoinable(object):
+            def join(self):
+                return None
+
+        cache = XsegCtxCache(Unjoinable())
+        self.assertRaises(Error, cache.get)
+        self.assertRaises(Error, cache.get_shared)
+        self.assertIsNone(cache.xseg)
+
+    def test_shutdown_xseg_ctxs(self):
+        import archipelago.common as common
+
+        def restore(saved_segment, saved_cache):
+            common.segment = saved_segment
+            common.xseg_ctx_cache = saved_cache
+        self.addCleanup(restore, common.segment, common.xseg_ctx_cache)
+        common.segment = self.segment
+        common.xseg_ctx_cache = None
+
+        xseg_ctx = common.get_xseg_ctx()
+        cache = common.xseg_ctx_cache
+        self.assertIs(cache.segment, self.segment)
+        common.put_xseg_ctx(xseg_ctx)
+        self.assertIs(common.get_xseg_ctx(), xseg_ctx)
+        common.put_xseg_ctx(xseg_ctx)
+
+        common.shutdown_xseg_ctxs()
+        self.assertIsNone(common.xseg_ctx_cache)
+        self.assertIsNone(xseg_ctx.ctx)
+        self.assertIsNone(cache.xseg)
+
+class WaitPolicyTest(unittest.TestCase):
+    def test_parse(self):
+        from archipelago.common import parse_wait_policy, WaitPolicy, \
+            SpinWaitPolicy
+        self.assertIs(type(parse_wait_policy('sleep')), WaitPolicy)
+        policy = parse_wait_policy('spin')
+        self.assertIsInstance(policy, SpinWaitPolicy)
+        self.assertEqual(policy.spin_usecs, SpinWaitPolicy().spin_usecs)
+        self.assertEqual(parse_wait_policy('spin:20').spin_usecs, 20)
+        self.assertEqual(parse_wait_policy('spin:0').spin_usecs, 0)
+        for spec in ('', 'sleep:10', 'spin:', 'spin:-1', 'spin:x', 'busy'):
+            self.assertRaises(Error, parse_wait_policy, spec)
+
+    def test_cli(self):
+        from archipelago.cli import vlmc_parser, BatchArgumentParser
+        from archipelago.common import SpinWaitPolicy
+        parser = vlmc_parser(parser_class=BatchArgumentParser)
+        args = parser.parse_args(['--wait-policy', 'spin:20', 'info', 'vol'])
+        self.assertIsInstance(args.wait_policy, SpinWaitPolicy)
+        self.assertEqual(args.wait_policy.spin_usecs, 20)
+        self.assertIsNone(parser.parse_args(['info', 'vol']).wait_policy)
+        self.assertRaises(Error, parser.parse_args,
+                          ['--wait-policy', 'spin:x', 'info', 'vol'])
+
+    def test_stats(self):
+        from archipelago.common import SpinWaitPolicy
+        policy = SpinWaitPolicy()
+        self.assertEqual(policy.get_stats(),
+                         {'spins': 0, 'spin_hits': 0, 'sleeps': 0,
+                          'avg_sleep_usecs': 0, 'wakeups': 0,
+                          'avg_wakeup_usecs': 0, 'max_wakeup_usecs': 0})
+        policy.sleeps = 2
+        policy.sleep_time = 0.5
+        policy.wakeups = 1
+        policy.wakeup_time = policy.max_wakeup_time = 0.000125
+        stats = policy.get_stats()
+        self.assertEqual(stats['avg_sleep_usecs'], 250000)
+        self.assertAlmostEqual(stats['avg_wakeup_usecs'], 125)
+        policy.reset_stats()
+        self.assertEqual(policy.get_stats()['sleeps'], 0)
+
+class PortSelectorTest(unittest.TestCase):
+    def test_roundrobin(self):
+        from archipelago.common import PortSelector
+        selector = PortSelector(10, 12)
+        self.assertEqual([selector.select() for _ in range(7)],
+                         [10, 11, 12, 10, 11, 12, 10])
+
+    def test_hash(self):
+        from archipelago.common import HashPortSelector
+        selector = HashPortSelector(10, 13)
+        ports = {}
+        for i in range(64):
+            name = 'volume%d' % i
+            portno = selector.select(name=name)
+            self.assertTrue(10 <= portno <= 13)
+            ports.setdefault(portno, set()).add(name)
+        # The same volume always goes to the same port
+        for portno, names in ports.items():
+            for name in names:
+                self.assertEqual(selector.select(name=name), portno)
+        self.assertEqual(len(ports), 4)
+        # Requests for no volume in particular are spread around
+        self.assertEqual([selector.select() for _ in range(4)],
+                         [10, 11, 12, 13])
+
+    def patch_queue_count(self, count):
+        import archipelago.common as common
+        saved = common.get_port_queue_count
+        common.get_port_queue_count = count
+        self.addCleanup(setattr, common, 'get_port_queue_count', saved)
+
+    def test_leastqueued(self):
+        from archipelago.common import LeastQueuedPortSelector
+        queued = {10: 3, 11: 1, 12: 2}
+        xseg_ctx = object()
+
+        def count(ctx, portno):
+            self.assertIs(ctx, xseg_ctx)
+            return queued[portno]
+        self.patch_queue_count(count)
+        selector = LeastQueuedPortSelector(10, 12)
+        self.assertEqual(selector.select(xseg_ctx), 11)
+        queued[12] = 0
+        self.assertEqual(selector.select(xseg_ctx, 'volume'), 12)
+        # Without a context, the queues cannot be inspected
+        self.assertEqual(selector.select(), 10)
+        self.assertTrue(selector.inspectable)
+
+    def test_leastqueued_fallback(self):
+        from StringIO import StringIO
+        from archipelago.common import LeastQueuedPortSelector
+
+        def count(ctx, portno):
+            raise NameError("global name 'xq_count' is not defined")
+        self.patch_queue_count(count)
+        stderr = StringIO()
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = stderr
+        selector = LeastQueuedPortSelector(10, 12)
+        self.assertEqual([selector.select(object()) for _ in range(4)],
+                         [10, 11, 12, 10])
+        self.assertFalse(selector.inspectable)
+        self.assertEqual(stderr.getvalue().count('round-robin'), 1)
+
+    def test_leastqueued_error(self):
+        from archipelago.common import LeastQueuedPortSelector
+
+        def count(ctx, portno):
+            raise Error("Invalid port %d" % portno)
+        self.patch_queue_count(count)
+        selector = LeastQueuedPortSelector(10, 12)
+        self.assertRaises(Error, selector.select, object())
+        self.assertTrue(selector.inspectable)
+
+class CreateRequestTest(unittest.TestCase):
+    def test_pack_create_request(self):
+        from archipelago.common import pack_create_request, \
+            create_header_struct, create_scatterlist_struct
+        objects = [('object%d' % i, i % 3) for i in range(100)]
+        objects.append(('x' * 256, 1))
+        buf = pack_create_request(4 << 20, 7, objects)
+        header_size = create_header_struct.size
+        seg_size = create_scatterlist_struct.size
+        self.assertIsInstance(buf, bytearray)
+        self.assertEqual(len(buf), header_size + len(objects) * seg_size)
+        self.assertEqual(create_header_struct.unpack_from(buf, 0),
+                         (len(objects), 4 << 20, 7))
+        for i, (name, flags) in enumerate(objects):
+            target, targetlen, segflags = create_scatterlist_struct.unpack_from(
+                buf, header_size + i * seg_size)
+            self.assertEqual(targetlen, len(name))
+            self.assertEqual(target[:targetlen], name)
+            self.assertEqual(target[targetlen:], '\0' * (256 - targetlen))
+            self.assertEqual(segflags, flags)
+
+    def test_pack_create_request_empty(self):
+        from archipelago.common import pack_create_request, \
+            create_header_struct
+        buf = pack_create_request(4 << 20, 0, [])
+        self.assertEqual(str(buf), create_header_struct.pack(0, 4 << 20, 0))
+
 class VlmcdTest(XsegTest):
     bfiled_args = {
             'role': 'vlmctest-blockerb',
@@ -630,6 +945,52 @@ class VlmcdTest(XsegTest):
             reqs.remove(req)
             self.assertTrue(req.put())
 
+    def test_info_callback(self):
+        volume = "myvolume"
+        volsize = 10*1024*1024
+        self.send_and_evaluate_clone(self.mapperdport, "", clone=volume,
+                clone_size=volsize)
+        xinfo = self.get_reply_info(volsize)
+        completed = []
+        for i in range(0, 8):
+            req = Request.get_info_request(self.xseg, self.vlmcdport, volume)
+            req.submit(callback=completed.append)
+        self.xseg.wait_all()
+        self.assertEqual(len(completed), 8)
+        for req in completed:
+            self.assertTrue(req.done())
+            self.evaluate_req(req, data=xinfo)
+            self.assertTrue(req.put())
+
+    def test_info_executor(self):
+        volume = "myvolume"
+        volsize = 10*1024*1024
+        self.send_and_evaluate_clone(self.mapperdport, "", clone=volume,
+                clone_size=volsize)
+        xinfo = self.get_reply_info(volsize)
+        cache = XsegCtxCache(self.segment)
+
+        def info(volume):
+            xseg_ctx = cache.get()
+            req = Request.get_info_request(xseg_ctx, self.vlmcdport, volume)
+            req.submit()
+            req.wait()
+            self.evaluate_req(req, data=xinfo)
+            self.assertTrue(req.put())
+            cache.put(xseg_ctx)
+            return volsize
+
+        with XsegExecutor(max_workers=4, cache=cache) as executor:
+            futures = [executor.submit(info, volume) for i in range(0, 16)]
+            for f in futures:
+                self.assertEqual(f.result(), volsize)
+            req = Request.get_info_request(executor.xseg_ctx, self.vlmcdport,
+                    volume)
+            req = executor.submit_request(req).result()
+            self.evaluate_req(req, data=xinfo)
+            self.assertTrue(req.put())
+        cache.shutdown()
+
     def test_flush(self):
         datalen = 1024
         data = get_random_string(datalen, 16)
@@ -1214,6 +1575,22 @@ class BlockerTest(object):
                 expected_data=data)
         self.send_and_evaluate_info(self.blockerport, target, expected_data=xinfo)
 
+    def test_write_read_buffer(self):
+        datalen = 1024
+        data = bytearray(get_random_string(datalen, 16))
+        target = "mytarget"
+
+        self.send_and_evaluate_write(self.blockerport, target, data=data,
+                serviced=datalen)
+        req = self.send_read(self.blockerport, target, size=datalen)
+        req.wait()
+        self.assertTrue(req.success())
+        buf = bytearray(datalen)
+        buf[:] = req.data_view()
+        self.assertEqual(buf, data)
+        self.assertEqual(req.target_view().tobytes(), target)
+        self.assertTrue(req.put())
+
     def test_info(self):
         datalen = 1024
         data = get_random_string(datalen, 16)
@@ -1366,6 +1743,1587 @@ class RadosdTest(BlockerTest, XsegTest):
         stop_peer(self.blocker)
         super(RadosdTest, self).tearDown()
 
+class StubXsegCtx(object):
+    """The part of Xseg_ctx that AsyncXsegCtx uses, with replies delivered
+    through a pipe"""
+    def __init__(self):
+        import fcntl
+        self.async_ctx = None
+        self.armed = False
+        self.completed = Set()
+        self.callbacks = {}
+        self.replies = []
+        self.rfd, self.wfd = os.pipe()
+        flags = fcntl.fcntl(self.rfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.rfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.rfd
+
+    def arm(self):
+        self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def track(self, req, callback=None):
+        self.callbacks[req] = callback
+
+    def reply(self, req):
+        self.replies.append(req)
+        os.write(self.wfd, 'x')
+
+    def handle_signal(self):
+        from archipelago.common import clear_signal_fd
+        clear_signal_fd(self.rfd)
+        while self.replies:
+            req = self.replies.pop(0)
+            callback = self.callbacks.pop(req)
+            if callback is not None:
+                callback(req)
+            else:
+                self.completed.add(req)
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class StubRequest(Request):
+    def __init__(self, xseg_ctx):
+        self.xseg_ctx = xseg_ctx
+
+    def submit(self, callback=None):
+        self.xseg_ctx.track(self, callback=callback)
+        return True
+
+
+class AsyncXsegCtxTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            from archipelago.aio import asyncio
+        except ImportError:
+            self.skipTest("Neither asyncio nor trollius is available")
+        self.loop = asyncio.new_event_loop()
+        self.xseg = StubXsegCtx()
+
+    def tearDown(self):
+        self.loop.close()
+        self.xseg.close()
+
+    def run_loop(self, fut):
+        return self.loop.run_until_complete(fut)
+
+    def test_arm_disarm(self):
+        from archipelago.aio import AsyncXsegCtx
+        actx = AsyncXsegCtx(self.xseg, loop=self.loop)
+        self.assertTrue(self.xseg.armed)
+        self.assertIs(self.xseg.async_ctx, actx)
+        with self.assertRaises(Error):
+            AsyncXsegCtx(self.xseg, loop=self.loop)
+        fut = actx.receive()
+        actx.close()
+        self.assertFalse(self.xseg.armed)
+        self.assertIsNone(self.xseg.async_ctx)
+        self.assertTrue(fut.cancelled())
+        # Closing twice is harmless
+        actx.close()
+        with self.assertRaises(Error):
+            StubRequest(self.xseg).submit_async()
+
+    def test_submit_async(self):
+        from archipelago.aio import AsyncXsegCtx
+        with AsyncXsegCtx(self.xseg, loop=self.loop):
+            reqs = [StubRequest(self.xseg) for _ in range(4)]
+            futs = [req.submit_async() for req in reqs]
+            for req in reversed(reqs):
+                self.xseg.reply(req)
+            for req, fut in zip(reqs, futs):
+                self.assertIs(self.run_loop(fut), req)
+            self.assertEqual(len(self.xseg.completed), 0)
+        self.assertFalse(self.xseg.armed)
+
+    def test_handle_signal(self):
+        from archipelago.aio import AsyncXsegCtx
+        early = StubRequest(self.xseg)
+        early.submit()
+        # A reply that arrived before the context was attached
+        self.xseg.reply(early)
+        actx = AsyncXsegCtx(self.xseg, loop=self.loop)
+        self.assertIs(self.run_loop(actx.receive()), early)
+
+        req = StubRequest(self.xseg)
+        req.submit()
+        fut = actx.receive()
+        self.assertFalse(fut.done())
+        self.xseg.reply(req)
+        self.assertIs(self.run_loop(fut), req)
+        self.assertEqual(len(self.xseg.completed), 0)
+        # The signal has been consumed
+        self.assertRaises(OSError, os.read, self.xseg.rfd, 1)
+        actx.close()
+
+class FakeVlmcd(object):
+    """Serves the requests of VolumeIO from memory, upon wait(), and the map
+    of the volume, as objects of objsize bytes"""
+    def __init__(self, size, objsize=4 * 4096):
+        self.data = bytearray(size)
+        self.objsize = objsize
+        self.allocated = set()
+        self.requests = []
+        self.failures = set()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.opened = 0
+        self.closed = 0
+        self.flushed = 0
+        self.ctxs_put = 0
+
+    def fill(self, offset, data):
+        """Write data to the volume, bypassing VolumeIO"""
+        self.data[offset:offset + len(data)] = data
+        for index in xrange(offset // self.objsize,
+                            (offset + len(data) - 1) // self.objsize + 1):
+            self.allocated.add(index)
+
+    def map_extents(self, xseg_ctx, name, size, epoch=None, **kwargs):
+        from archipelago.vlmc import Extent
+        for offset in xrange(0, size, self.objsize):
+            index = offset // self.objsize
+            if index in self.allocated:
+                yield Extent(index, offset, self.objsize, 1, 'writable', name)
+            else:
+                yield Extent(index, offset, self.objsize, 1, 'zero', None)
+
+    def serve(self, req):
+        if (req.op, req.get_offset()) in self.failures:
+            return False
+        offset = req.get_offset()
+        size = req.get_size()
+        if req.op == X_INFO:
+            req.info_size = len(self.data)
+        elif req.op == X_OPEN:
+            self.opened += 1
+        elif req.op == X_CLOSE:
+            self.closed += 1
+        elif req.op == X_WRITE and req.get_flags() & XF_FLUSH:
+            self.flushed += 1
+        elif req.op == X_WRITE:
+            self.fill(offset, req.data[:size])
+        elif req.op == X_READ:
+            req.data[:size] = self.data[offset:offset + size]
+        else:
+            return False
+        return True
+
+
+class FakeVolumeRequest(object):
+    """The part of Request that VolumeIO uses, served by a FakeVlmcd"""
+    vlmcd = None
+
+    def __init__(self, xseg_ctx, dst_portno, target, datalen=0, size=0,
+                 op=None, data=None, flags=0, offset=0, v0_size=-1):
+        self.target = target
+        self.op = op
+        self.offset = offset
+        self.size = size
+        self.flags = flags
+        self.v0_size = v0_size
+        self.data = bytearray(datalen)
+        self.served = None
+        self.vlmcd.inflight += 1
+        self.vlmcd.max_inflight = max(self.vlmcd.max_inflight,
+                                      self.vlmcd.inflight)
+
+    @classmethod
+    def get_info_request(cls, xseg, dst, target):
+        return cls(xseg, dst, target, op=X_INFO)
+
+    @classmethod
+    def get_open_request(cls, xseg, dst, target):
+        return cls(xseg, dst, target, op=X_OPEN)
+
+    @classmethod
+    def get_close_request(cls, xseg, dst, target):
+        return cls(xseg, dst, target, op=X_CLOSE)
+
+    def get_flags(self):
+        return self.flags
+
+    def set_flags(self, flags):
+        self.flags = flags
+
+    def set_v0_size(self, v0_size):
+        self.v0_size = v0_size
+
+    def get_offset(self):
+        return self.offset
+
+    def get_size(self):
+        return self.size
+
+    def data_view(self):
+        return memoryview(self.data)
+
+    def get_data(self, _type=None):
+        info = _type()
+        info.size = self.info_size
+        return ctypes.pointer(info)
+
+    def submit(self):
+        self.vlmcd.requests.append((self.op, self.offset, self.size))
+
+    def wait(self):
+        if self.served is None:
+            self.served = self.vlmcd.serve(self)
+
+    def success(self):
+        return self.served
+
+    def put(self):
+        self.vlmcd.inflight -= 1
+
+
+def patch_volumeio(test, vlmcd):
+    """Serve the VolumeIO objects of a test case from a FakeVlmcd"""
+    import archipelago.volumeio as volumeio
+
+    class Request(FakeVolumeRequest):
+        pass
+    Request.vlmcd = vlmcd
+
+    def put_xseg_ctx(xseg_ctx):
+        vlmcd.ctxs_put += 1
+    patches = {'Request': Request,
+               'get_xseg_ctx': lambda: 'xseg_ctx',
+               'put_xseg_ctx': put_xseg_ctx,
+               'get_peer_port': lambda role, xseg_ctx, name: 1}
+    for name, value in patches.items():
+        test.addCleanup(setattr, volumeio, name, getattr(volumeio, name))
+        setattr(volumeio, name, value)
+
+
+class VolumeIOTest(unittest.TestCase):
+    def setUp(self):
+        self.vlmcd = FakeVlmcd(16 * 4096)
+        patch_volumeio(self, self.vlmcd)
+
+    def open(self, mode='r+', iodepth=2):
+        from archipelago.volumeio import VolumeIO
+        return VolumeIO('volume', mode, iodepth=iodepth, blocksize=4096)
+
+    def data_requests(self):
+        return [(offset, size) for op, offset, size in self.vlmcd.requests
+                if op in (X_READ, X_WRITE) and size]
+
+    def test_write_read(self):
+        data = get_random_string(3 * 4096, 512)
+        with self.open() as vio:
+            self.assertEqual(vio.size, 16 * 4096)
+            self.assertEqual(self.vlmcd.opened, 1)
+            vio.seek(1000)
+            self.assertEqual(vio.write(data), len(data))
+            self.assertEqual(vio.tell(), 1000 + len(data))
+            # Writes are split in blocksize aligned requests
+            self.assertEqual(self.data_requests(),
+                             [(1000, 3096), (4096, 4096), (8192, 4096),
+                              (12288, 1000)])
+            self.assertLessEqual(self.vlmcd.max_inflight, 2 + 1)
+            del self.vlmcd.requests[:]
+            vio.seek(1000)
+            self.assertEqual(vio.read(len(data)), data)
+            self.assertEqual(self.data_requests(),
+                             [(1000, 3096), (4096, 4096), (8192, 4096),
+                              (12288, 1000)])
+        self.assertEqual(str(self.vlmcd.data[1000:1000 + len(data)]), data)
+        self.assertEqual(self.vlmcd.flushed, 1)
+        self.assertEqual(self.vlmcd.closed, 1)
+        self.assertEqual(self.vlmcd.inflight, 0)
+        self.assertEqual(self.vlmcd.ctxs_put, 1)
+
+    def test_readinto(self):
+        self.vlmcd.data[:] = get_random_string(16 * 4096, 4096)
+        with self.open('r', iodepth=3) as vio:
+            buf = bytearray(10 * 4096)
+            vio.seek(-5 * 4096, os.SEEK_END)
+            self.assertEqual(vio.readinto(buf), 5 * 4096)
+            self.assertEqual(buf[:5 * 4096], self.vlmcd.data[11 * 4096:])
+            self.assertEqual(vio.tell(), 16 * 4096)
+            self.assertEqual(vio.read(), '')
+            self.assertEqual(vio.readinto(buf), 0)
+            self.assertLessEqual(self.vlmcd.max_inflight, 3)
+        self.assertEqual(self.vlmcd.opened, 0)
+        self.assertEqual(self.vlmcd.closed, 0)
+
+    def test_seek(self):
+        with self.open('r') as vio:
+            self.assertEqual(vio.seek(4096), 4096)
+            self.assertEqual(vio.seek(100, os.SEEK_CUR), 4196)
+            self.assertEqual(vio.seek(-96, os.SEEK_END), 16 * 4096 - 96)
+            self.assertRaises(Error, vio.seek, -1)
+            self.assertRaises(Error, vio.seek, 0, 3)
+            self.assertEqual(vio.tell(), 16 * 4096 - 96)
+            self.assertEqual(len(vio.read(1000)), 96)
+            self.assertRaises(Error, vio.write, 'data')
+        self.assertRaises(Error, vio.seek, 0)
+        self.assertRaises(Error, vio.read)
+
+    def test_write_beyond_end(self):
+        with self.open() as vio:
+            vio.seek(16 * 4096 - 10)
+            self.assertRaises(Error, vio.write, 'x' * 11)
+            self.assertEqual(self.data_requests(), [])
+
+    def test_read_error(self):
+        self.vlmcd.failures.add((X_READ, 8192))
+        with self.open('r', iodepth=4) as vio:
+            vio.seek(100)
+            self.assertRaises(Error, vio.read, 4 * 4096)
+            # Every request of the failed read is waited for and put
+            self.assertEqual(self.vlmcd.inflight, 0)
+            self.assertEqual(vio.tell(), 100)
+
+    def test_write_error(self):
+        self.vlmcd.failures.add((X_WRITE, 4096))
+        vio = self.open(iodepth=8)
+        vio.write('x' * 4 * 4096)
+        # Errors of pending writes are reported by the next flush
+        self.assertRaises(Error, vio.flush)
+        self.assertEqual(self.vlmcd.inflight, 0)
+        self.assertEqual(self.vlmcd.flushed, 0)
+        vio.close()
+        self.assertEqual(self.vlmcd.flushed, 1)
+        self.assertEqual(self.vlmcd.closed, 1)
+
+    def test_close_after_flush_error(self):
+        self.vlmcd.failures.add((X_WRITE, 0))
+        vio = self.open()
+        vio.write('x' * 4096)
+        with self.assertRaises(Error) as cm:
+            vio.close()
+        self.assertIn('Write', str(cm.exception))
+        # The volume is closed all the same
+        self.assertEqual(self.vlmcd.closed, 1)
+        self.assertTrue(vio.closed)
+        self.assertEqual(self.vlmcd.ctxs_put, 1)
+        self.assertEqual(self.vlmcd.inflight, 0)
+        vio.close()
+        self.assertEqual(self.vlmcd.closed, 1)
+
+class ImportExportTest(unittest.TestCase):
+    size = 8 * 4096
+    objsize = 2 * 4096
+
+    def setUp(self):
+        import tempfile
+        import archipelago.vlmc as vlmc
+        self.vlmcd = FakeVlmcd(self.size, self.objsize)
+        patch_volumeio(self, self.vlmcd)
+        self.addCleanup(setattr, vlmc, 'map_extents', vlmc.map_extents)
+        vlmc.map_extents = self.vlmcd.map_extents
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def get_image(self):
+        # Data in the first and the third object, zeros elsewhere
+        image = bytearray(self.size)
+        image[1000:3000] = get_random_string(2000, 100)
+        image[2 * self.objsize + 100:2 * self.objsize + 200] = 'x' * 100
+        return image
+
+    def import_image(self, image, sparse=True):
+        from archipelago.vlmc import import_volume
+        with open(self.path, 'wb') as f:
+            f.write(image)
+        return import_volume('volume', self.path, iodepth=4, blocksize=1,
+                             sparse=sparse)
+
+    def written_blocks(self):
+        return sorted(offset for op, offset, size in self.vlmcd.requests
+                      if op == X_WRITE and size)
+
+    def test_import_sparse(self):
+        image = self.get_image()
+        written, skipped = self.import_image(image)
+        self.assertEqual(self.vlmcd.data, image)
+        self.assertEqual(self.written_blocks(), [0, 1024, 2048, 16384])
+        self.assertEqual((written, skipped), (4 * 1024, self.size - 4096))
+        self.assertEqual(self.vlmcd.closed, 1)
+
+    def test_import_over_data(self):
+        # Zero blocks of the image are written where the volume has data
+        self.vlmcd.fill(0, 'y' * self.objsize)
+        self.vlmcd.fill(3 * self.objsize + 4000, 'z' * 10)
+        image = self.get_image()
+        written, skipped = self.import_image(image)
+        self.assertEqual(self.vlmcd.data, image)
+        self.assertEqual(self.written_blocks(),
+                         range(0, self.objsize, 1024) + [16384] +
+                         range(3 * self.objsize, self.size, 1024))
+        self.assertEqual(written + skipped, self.size)
+
+    def test_import_no_sparse(self):
+        image = self.get_image()
+        self.assertEqual(self.import_image(image, sparse=False),
+                         (self.size, 0))
+        self.assertEqual(self.vlmcd.data, image)
+        self.assertEqual(self.written_blocks(), range(0, self.size, 1024))
+
+    def test_import_short_image(self):
+        image = self.get_image()[:5000]
+        self.vlmcd.fill(0, 'y' * self.size)
+        self.assertEqual(self.import_image(image), (5000, 0))
+        self.assertEqual(self.vlmcd.data[:5000], image)
+        self.assertEqual(self.vlmcd.data[5000:], 'y' * (self.size - 5000))
+
+    def test_export(self):
+        from archipelago.vlmc import export_volume
+        image = self.get_image()
+        self.vlmcd.fill(0, image[:self.objsize])
+        self.vlmcd.fill(2 * self.objsize, image[2 * self.objsize:
+                                                3 * self.objsize])
+        self.assertEqual(export_volume('volume', self.path, iodepth=2,
+                                       blocksize=1),
+                         (self.size, 2 * self.objsize))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), image)
+        # Only the allocated objects are read
+        self.assertEqual(sorted(offset for op, offset, size
+                                in self.vlmcd.requests if op == X_READ),
+                         range(0, self.objsize, 1024) +
+                         range(2 * self.objsize, 3 * self.objsize, 1024))
+        self.assertEqual(self.vlmcd.ctxs_put, 1)
+
+    def test_export_no_sparse(self):
+        from archipelago.vlmc import export_volume
+        image = self.get_image()
+        self.vlmcd.fill(0, image)
+        with open(self.path, 'wb') as f:
+            f.write('stale data' * self.size)
+        self.assertEqual(export_volume('volume', self.path, blocksize=1,
+                                       sparse=False), (self.size, 0))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), image)
+
+class FakeMapperd(object):
+    """Serves X_INFO, X_MAPW and the reads of map headers from memory, and
+    the maps of volumes, as objects of objsize bytes. Legacy maps are kept in
+    archip_<volume>, and their objects are named after it, as mapperd does."""
+    def __init__(self, objsize=4 * 4096):
+        self.objsize = objsize
+        self.objects = {}
+        self.maps = {}
+        self.snapshots = []
+        self.requests = []
+        self.reads = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.ctxs_put = 0
+
+    def create(self, volume, targets, epoch=1, legacy=False):
+        """Create the version 2 map of a volume, given the object of every
+        block, or None for zero blocks, and return its header object"""
+        header_object = 'archip_' + volume if legacy else volume
+        self.objects[header_object] = 'AMF.' + pack(
+            '>LQLLQ', 2, len(targets) * self.objsize, self.objsize, 0, epoch)
+        self.maps[volume] = (header_object, epoch, list(targets))
+        return header_object
+
+    def map_objects(self, xseg_ctx, name, size, **kwargs):
+        from archipelago.vlmc import MapObject
+        _, _, targets = self.maps[name]
+        for index, target in enumerate(targets):
+            yield MapObject(index, index * self.objsize, self.objsize,
+                            target or '', target is None)
+
+    def serve(self, req):
+        offset = req.get_offset()
+        size = req.get_size()
+        if req.op == X_INFO:
+            req.info_size = len(self.maps[req.target][2]) * self.objsize
+        elif req.op == X_READ:
+            self.reads.append(req.target)
+            data = self.objects.get(req.target)
+            if data is None:
+                return False
+            req.data[:size] = data[:size]
+        elif req.op == X_MAPW:
+            # Copy up the shared objects of the range
+            header_object, epoch, targets = self.maps[req.target]
+            for index in xrange(offset // self.objsize,
+                                (offset + size) // self.objsize):
+                if targets[index] is not None:
+                    targets[index] = '%s_%016x_%016x' % (header_object,
+                                                         epoch, index)
+        elif req.op == X_SNAPSHOT:
+            self.snapshots.append((req.target, req.snap))
+        else:
+            return False
+        return True
+
+
+class FakeMapRequest(FakeVolumeRequest):
+    """The part of Request that vlmc uses on maps, served by a FakeMapperd"""
+    @classmethod
+    def get_read_request(cls, xseg, dst, target, size=0, offset=0,
+                         datalen=0):
+        return cls(xseg, dst, target, op=X_READ, offset=offset, size=size,
+                   datalen=datalen or size)
+
+    @classmethod
+    def get_mapw_request(cls, xseg, dst, target, offset=0, size=0):
+        return cls(xseg, dst, target, op=X_MAPW, offset=offset, size=size)
+
+    @classmethod
+    def get_snapshot_request(cls, xseg, dst, target, snap=None):
+        req = cls(xseg, dst, target, op=X_SNAPSHOT)
+        req.snap = snap
+        return req
+
+
+def patch_vlmc(test, mapperd):
+    """Serve the map requests of vlmc in a test case from a FakeMapperd"""
+    import archipelago.vlmc as vlmc
+
+    class Request(FakeMapRequest):
+        pass
+    Request.vlmcd = mapperd
+
+    def put_xseg_ctx(xseg_ctx):
+        mapperd.ctxs_put += 1
+    blocker = Filed.__new__(Filed)
+    blocker.portno_start = 2
+    patches = {'Request': Request,
+               'get_xseg_ctx': lambda: 'xseg_ctx',
+               'put_xseg_ctx': put_xseg_ctx,
+               'get_peer_port': lambda role, xseg_ctx, name: 1,
+               'map_objects': mapperd.map_objects}
+    for name, value in patches.items():
+        test.addCleanup(setattr, vlmc, name, getattr(vlmc, name))
+        setattr(vlmc, name, value)
+    set_blocker(test, blocker)
+
+
+class MapInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.mapperd = FakeMapperd()
+        patch_vlmc(self, self.mapperd)
+
+    def create_clone(self, legacy):
+        """Create a snapshot, and a clone of it with an object of its own
+        between two objects of the snapshot"""
+        shared = ['snapshot1_%016x_%016x' % (1, i) for i in range(3)]
+        self.mapperd.create('snapshot1', shared)
+        own = '%sclone1_%016x_%016x' % ('archip_' if legacy else '', 2, 1)
+        self.mapperd.create('clone1', [shared[0], own, shared[2]], epoch=2,
+                            legacy=legacy)
+
+    def mapinfo(self, name):
+        from StringIO import StringIO
+        from archipelago.vlmc import mapinfo
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        sys.stdout = StringIO()
+        return mapinfo(name)
+
+    def test_read_map_header(self):
+        from archipelago.vlmc import read_map_header
+        for legacy in (False, True):
+            header_object = self.mapperd.create('volume1', [None, None],
+                                                epoch=3, legacy=legacy)
+            del self.mapperd.reads[:]
+            header = read_map_header('xseg_ctx', 'volume1')
+            self.assertEqual((header.version, header.size, header.epoch,
+                              header.header_object),
+                             (2, 2 * self.mapperd.objsize, 3, header_object))
+            # The plain name is looked up first
+            self.assertEqual(self.mapperd.reads[0], 'volume1')
+            del self.mapperd.objects[header_object]
+        with self.assertRaises(Error):
+            read_map_header('xseg_ctx', 'volume1')
+
+    def test_mapinfo(self):
+        for legacy in (False, True):
+            self.create_clone(legacy)
+            self.assertEqual(self.mapinfo('clone1'),
+                             {'zero': 0, 'shared': 2, 'writable': 1})
+            self.assertEqual(self.mapinfo('snapshot1'),
+                             {'zero': 0, 'shared': 0, 'writable': 3})
+            self.mapperd.objects.clear()
+
+    def test_flatten(self):
+        from archipelago.vlmc import flatten, read_map_header, shared_ranges
+        objsize = self.mapperd.objsize
+        for legacy in (False, True):
+            self.create_clone(legacy)
+            header = read_map_header('xseg_ctx', 'clone1')
+            self.assertEqual(list(shared_ranges('xseg_ctx', 'clone1',
+                                                3 * objsize, header.epoch,
+                                                16, header.header_object)),
+                             [(0, objsize, 1), (2 * objsize, objsize, 1)])
+            self.assertEqual(flatten('clone1', jobs=1, batch=1), 2)
+            self.assertEqual(list(shared_ranges('xseg_ctx', 'clone1',
+                                                3 * objsize, header.epoch,
+                                                16, header.header_object)),
+                             [])
+            self.assertEqual(self.mapinfo('clone1'),
+                             {'zero': 0, 'shared': 0, 'writable': 3})
+            # Nothing is left to copy up
+            self.assertEqual(flatten('clone1'), 0)
+            self.mapperd.objects.clear()
+
+    def test_put_on_error(self):
+        import archipelago.vlmc as vlmc
+        # The info request of an unknown volume fails in wait()
+        with self.assertRaises(KeyError):
+            vlmc.info('volume1')
+        self.assertEqual((self.mapperd.inflight, self.mapperd.ctxs_put),
+                         (0, 1))
+
+        def get_peer_port(role, xseg_ctx, name):
+            raise Error("No %s peer" % role)
+        vlmc.get_peer_port = get_peer_port
+        with self.assertRaises(Error):
+            vlmc.snapshot('volume1', 'snapshot1')
+        self.assertEqual((self.mapperd.inflight, self.mapperd.ctxs_put),
+                         (0, 2))
+
+class SnapshotGroupTest(unittest.TestCase):
+    class XsegCtx(object):
+        """Completes the pending requests one at a time"""
+        def wait_requests(self, pending):
+            req = iter(pending).next()
+            req.wait()
+            return req
+
+    def setUp(self):
+        import archipelago.vlmc as vlmc
+        from archipelago.blktap import VlmcTapdisk
+        self.mapperd = FakeMapperd()
+        patch_vlmc(self, self.mapperd)
+        xseg_ctx = self.XsegCtx()
+        vlmc.get_xseg_ctx = lambda: xseg_ctx
+        self.tapdisks = [VlmcTapdisk.Tapdisk(pid=str(i + 100), minor=i,
+                                             volume='volume%d' % i)
+                         for i in range(3)]
+        self.addCleanup(setattr, vlmc, 'get_mapped', vlmc.get_mapped)
+        vlmc.get_mapped = lambda: self.tapdisks
+        self.tap_ctl = []
+        self.failures = set()
+        self.addCleanup(setattr, VlmcTapdisk, 'exc',
+                        VlmcTapdisk.__dict__['exc'])
+        VlmcTapdisk.exc = staticmethod(self.exc)
+
+    def exc(self, action, pid, minor):
+        self.tap_ctl.append((action, int(minor[2:])))
+        if (action, int(minor[2:])) in self.failures:
+            raise Exception("%s failed" % action)
+
+    def snapshot_group(self):
+        from archipelago.vlmc import snapshot_group
+        return snapshot_group([('volume%d' % i, 'snapshot%d' % i)
+                               for i in range(3)], pause=True)
+
+    def test_snapshot_group(self):
+        results = self.snapshot_group()
+        self.assertEqual([(r['volume'], r['snapshot'], r['success'])
+                          for r in results],
+                         [('volume%d' % i, 'snapshot%d' % i, True)
+                          for i in range(3)])
+        self.assertEqual(sorted(self.mapperd.snapshots),
+                         [('volume%d' % i, 'snapshot%d' % i)
+                          for i in range(3)])
+        self.assertEqual(sorted(self.tap_ctl),
+                         [('pause', i) for i in range(3)] +
+                         [('unpause', i) for i in range(3)])
+
+    def test_pause_failure(self):
+        self.failures.add(('pause', 1))
+        with self.assertRaisesRegexp(Error, 'Cannot pause'):
+            self.snapshot_group()
+        # Only the tapdisks that were paused are unpaused
+        self.assertEqual(sorted(a for a in self.tap_ctl if a[0] == 'unpause'),
+                         [('unpause', 0), ('unpause', 2)])
+        self.assertEqual(self.mapperd.snapshots, [])
+
+    def test_unpause_failure(self):
+        self.failures.add(('unpause', 1))
+        with self.assertRaisesRegexp(Error, 'Cannot unpause'):
+            self.snapshot_group()
+        self.assertEqual(len([a for a in self.tap_ctl if a[0] == 'unpause']),
+                         3)
+
+        # An earlier error is kept
+        del self.tap_ctl[:]
+        self.failures.add(('pause', 2))
+        with self.assertRaisesRegexp(Error, 'Cannot pause'):
+            self.snapshot_group()
+        self.assertEqual(sorted(a for a in self.tap_ctl if a[0] == 'unpause'),
+                         [('unpause', 0), ('unpause', 1)])
+
+
+class StubXsegCtxCache(object):
+    """Hands out a stand-in for the shared context of an XsegExecutor"""
+    class SharedCtx(object):
+        def shutdown(self):
+            pass
+
+    def __init__(self):
+        self.shared = None
+
+    def get_shared(self):
+        return self.SharedCtx()
+
+    def share(self, xseg_ctx):
+        self.shared = xseg_ctx
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        import archipelago.common as common
+        self.addCleanup(setattr, common, 'get_xseg_ctx_cache',
+                        common.get_xseg_ctx_cache)
+        self.cache = StubXsegCtxCache()
+        common.get_xseg_ctx_cache = lambda: self.cache
+
+    def test_parse_batch_line(self):
+        from archipelago import vlmc
+        from archipelago.vlmc import parse_batch_line
+        self.assertIsNone(parse_batch_line(''))
+        self.assertIsNone(parse_batch_line('  # a comment'))
+        func, kwargs = parse_batch_line('create vol -s 10  # new volume')
+        self.assertIs(func, vlmc.create)
+        self.assertEqual(kwargs['name'], 'vol')
+        self.assertEqual(kwargs['size'], 10)
+        for option in ('func', 'config', 'wait_policy'):
+            self.assertNotIn(option, kwargs)
+        func, kwargs = parse_batch_line('clone snap vol -s 5')
+        self.assertIs(func, vlmc.create)
+        self.assertEqual((kwargs['name'], kwargs['snap'], kwargs['size']),
+                         ('vol', 'snap', 5))
+        func, kwargs = parse_batch_line("info 'my vol'")
+        self.assertIs(func, vlmc.info)
+        self.assertEqual(kwargs['name'], 'my vol')
+        for line in ('map vol', 'clone snap', 'create', 'info vol --bogus',
+                     'create vol -s ten', 'info "vol'):
+            self.assertRaises(Error, parse_batch_line, line)
+
+    def test_run_batch(self):
+        from archipelago.vlmc import run_batch
+
+        def op(i):
+            if i % 3 == 1:
+                raise Error("failed %d" % i)
+            if i % 3 == 2:
+                raise ValueError(i)
+            return i
+        consumed = []
+
+        def operations():
+            for i in range(20):
+                consumed.append(i)
+                yield op, {'i': i}
+        results = run_batch(operations(), max_workers=2)
+        self.assertEqual(consumed, [])
+        for i, (result, e) in enumerate(results):
+            # Operations are consumed lazily, up to a window ahead
+            self.assertLessEqual(len(consumed), i + 4 + 1)
+            if i % 3 == 0:
+                self.assertEqual((result, e), (i, None))
+            elif i % 3 == 1:
+                self.assertIsNone(result)
+                self.assertIsInstance(e, Error)
+                self.assertEqual(str(e), "failed %d" % i)
+            else:
+                self.assertIsNone(result)
+                self.assertIsInstance(e, ValueError)
+        self.assertEqual(i, 19)
+        # The shared context is no longer handed out
+        self.assertIsNone(self.cache.shared)
+
+    def test_batch(self):
+        import tempfile
+        from archipelago import vlmc
+
+        def info(name, **kwargs):
+            if name == 'missing':
+                raise Error("Cannot get info")
+            return len(name)
+        self.addCleanup(setattr, vlmc, 'info', vlmc.info)
+        vlmc.info = info
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write("info vol\n\n# comment\nbogus vol\ninfo missing\n"
+                    "info volume\ninfo 'unterminated\n")
+        results = vlmc.batch(path, max_workers=2)
+        self.assertEqual([(lineno, result) for lineno, result, e in results],
+                         [(1, 3), (4, None), (5, None), (6, 6), (7, None)])
+        self.assertEqual([type(e) for lineno, result, e in results],
+                         [type(None), Error, Error, type(None), Error])
+        self.assertIn('bogus', str(results[1][2]))
+        self.assertRaises(Error, vlmc.batch, path, max_workers=0)
+        stdout = sys.stdout
+        try:
+            from StringIO import StringIO
+            sys.stdout = StringIO()
+            self.assertRaises(Error, vlmc.batch, path, max_workers=2,
+                              cli=True)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn('5: ', output)
+        self.assertIn('FAILED', output)
+
+class CmdFramingTest(unittest.TestCase):
+    def setUp(self):
+        import socket
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def test_round_trip(self):
+        import threading
+        from archipelago.cmdclient import send_msg, recv_msg
+        msgs = [{'prog': 'vlmc', 'argv': ['info', u'vol\xe9']},
+                {'stdout': 'x' * (1 << 20), 'status': 0},
+                [], 0, None]
+        # Large messages do not fit in the socket buffer
+        t = threading.Thread(target=lambda: [send_msg(self.a, m)
+                                             for m in msgs])
+        t.start()
+        received = [recv_msg(self.b) for _ in msgs]
+        t.join()
+        self.assertEqual(received, msgs)
+
+    def test_partial(self):
+        import json
+        import threading
+        from archipelago.cmdclient import recv_msg, header_struct
+        data = json.dumps({'argv': ['ls']})
+        frame = header_struct.pack(len(data)) + data
+
+        def trickle():
+            for c in frame:
+                self.a.send(c)
+                time.sleep(0.001)
+        t = threading.Thread(target=trickle)
+        t.start()
+        self.assertEqual(recv_msg(self.b), {'argv': ['ls']})
+        t.join()
+
+    def test_eof(self):
+        from archipelago.cmdclient import recv_msg, header_struct
+        self.a.sendall(header_struct.pack(10) + '{"ar')
+        self.a.close()
+        # A truncated message reads as the end of the stream
+        self.assertIsNone(recv_msg(self.b))
+        self.assertIsNone(recv_msg(self.b))
+
+    def test_eof_in_header(self):
+        from archipelago.cmdclient import recv_msg
+        self.a.sendall('\0\0')
+        self.a.close()
+        self.assertIsNone(recv_msg(self.b))
+
+    def test_invalid(self):
+        from archipelago.cmdclient import recv_msg, header_struct
+        self.a.sendall(header_struct.pack(3) + 'foo')
+        self.assertRaises(ValueError, recv_msg, self.b)
+
+    def test_call(self):
+        import socket
+        import tempfile
+        import threading
+        from archipelago.cmdclient import call, send_msg, recv_msg
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'vlmc.socket')
+        self.addCleanup(os.rmdir, tmpdir)
+        self.assertIsNone(call({'argv': []}, endpoint=path))
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        self.addCleanup(os.unlink, path)
+        self.addCleanup(server.close)
+        server.listen(1)
+        replies = [{'fallback': True},
+                   {'stdout': 'ok\n', 'stderr': '', 'status': 0}]
+        requests = []
+
+        def serve():
+            for reply in replies:
+                conn, _ = server.accept()
+                requests.append(recv_msg(conn))
+                send_msg(conn, reply)
+                conn.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        self.assertIsNone(call({'argv': ['ls']}, endpoint=path))
+        self.assertEqual(call({'argv': ['info', 'vol']}, endpoint=path),
+                         replies[1])
+        t.join()
+        self.assertEqual(requests, [{'argv': ['ls']},
+                                    {'argv': ['info', 'vol']}])
+
+    def test_local_commands(self):
+        from archipelago.cmdserver import CommandServer
+
+        class Server(CommandServer):
+            def __init__(self):
+                pass
+        server = Server()
+        # Commands that use the client's stdio or working directory
+        for argv in (['diff', 'snapa', 'snapb'],
+                     ['diff', 'snapa', 'snapb', 'diff.out'],
+                     ['export', 'volume', '-'], ['batch', '-'],
+                     ['backup', 'snapa'], ['restore', 'volume', '-'],
+                     ['restore', 'volume', 'full.abk', 'incr.abk']):
+            self.assertEqual(server.run({'prog': 'vlmc', 'argv': argv}),
+                             {'fallback': True})
+
+class MapReaderTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.archip_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        recursive_remove(self.archip_dir)
+        os.rmdir(self.archip_dir)
+
+    def put(self, name, data):
+        from archipelago.vlmc import filed_object_dir
+        path = os.path.join(self.archip_dir, filed_object_dir(name))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+
+    def read(self, name):
+        from archipelago.mapreader import FiledStore, MapReader
+        reader = MapReader(FiledStore(self.archip_dir), name)
+        return reader.header, list(reader.objects())
+
+    def test_v0(self):
+        from archipelago.mapreader import ZERO_BLOCK, MF_OBJECT_ZERO
+        digests = [sha256(str(i)).digest() for i in range(3)]
+        name = sha256('map').hexdigest()
+        self.put(name, ''.join(digests) + unhexlify(ZERO_BLOCK) +
+                 '\0' * 32 + digests[0])
+        header, objects = self.read(name)
+        self.assertEqual(header.version, 0)
+        self.assertEqual(header.nr_objs, 4)
+        self.assertEqual(objects, [(i, 0, hexlify(d))
+                                   for i, d in enumerate(digests)] +
+                         [(3, MF_OBJECT_ZERO, ZERO_BLOCK)])
+
+    def test_v1(self):
+        from archipelago.mapreader import MF_OBJECT_WRITABLE, \
+            MF_OBJECT_ARCHIP
+        digests = [sha256(str(i)).digest() for i in range(2)]
+        self.put('volume1', pack('<LQ', 1, (1 << 22) + 1) +
+                 '\1' + digests[0] + '\0' + digests[1])
+        header, objects = self.read('volume1')
+        self.assertEqual((header.version, header.nr_objs), (1, 2))
+        self.assertEqual(objects,
+                         [(0, MF_OBJECT_WRITABLE | MF_OBJECT_ARCHIP,
+                           'archip_' + hexlify(digests[0])),
+                          (1, 0, hexlify(digests[1]))])
+
+    def test_v2(self):
+        from archipelago.mapreader import MF_OBJECT_WRITABLE, \
+            MF_OBJECT_ZERO
+        blocksize = 256
+        nr_objs = 5
+        self.put('archip_volume2', 'AMF.' + pack('>LQLLQ', 2,
+                                                 nr_objs * blocksize,
+                                                 blocksize, 0, 3))
+        expected = []
+        for i in range(nr_objs):
+            if i % 2:
+                expected.append((i, MF_OBJECT_WRITABLE,
+                                 'volume2_%016x_%016x' % (3, i)))
+            else:
+                expected.append((i, MF_OBJECT_ZERO, ''))
+        records = [pack('<BI', flags, len(name)) + name +
+                   '\0' * (123 - len(name)) for _, flags, name in expected]
+        # Two records per map block
+        for block in range(3):
+            self.put('archip_volume2_%016x' % block,
+                     ''.join(records[2 * block:2 * block + 2]))
+        header, objects = self.read('volume2')
+        self.assertEqual((header.version, header.epoch, header.nr_objs),
+                         (2, 3, nr_objs))
+        self.assertEqual(objects, expected)
+
+    def put_v2(self, volume, names, size, flags=1, legacy=True):
+        from archipelago.mapreader import MF_OBJECT_WRITABLE, \
+            MF_OBJECT_ZERO
+        blocksize = 256
+        header_object = 'archip_' + volume if legacy else volume
+        self.put(header_object, 'AMF.' + pack('>LQLLQ', 2, size, blocksize,
+                                              flags, 1))
+        records = [pack('<BI', MF_OBJECT_WRITABLE if name else
+                        MF_OBJECT_ZERO, len(name)) + name +
+                   '\0' * (123 - len(name)) for name in names]
+        for block in range(0, len(records), 2):
+            self.put('%s_%016x' % (header_object, block / 2),
+                     ''.join(records[block:block + 2]))
+
+    def test_v2_layouts(self):
+        self.put_v2('volume3', ['a0', 'a1', 'a2'], 3 * 256, legacy=False)
+        self.put_v2('volume4', ['b0', 'b1', 'b2'], 3 * 256)
+        # A map renamed from the legacy layout may leave the old one behind
+        self.put_v2('volume5', ['c0', 'c1', 'c2'], 3 * 256, legacy=False)
+        self.put_v2('volume5', ['d0', 'd1', 'd2'], 3 * 256)
+        for name, header_object, prefix in [('volume3', 'volume3', 'a'),
+                                            ('volume4', 'archip_volume4', 'b'),
+                                            ('volume5', 'volume5', 'c')]:
+            header, objects = self.read(name)
+            self.assertEqual(header.header_object, header_object)
+            self.assertEqual([o[2] for o in objects],
+                             [prefix + str(i) for i in range(3)])
+
+    def without_numpy(self):
+        """Make the runs of mapreader fall back to pure Python"""
+        import archipelago.mapreader as mapreader
+        self.addCleanup(setattr, mapreader, 'get_numpy', mapreader.get_numpy)
+        mapreader.get_numpy = lambda: None
+
+    def check_runs(self):
+        from array import array
+        from archipelago.mapreader import count_runs, run_counts, \
+            run_union, run_contains
+        runs = [array('l', [1, 3, 5]), array('l', [3, 4]), array('l')]
+        keys, counts = count_runs(runs)
+        self.assertEqual((list(keys), list(counts)),
+                         ([1, 3, 4, 5], [1, 2, 1, 1]))
+        self.assertEqual(list(run_counts(runs[1], keys, counts)), [2, 1])
+        self.assertEqual(list(run_counts(runs[2], keys, counts)), [])
+        self.assertEqual(list(run_union(runs)), [1, 3, 4, 5])
+        self.assertEqual([list(r) for r in count_runs([])], [[], []])
+        self.assertTrue(run_contains(keys, 4))
+        self.assertFalse(run_contains(keys, 2))
+
+    def test_runs(self):
+        self.without_numpy()
+        self.check_runs()
+
+    @unittest.skipUnless(get_numpy(), "numpy is not installed")
+    def test_runs_numpy(self):
+        self.check_runs()
+
+    def check_du(self):
+        import archipelago.vlmc as vlmc
+        from archipelago.vlmc import Volume, du
+        blocker = Filed.__new__(Filed)
+        blocker.archip_dir = self.archip_dir
+        set_blocker(self, blocker)
+        # A snapshot, a clone sharing one of its objects and a deleted
+        # volume, which is not accounted for
+        self.put_v2('snapa', ['a0', 'a1', '', 'a3'], 4 * 256)
+        self.put_v2('clonea', ['a0', 'c1', '', ''], 4 * 256, flags=0)
+        self.put_v2('volumed', ['a0', 'a1'], 2 * 256, flags=2)
+        volumes = [Volume('snapa', 2, 'archip_snapa', True, False, 1024, 1),
+                   Volume('clonea', 2, 'archip_clonea', False, False, 1024,
+                          1),
+                   Volume('volumed', 2, 'archip_volumed', False, True, 512,
+                          1)]
+        self.addCleanup(setattr, vlmc, 'list_volumes', vlmc.list_volumes)
+        vlmc.list_volumes = lambda use_catalog: volumes
+
+        expected = [('clonea', False, 4, 2, 1, 1, 1.5),
+                    ('snapa', True, 4, 1, 2, 1, 2.5)]
+        self.assertEqual([(r['volume'], r['snapshot'], r['objects'],
+                           r['zero'], r['exclusive'], r['shared'],
+                           r['charged']) for r in du()], expected)
+        self.assertEqual([r['volume'] for r in du(['snapa'])], ['snapa'])
+        with self.assertRaises(Error):
+            du(['snapa', 'volumed'])
+
+    def test_du(self):
+        self.without_numpy()
+        self.check_du()
+
+    @unittest.skipUnless(get_numpy(), "numpy is not installed")
+    def test_du_numpy(self):
+        self.check_du()
+
+    def test_diff(self):
+        from StringIO import StringIO
+        from archipelago.mapreader import FiledStore, MapReader
+        from archipelago.mapdiff import Extent, diff_maps, write_diff, \
+            read_diff
+        self.put_v2('snapa', ['a0', 'a1', '', 'a3'], 4 * 256)
+        self.put_v2('snapb', ['a0', 'b1', 'b2', '', 'b4', ''], 6 * 256 - 10)
+        store = FiledStore(self.archip_dir)
+        a = MapReader(store, 'snapa')
+        b = MapReader(store, 'snapb')
+        expected = [Extent(256, 512, False), Extent(768, 256, True),
+                    Extent(1024, 256, False)]
+        self.assertEqual(list(diff_maps(a, b)), expected)
+        # A full diff covers the zero ranges too
+        self.assertEqual(list(diff_maps(None, b)),
+                         [Extent(0, 768, False), Extent(768, 256, True),
+                          Extent(1024, 256, False), Extent(1280, 246, True)])
+
+        stream = StringIO()
+        self.assertEqual(write_diff(stream, expected, b.size, b.blocksize),
+                         3)
+        stream.seek(0)
+        size, blocksize, extents = read_diff(stream)
+        self.assertEqual((size, blocksize), (b.size, 256))
+        self.assertEqual(list(extents), expected)
+
+    def test_full_archive(self):
+        from io import BytesIO
+        from archipelago.mapreader import FiledStore, MapReader
+        from archipelago.mapdiff import diff_maps
+        from archipelago.backup import write_archive, read_archive_header, \
+            apply_archive
+        self.put_v2('snapa', ['a0', '', 'a2', ''], 4 * 256)
+        snapa = MapReader(FiledStore(self.archip_dir), 'snapa')
+        source = MemoryVolume('a' * 256 + '\0' * 256 + 'c' * 256 + '\0' * 256)
+        stream = BytesIO()
+        write_archive(stream, source, diff_maps(None, snapa), 'snapa', None,
+                      snapa.size, snapa.blocksize, bufsize=100)
+
+        # Restored over a volume with data, the zero ranges are zeroed
+        stream.seek(0)
+        target = MemoryVolume('x' * 1024)
+        self.assertEqual(read_archive_header(stream)['base'], None)
+        self.assertEqual(apply_archive(stream, target, bufsize=100),
+                         (4, 512))
+        self.assertEqual(target.data, source.data)
+
+class FiledScanTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.archip_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        recursive_remove(self.archip_dir)
+        os.rmdir(self.archip_dir)
+
+    def put(self, name, data='', path=None):
+        from archipelago.vlmc import filed_object_dir
+        if path is None:
+            path = os.path.join(self.archip_dir, filed_object_dir(name))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+        return os.path.join(path, name)
+
+    def test_filed_header_candidates(self):
+        from archipelago.vlmc import filed_header_candidates
+        expected = [(name, self.put(name))
+                    for name in ('volume1', 'archip_volume2')]
+        for name in ('volume1_%016x_%016x' % (1, 0),
+                     'archip_volume2_%016x' % 0, 'volume1_lock', 'abc'):
+            self.put(name)
+        # Files outside the three levels of hex directories are not objects
+        self.put('volume3', path=self.archip_dir)
+        self.put('volume4', path=os.path.join(self.archip_dir, 'xyz'))
+        self.put('volume5', path=os.path.join(self.archip_dir, 'ab'))
+        self.assertEqual(sorted(filed_header_candidates(self.archip_dir)),
+                         sorted(expected))
+
+        self.assertEqual(list(filed_header_candidates(
+            os.path.join(self.archip_dir, 'missing'))), [])
+
+    def test_catalog_refresh(self):
+        import archipelago.catalog as catalog
+        blocker = Filed.__new__(Filed)
+        blocker.archip_dir = os.path.join(self.archip_dir, 'blocker')
+        set_blocker(self, blocker)
+
+        parsed = []
+
+        def parse_volume_header(name, header):
+            parsed.append(name)
+            return parse(name, header)
+        parse = catalog.parse_volume_header
+        self.addCleanup(setattr, catalog, 'parse_volume_header', parse)
+        catalog.parse_volume_header = parse_volume_header
+
+        def put(name, data):
+            from archipelago.vlmc import filed_object_dir
+            return self.put(name, data, os.path.join(
+                blocker.archip_dir, filed_object_dir(name)))
+
+        def v2_header(flags):
+            return 'AMF.' + pack('>LQLLQ', 2, 4096, 4096, flags, 1)
+
+        put('volume1', v2_header(0))
+        put('archip_volume2', pack('<LQ', 1, 8192))
+        put('volume1_%016x_%016x' % (1, 0), 'data')
+        # Modification times this recent are not trusted
+        for path, dirs, files in os.walk(blocker.archip_dir):
+            for name in [path] + [os.path.join(path, n) for n in files]:
+                os.utime(name, (time.time() - 3600, time.time() - 3600))
+
+        db = catalog.Catalog(os.path.join(self.archip_dir, 'catalog.db'))
+        self.addCleanup(db.close)
+        db.refresh(jobs=4)
+        self.assertEqual(sorted(parsed), ['archip_volume2', 'volume1'])
+        self.assertEqual([(v.name, v.version, v.deleted, v.size)
+                          for v in db.volumes()],
+                         [('volume1', 2, False, 4096),
+                          ('volume2', 1, False, 8192)])
+
+        # Nothing changed, nothing is read again
+        del parsed[:]
+        db.refresh(jobs=4)
+        self.assertEqual(parsed, [])
+        self.assertEqual(len(db.volumes()), 2)
+
+        # Only new and changed headers are read, and removed ones forgotten
+        put('volume1', v2_header(2))
+        put('volume3', v2_header(0))
+        os.unlink(os.path.join(blocker.archip_dir,
+                               catalog.filed_object_dir('archip_volume2'),
+                               'archip_volume2'))
+        db.refresh(jobs=4)
+        self.assertEqual(sorted(parsed), ['volume1', 'volume3'])
+        self.assertEqual([(v.name, v.deleted) for v in db.volumes()],
+                         [('volume1', True), ('volume3', False)])
+
+def set_blocker(test, blocker):
+    """Make blocker the blocker peer for the duration of a test case"""
+    from archipelago.common import peers
+    if 'blockerm' in peers:
+        test.addCleanup(peers.__setitem__, 'blockerm', peers['blockerm'])
+    else:
+        test.addCleanup(peers.pop, 'blockerm', None)
+    peers['blockerm'] = blocker
+
+
+def patch_rados(test):
+    """Serve the rados module of a test case from the in-memory fakerados,
+    emptied, and return it"""
+    import archipelago.radoslist as radoslist
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    test.addCleanup(sys.path.remove, sys.path[0])
+    import fakerados
+    fakerados.pools.clear()
+    test.addCleanup(setattr, radoslist, 'rados_module',
+                    radoslist.rados_module)
+    radoslist.rados_module = lambda: fakerados
+    return fakerados
+
+
+class RadosListTest(unittest.TestCase):
+    pool = 'test_radoslist'
+
+    def setUp(self):
+        self.rados = patch_rados(self)
+        self.rados.failures.clear()
+        self.rados.pools[self.pool] = {}
+
+    def get_ioctx(self):
+        return self.rados.Rados().open_ioctx(self.pool)
+
+    def test_list_objects(self):
+        from archipelago.radoslist import list_objects
+        self.rados.put(self.pool, 'archip_volume1', 'a')
+        self.rados.put(self.pool, 'volume1', 'b')
+        self.rados.put(self.pool, 'archip_volume2', 'c', namespace='other')
+        self.assertEqual(list(list_objects(self.get_ioctx())),
+                         [('', 'archip_volume1'), ('', 'volume1')])
+        self.assertEqual(list(list_objects(self.get_ioctx(),
+                                           prefix='archip_')),
+                         [('', 'archip_volume1')])
+        self.assertEqual(list(list_objects(self.get_ioctx(),
+                                           namespace='other')),
+                         [('other', 'archip_volume2')])
+        self.assertEqual(sorted(list_objects(self.get_ioctx(),
+                                             prefix='archip_',
+                                             namespace='*')),
+                         [('', 'archip_volume1'),
+                          ('other', 'archip_volume2')])
+
+    def test_aio_read_window(self):
+        from archipelago.radoslist import aio_read_window
+        names = ['object%d' % i for i in range(100)]
+        for name in names:
+            self.rados.put(self.pool, name, name * 2)
+        ioctx = self.get_ioctx()
+        objects = [('', name) for name in names + ['missing']]
+        read = dict((name, data) for _, name, data
+                    in aio_read_window(ioctx, objects, 8, window=7))
+        self.assertEqual(sorted(read), sorted(names))
+        for name, data in read.iteritems():
+            self.assertEqual(data, (name * 2)[:8])
+
+        # Reads in flight keep the namespace they were issued in
+        for i, name in enumerate(names):
+            self.rados.put(self.pool, name, 'ns%d' % (i % 3),
+                           namespace='ns%d' % (i % 3))
+        objects = [('ns%d' % (i % 3), name) for i, name in enumerate(names)]
+        read = list(aio_read_window(ioctx, objects, 8, window=7))
+        self.assertEqual(sorted(read),
+                         sorted((ns, name, ns) for ns, name in objects))
+
+        self.rados.failures['object42'] = errno.EIO
+        with self.assertRaises(Error):
+            list(aio_read_window(ioctx, objects, 8, window=7))
+
+    def test_scan_volumes(self):
+        from archipelago import vlmc
+        self.rados.put(self.pool, 'archip_volume1',
+                       'AMF.' + pack('>LQLLQ', 2, 4096, 4096, 2, 1))
+        self.rados.put(self.pool, 'volume2', pack('<LQ', 1, 8192))
+        self.rados.put(self.pool, 'volume1_%016x_%016x' % (1, 0), 'data')
+        self.rados.put(self.pool, 'garbage', 'garbage')
+
+        blocker = Radosd.__new__(Radosd)
+        blocker.pool = self.pool
+        blocker.cephx_id = None
+        set_blocker(self, blocker)
+        volumes = sorted(vlmc.scan_volumes(jobs=4))
+        self.assertEqual([(v.name, v.version, v.deleted, v.size)
+                          for v in volumes],
+                         [('volume1', 2, True, 4096),
+                          ('volume2', 1, False, 8192)])
+
+    def test_scan_volumes_all_namespaces(self):
+        from archipelago import vlmc
+        self.rados.put(self.pool, 'volume1', pack('<LQ', 1, 4096))
+        self.rados.put(self.pool, 'volume2', pack('<LQ', 1, 8192),
+                       namespace='other')
+        self.rados.put(self.pool, 'volume3', pack('<LQ', 1, 16384),
+                       namespace='third')
+
+        blocker = Radosd.__new__(Radosd)
+        blocker.pool = self.pool
+        blocker.cephx_id = None
+        set_blocker(self, blocker)
+        self.assertEqual(sorted((v.name, v.size) for v in
+                                vlmc.scan_volumes(jobs=2, namespace='*')),
+                         [('volume1', 4096), ('volume2', 8192),
+                          ('volume3', 16384)])
+        self.assertEqual([v.name for v in
+                          vlmc.scan_volumes(jobs=2, namespace='other')],
+                         ['volume2'])
+
+class GarbageCollectorTest(unittest.TestCase):
+    pool = 'test_gc'
+
+    def setUp(self):
+        self.rados = patch_rados(self)
+        self.rados.pools[self.pool] = {'': {}}
+        blocker = Radosd.__new__(Radosd)
+        blocker.pool = self.pool
+        blocker.cephx_id = None
+        set_blocker(self, blocker)
+
+    def put_map(self, volume, names, flags=0):
+        from archipelago.mapreader import MF_OBJECT_WRITABLE, MF_OBJECT_ZERO
+        blocksize = 256
+        self.rados.put(self.pool, 'archip_' + volume,
+                       'AMF.' + pack('>LQLLQ', 2, len(names) * blocksize,
+                                     blocksize, flags, 1))
+        records = [pack('<BI', MF_OBJECT_WRITABLE if name else
+                        MF_OBJECT_ZERO, len(name)) + name +
+                   '\0' * (123 - len(name)) for name in names]
+        for block in range(0, len(records), 2):
+            self.rados.put(self.pool, 'archip_%s_%016x' % (volume, block / 2),
+                           ''.join(records[block:block + 2]))
+
+    def put_object(self, name, age):
+        self.rados.put(self.pool, name, 'data')
+        self.rados.pools[self.pool][''][name][1] = time.time() - age
+
+    def objects(self):
+        return sorted(self.rados.pools[self.pool][''])
+
+    def test_gc(self):
+        from archipelago.garbage import Collector
+        live = ['volume1_%016x_%016x' % (1, i) for i in range(2)]
+        self.put_map('volume1', live + [''])
+        for name in live:
+            self.put_object(name, 7200)
+        self.put_map('volume2', ['volume2_%016x_%016x' % (1, 0)], flags=2)
+        garbage = ['volume2_%016x_%016x' % (1, 0),
+                   'clone3_%016x_%016x' % (1, 0)]
+        for name in garbage:
+            self.put_object(name, 7200)
+        self.put_object('clone4_%016x_%016x' % (1, 0), 60)
+        before = self.objects()
+
+        reported = []
+        stats = Collector(jobs=4, grace=3600, dry_run=True,
+                          report=lambda n, s: reported.append(n)).run()
+        self.assertEqual(sorted(reported), sorted(garbage))
+        self.assertEqual((stats['maps'], stats['objects'], stats['young'],
+                          stats['removed']), (2, 5, 1, 2))
+        self.assertEqual(self.objects(), before)
+
+        stats = Collector(jobs=4, grace=3600, rate=1000).run()
+        self.assertEqual(stats['removed'], 2)
+        self.assertEqual(self.objects(), sorted(set(before) - set(garbage)))
+
+    def test_grace(self):
+        from archipelago.garbage import Collector
+        young = 'clone3_%016x_%016x' % (1, 0)
+        self.put_object(young, 60)
+        stats = Collector(jobs=4, grace=3600).run()
+        self.assertEqual((stats['young'], stats['removed']), (1, 0))
+        self.assertEqual(self.objects(), [young])
+
+        stats = Collector(jobs=4, grace=30).run()
+        self.assertEqual((stats['young'], stats['removed']), (0, 1))
+        self.assertEqual(self.objects(), [])
+
+    def test_missed_map(self):
+        from archipelago.mapreader import open_store
+        from archipelago.garbage import Collector
+        name = 'volume5_%016x_%016x' % (1, 0)
+        self.put_object(name, 7200)
+        collector = Collector(jobs=4, grace=3600)
+        collector.store = open_store()
+        try:
+            collector.mark()
+            # A map created after the mark is not read, but its objects are
+            # kept
+            self.put_map('volume5', [name])
+            collector.sweep()
+        finally:
+            collector.store.close()
+        self.assertEqual((collector.stats['unknown'],
+                          collector.stats['removed']), (1, 0))
+        self.assertIn(name, self.objects())
+
+    def test_deleted_map(self):
+        from archipelago.garbage import Collector
+        shared = 'snapshot6_%016x_%016x' % (1, 0)
+        own = 'volume7_%016x_%016x' % (1, 1)
+        self.put_map('snapshot6', [shared], flags=1)
+        self.put_map('volume7', [shared, own], flags=2)
+        for name in (shared, own):
+            self.put_object(name, 7200)
+        # The objects of a deleted map that a snapshot still references are
+        # kept
+        stats = Collector(jobs=4, grace=3600).run()
+        self.assertEqual((stats['maps'], stats['removed']), (2, 1))
+        self.assertIn(shared, self.objects())
+        self.assertNotIn(own, self.objects())
+
+class MemoryVolume(object):
+    """Stand-in for VolumeIO, over a bytearray"""
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.size = len(self.data)
+        self.pos = 0
+
+    def seek(self, offset):
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def write(self, data):
+        data = bytearray(data)
+        self.data[self.pos:self.pos + len(data)] = data
+        self.pos += len(data)
+
+
+class BackupArchiveTest(unittest.TestCase):
+    def archive(self, volume, extents, snapshot, base):
+        from io import BytesIO
+        from archipelago.backup import write_archive
+        stream = BytesIO()
+        write_archive(stream, volume, extents, snapshot, base, volume.size,
+                      16, bufsize=5)
+        stream.seek(0)
+        return stream
+
+    def test_chain(self):
+        from archipelago.mapdiff import Extent
+        from archipelago.backup import read_archive_header, apply_archive
+        snap1 = MemoryVolume('a' * 16 + '\0' * 16 + 'c' * 16)
+        snap2 = MemoryVolume('a' * 16 + 'b' * 16 + '\0' * 16)
+        full = self.archive(snap1, [Extent(0, 16, False),
+                                    Extent(32, 16, False)], 'snap1', None)
+        incremental = self.archive(snap2, [Extent(16, 16, False),
+                                           Extent(32, 16, True)],
+                                   'snap2', 'snap1')
+
+        volume = MemoryVolume('x' * 48)
+        self.assertEqual(read_archive_header(full)['base'], None)
+        self.assertEqual(apply_archive(full, volume, bufsize=7), (2, 32))
+        self.assertEqual(volume.data, bytearray('a' * 16 + 'x' * 16 +
+                                                'c' * 16))
+        self.assertEqual(read_archive_header(incremental)['base'], 'snap1')
+        self.assertEqual(apply_archive(incremental, volume, bufsize=7),
+                         (2, 16))
+        self.assertEqual(volume.data, snap2.data)
+
+    def test_corrupt(self):
+        from io import BytesIO
+        from archipelago.mapdiff import Extent
+        from archipelago.backup import read_archive_header, apply_archive
+        snap = MemoryVolume('abcdefgh' * 4)
+        data = self.archive(snap, [Extent(0, 32, False)], 'snap', None).read()
+        corrupt = BytesIO(data.replace('abcd', 'abce', 1))
+        read_archive_header(corrupt)
+        with self.assertRaises(Error):
+            apply_archive(corrupt, MemoryVolume('\0' * 32))
+        truncated = BytesIO(data[:-4])
+        read_archive_header(truncated)
+        with self.assertRaises(Error):
+            apply_archive(truncated, MemoryVolume('\0' * 32))
+
+    def test_corrupt_unchanged(self):
+        from io import BytesIO
+        from archipelago.mapdiff import Extent
+        from archipelago.backup import read_archive_header, apply_archive
+        snap = MemoryVolume('abcdefgh' * 4)
+        data = self.archive(snap, [Extent(0, 32, False)], 'snap', None).read()
+        # A flipped byte of an extent held in memory, or spooled
+        for bufsize in (64, 7):
+            for corrupt in (data.replace('abcd', 'abce', 1),
+                            data.replace('defg', 'dxfg', 3)):
+                src = BytesIO(corrupt)
+                read_archive_header(src)
+                volume = MemoryVolume('x' * 32)
+                with self.assertRaisesRegexp(Error, 'Checksum mismatch'):
+                    apply_archive(src, volume, bufsize=bufsize)
+                self.assertEqual(volume.data, bytearray('x' * 32))
+
+    def test_restore_corrupt(self):
+        import tempfile
+        from archipelago.mapdiff import Extent
+        from archipelago.vlmc import restore
+        vlmcd = FakeVlmcd(64)
+        vlmcd.fill(0, 'x' * 64)
+        patch_volumeio(self, vlmcd)
+        snap1 = MemoryVolume('a' * 32 + 'b' * 32)
+        snap2 = MemoryVolume('a' * 32 + 'c' * 32)
+        full = self.archive(snap1, [Extent(0, 64, False)], 'snap1', None)
+        incremental = self.archive(snap2, [Extent(32, 32, False)], 'snap2',
+                                   'snap1').read()
+        paths = []
+        for data in (full.read(), incremental.replace('cccc', 'cccd', 1)):
+            fd, path = tempfile.mkstemp()
+            os.write(fd, data)
+            os.close(fd)
+            self.addCleanup(os.unlink, path)
+            paths.append(path)
+
+        # The damage of the second archive is found before the first is
+        # applied
+        with self.assertRaisesRegexp(Error, 'Checksum mismatch'):
+            restore('volume', paths, iodepth=2, blocksize=1)
+        self.assertEqual(vlmcd.data, bytearray('x' * 64))
+        self.assertFalse([r for r in vlmcd.requests if r[0] == X_WRITE])
+
 if __name__=='__main__':
     init()
     unittest.main()